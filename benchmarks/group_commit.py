@@ -0,0 +1,100 @@
+# Пропускная способность одиночных платежей и переводов: коммит на каждую запись против group commit.
+#
+#   python benchmarks/group_commit.py --accounts 1000 --concurrency 256 --duration 10 --window 0.002 --max-batch 64
+#
+# переводы идут между случайными счетами из --accounts, конкуренция за строки низкая, упираемся в коммиты.
+# запускается из корня проекта, берет базу из config.yml. результат - JSON в stdout
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from uuid import uuid4
+
+sys.path.insert(0, os.getcwd())
+
+from server.exceptions import ApiException, TransactionRetriesExceeded  # noqa: E402
+from server.handlers import DBHandler  # noqa: E402
+from server.utils import load_conf  # noqa: E402
+
+
+async def create_accounts(db_handler, accounts):
+    return [
+        (await db_handler.create_account(f'bench_group_{uuid4()}@test.com', 1000000))['id']
+        for _ in range(accounts)
+    ]
+
+
+async def run_load(db_handler, account_ids, concurrency, duration):
+    stats = {'ok': 0, 'rejected': 0, 'gave_up': 0}
+    timings = []
+    deadline = time.monotonic() + duration
+
+    async def _worker():
+        while time.monotonic() < deadline:
+            source_id, target_id = random.sample(account_ids, 2)
+            started_at = time.perf_counter()
+            try:
+                # каждая пятая запись - пополнение, остальные - переводы
+                if random.random() < 0.2:
+                    await db_handler.create_account_payment(source_id, 100)
+                else:
+                    await db_handler.create_transaction(source_id, target_id, 100)
+                stats['ok'] += 1
+            except TransactionRetriesExceeded:
+                stats['gave_up'] += 1
+            except ApiException:
+                stats['rejected'] += 1
+            timings.append(time.perf_counter() - started_at)
+
+    started_at = time.monotonic()
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - started_at
+
+    timings.sort()
+    stats['tps'] = round(stats['ok'] / elapsed, 1)
+    stats['p50_ms'] = round(timings[len(timings) // 2] * 1000, 2)
+    stats['p99_ms'] = round(timings[int(len(timings) * 0.99) - 1] * 1000, 2)
+    return stats
+
+
+async def run_mode(config, args, group_commit):
+    database_conf = dict(config['database'], group_commit={
+        'enabled': group_commit, 'window': args.window, 'max_batch': args.max_batch
+    })
+    db_handler = DBHandler(dict(config, database=database_conf))
+    await db_handler.start()
+    account_ids = await create_accounts(db_handler, args.accounts)
+    try:
+        result = await run_load(db_handler, account_ids, args.concurrency, args.duration)
+        if group_commit:
+            stats = db_handler.group_committer.stats
+            result['avg_group_size'] = round(stats['writes'] / max(stats['groups'], 1), 1)
+            result['retried'] = stats['retried']
+    finally:
+        for account_id in account_ids:
+            await db_handler.drop_account(account_id)
+        await db_handler.close()
+    return result
+
+
+async def main(args):
+    config = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    results = {
+        'per_request': await run_mode(config, args, group_commit=False),
+        'group_commit': await run_mode(config, args, group_commit=True),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--window', type=float, default=0.002, help='database.group_commit.window')
+    parser.add_argument('--max-batch', type=int, default=64, help='database.group_commit.max_batch')
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,115 @@
+# Время страницы истории счета (GET /account/{id}/transactions) в зависимости от размера таблицы транзакций.
+#
+#   python benchmarks/history.py --sizes 100000,1000000,10000000 --accounts 1000 --queries 500
+#
+# таблица дозаполняется до каждого размера из --sizes, после каждого шага замеряются первая страница,
+# страница из середины истории (по курсору) и страница с фильтрами. при keyset пагинации время не должно
+# расти вместе с таблицей. запускается из корня проекта, берет базу из config.yml. результат - JSON в stdout
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from uuid import uuid4
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.getcwd())
+
+from server.constants import TransactionDirection  # noqa: E402
+from server.handlers import DBHandler  # noqa: E402
+from server.utils import load_conf  # noqa: E402
+
+
+# строки засеваются пачками, что бы не держать одну огромную транзакцию
+SEED_CHUNK = 500000
+SEED_START = datetime(2020, 1, 1)
+
+
+async def create_accounts(db_handler, accounts):
+    async with db_handler._acquire() as conn:
+        rows = await conn.fetch(
+            'INSERT INTO accounts(email) SELECT $1 || g FROM generate_series(1, $2) AS g RETURNING id',
+            f'bench_history_{uuid4()}_', accounts
+        )
+    return [row['id'] for row in rows]
+
+
+async def seed(db_handler, account_ids, start, stop):
+    # строка g: перевод со счета g % n на следующий счет, сумма 1..100, раз в секунду начиная с SEED_START
+    async with db_handler._acquire() as conn:
+        for chunk_start in range(start, stop, SEED_CHUNK):
+            await conn.execute(
+                '''INSERT INTO transactions(source_account_id, target_account_id, amount, ctime)
+                SELECT ids[1 + g % n], ids[1 + (g + 1) % n], 1 + g % 100, $4::timestamp + g * interval '1 second'
+                FROM generate_series($2::bigint, $3::bigint - 1) AS g,
+                    (SELECT $1::bigint[] AS ids, array_length($1::bigint[], 1) AS n) AS a''',
+                account_ids, chunk_start, min(chunk_start + SEED_CHUNK, stop), SEED_START
+            )
+        await conn.execute('ANALYZE transactions')
+
+
+async def measure(db_handler, account_ids, size, queries):
+    # середина истории: курсор на время, к которому засеяна половина строк
+    middle = (SEED_START + timedelta(seconds=size // 2), 0)
+    scenarios = {
+        'first_page': {},
+        'middle_page': {'cursor': middle},
+        'incoming_filtered': {'direction': TransactionDirection.IN, 'min_amount': 5000},
+    }
+
+    results = {}
+    for name, kwargs in scenarios.items():
+        timings = []
+        for _ in range(queries):
+            started_at = time.perf_counter()
+            await db_handler.get_account_transactions(random.choice(account_ids), **kwargs)
+            timings.append((time.perf_counter() - started_at) * 1000)
+        timings.sort()
+        results[name] = {
+            'mean_ms': round(statistics.mean(timings), 3),
+            'p99_ms': round(timings[int(len(timings) * 0.99) - 1], 3),
+        }
+    return results
+
+
+async def cleanup(db_handler, account_ids):
+    async with db_handler._acquire() as conn:
+        await conn.execute(
+            'DELETE FROM transactions WHERE source_account_id = ANY($1) OR target_account_id = ANY($1)', account_ids
+        )
+        await conn.execute('DELETE FROM accounts WHERE id = ANY($1)', account_ids)
+
+
+async def main(args):
+    db_handler = DBHandler(load_conf(os.path.join(os.getcwd(), 'config.yml')))
+    await db_handler.start()
+
+    account_ids = await create_accounts(db_handler, args.accounts)
+    results, seeded = {}, 0
+    try:
+        for size in sorted(int(size) for size in args.sizes.split(',')):
+            started_at = time.monotonic()
+            await seed(db_handler, account_ids, seeded, size)
+            seeded = size
+
+            results[size] = await measure(db_handler, account_ids, size, args.queries)
+            results[size]['seed_seconds'] = round(time.monotonic() - started_at, 1)
+    finally:
+        if not args.keep:
+            await cleanup(db_handler, account_ids)
+        await db_handler.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='100000,1000000,10000000', help='размеры таблицы через запятую')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500, help='запросов на каждый сценарий')
+    parser.add_argument('--keep', action='store_true', help='не удалять засеянные строки')
+
+    asyncio.run(main(parser.parse_args()))
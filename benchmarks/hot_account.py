@@ -0,0 +1,91 @@
+# Пропускная способность переводов через один горячий счет: обычный баланс против шардированного.
+#
+#   python benchmarks/hot_account.py --clients 200 --concurrency 64 --duration 10 --shards 16
+#
+# запускается из корня проекта, берет базу из config.yml. результат - JSON в stdout
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from uuid import uuid4
+
+sys.path.insert(0, os.getcwd())
+
+from server.exceptions import ApiException, TransactionRetriesExceeded  # noqa: E402
+from server.handlers import DBHandler  # noqa: E402
+from server.utils import load_conf  # noqa: E402
+
+
+async def create_accounts(db_handler, clients):
+    hot_account = await db_handler.create_account(f'bench_hot_{uuid4()}@test.com', 50000000)
+    client_accounts = [
+        await db_handler.create_account(f'bench_client_{uuid4()}@test.com', 500000) for _ in range(clients)
+    ]
+    return hot_account['id'], [a['id'] for a in client_accounts]
+
+
+async def run_load(db_handler, hot_account_id, client_ids, concurrency, duration):
+    stats = {'ok': 0, 'rejected': 0, 'gave_up': 0}
+    deadline = time.monotonic() + duration
+
+    async def _worker():
+        while time.monotonic() < deadline:
+            client_id = random.choice(client_ids)
+            # половина переводов пополняет горячий счет, половина списывает с него
+            source_id, target_id = (client_id, hot_account_id) if random.random() < 0.5 else (hot_account_id, client_id)
+            try:
+                await db_handler.create_transaction(source_id, target_id, 100)
+                stats['ok'] += 1
+            except TransactionRetriesExceeded:
+                stats['gave_up'] += 1
+            except ApiException:
+                stats['rejected'] += 1
+
+    started_at = time.monotonic()
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - started_at
+
+    stats['tps'] = round(stats['ok'] / elapsed, 1)
+    stats['lock_wait_seconds'] = round(db_handler.contention_stats['lock_wait_seconds'], 3)
+    return stats
+
+
+async def main(args):
+    db_handler = DBHandler(load_conf(os.path.join(os.getcwd(), 'config.yml')))
+    await db_handler.start()
+    try:
+        results = await run_modes(db_handler, args)
+    finally:
+        await db_handler.close()
+
+    print(json.dumps(results, indent=2))
+
+
+async def run_modes(db_handler, args):
+    results = {}
+
+    for mode in ('plain', 'sharded'):
+        hot_account_id, client_ids = await create_accounts(db_handler, args.clients)
+        if mode == 'sharded':
+            await db_handler.enable_balance_sharding(hot_account_id, args.shards)
+
+        db_handler.contention_stats.clear()
+        results[mode] = await run_load(db_handler, hot_account_id, client_ids, args.concurrency, args.duration)
+
+        for account_id in [hot_account_id] + client_ids:
+            await db_handler.drop_account(account_id)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--shards', type=int, default=16)
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,314 @@
+# Нагрузочный тест API по HTTP: смесь create_account, payment, transaction и GET запросов
+# при разных профилях конкуренции за счета.
+#
+#   python benchmarks/load.py --accounts 1000 --concurrency 64 --duration 20 --output base.json
+#   python benchmarks/load.py --profiles zipf,hot --compare base.json
+#   python benchmarks/load.py --concurrency-control optimistic --compare base.json
+#
+# профили - как выбираются счета для операций:
+#   uniform - равномерно по всем счетам
+#   zipf    - по закону Ципфа (--zipf-s), несколько счетов получают большую часть операций
+#   hot     - в каждом переводе участвует один горячий счет, в половине - получателем, в половине - отправителем
+#   cross   - встречные переводы A->B и B->A внутри --pairs пар счетов, худший случай для дедлоков
+#
+# без --url приложение поднимается в этом же процессе на свободном порту (клиент и сервер делят один
+# event loop, абсолютные цифры ниже, чем у отдельного сервера, но сравнивать коммиты между собой можно).
+# с --url нагружается уже запущенный сервер. счета засеваются и удаляются напрямую в базе из config.yml.
+# запускается из корня проекта, результат - JSON в stdout и в --output
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from bisect import bisect
+from uuid import uuid4
+from itertools import accumulate
+from collections import deque
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.getcwd())
+
+from server.app import Application  # noqa: E402
+from server.handlers import DBHandler  # noqa: E402
+from server.utils import load_conf  # noqa: E402
+
+
+PROFILES = ('uniform', 'zipf', 'hot', 'cross')
+DEFAULT_MIX = 'create_account=2,payment=15,transaction=60,get_account=15,get_transaction=8'
+INITIAL_BALANCE = 10000
+# счетчики из /metrics, по разнице до и после профиля считаются дедлоки и ретраи
+DB_COUNTERS = (
+    'db_transaction_errors_total{error="deadlocks"}',
+    'db_transaction_errors_total{error="serialization_failures"}',
+    'db_transaction_errors_total{error="lock_timeouts"}',
+    'db_transaction_errors_total{error="version_conflicts"}',
+    'db_transaction_retries_total',
+    'db_transaction_gave_up_total',
+)
+
+
+class AccountPicker:
+    # выбирает счета для операций по профилю конкуренции
+
+    def __init__(self, profile, account_ids, zipf_s, pairs):
+        self.profile = profile
+        self.account_ids = account_ids
+        self.hot_account_id = account_ids[0]
+        self.pairs = [(account_ids[2 * i], account_ids[2 * i + 1]) for i in range(min(pairs, len(account_ids) // 2))]
+        # накопленные веса считаются один раз, выбор - bisect по случайному числу
+        self.zipf_weights = list(accumulate(1 / rank ** zipf_s for rank in range(1, len(account_ids) + 1)))
+
+    def one(self):
+        if self.profile == 'zipf':
+            return self.account_ids[bisect(self.zipf_weights, random.random() * self.zipf_weights[-1])]
+        if self.profile == 'hot' and random.random() < 0.5:
+            return self.hot_account_id
+        if self.profile == 'cross':
+            return random.choice(random.choice(self.pairs))
+        return random.choice(self.account_ids)
+
+    def pair(self):
+        if self.profile == 'hot':
+            source_id, target_id = self.hot_account_id, random.choice(self.account_ids[1:])
+        elif self.profile == 'cross':
+            source_id, target_id = random.choice(self.pairs)
+        else:
+            source_id = target_id = self.one()
+            while target_id == source_id:
+                target_id = self.one()
+        return (source_id, target_id) if random.random() < 0.5 else (target_id, source_id)
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.statuses = {}
+
+    def record(self, operation, started_at, status):
+        self.timings.setdefault(operation, []).append(time.perf_counter() - started_at)
+        # 2xx - ok, 4xx - отказ по бизнес-правилам (нет денег и т.п.), 5xx и обрыв соединения - ошибка
+        kind = 'ok' if status < 400 else 'rejected' if status < 500 else 'errors'
+        counts = self.statuses.setdefault(operation, {'ok': 0, 'rejected': 0, 'errors': 0})
+        counts[kind] += 1
+
+
+def percentile(timings, q):
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+def summarize(recorder, elapsed):
+    report, total = {}, 0
+    for operation, timings in sorted(recorder.timings.items()):
+        timings.sort()
+        counts = recorder.statuses[operation]
+        total += len(timings)
+        report[operation] = dict(
+            counts,
+            count=len(timings),
+            rps=round(len(timings) / elapsed, 1),
+            p50_ms=round(percentile(timings, 0.5) * 1000, 2),
+            p95_ms=round(percentile(timings, 0.95) * 1000, 2),
+            p99_ms=round(percentile(timings, 0.99) * 1000, 2),
+            max_ms=round(timings[-1] * 1000, 2),
+            error_rate=round(counts['errors'] / len(timings), 4),
+        )
+    return report, round(total / elapsed, 1)
+
+
+async def read_db_counters(session, url):
+    async with session.get(f'{url}/metrics') as resp:
+        text = await resp.text()
+    counters = dict.fromkeys(DB_COUNTERS, 0.0)
+    for line in text.splitlines():
+        name, _, value = line.rpartition(' ')
+        if name in counters:
+            counters[name] = float(value)
+    return counters
+
+
+async def run_profile(session, url, picker, mix, args, created_ids):
+    operations, weights = zip(*mix.items())
+    transaction_ids = deque(maxlen=1000)
+    recorder = Recorder()
+
+    async def _request(operation):
+        if operation == 'get_transaction' and not transaction_ids:
+            operation = 'get_account'
+
+        if operation == 'create_account':
+            method, path, payload = 'POST', '/account', {'email': f'bench_load_{uuid4()}@test.com'}
+        elif operation == 'payment':
+            method, path, payload = 'POST', f'/account/{picker.one()}/payment', {'amount': random.randint(1, 10)}
+        elif operation == 'transaction':
+            source_id, target_id = picker.pair()
+            payload = {'source_account_id': source_id, 'target_account_id': target_id, 'amount': random.randint(1, 10)}
+            method, path = 'POST', '/transaction'
+        elif operation == 'get_account':
+            method, path, payload = 'GET', f'/account/{picker.one()}', None
+        else:
+            method, path, payload = 'GET', f'/transaction/{random.choice(transaction_ids)}', None
+
+        started_at = time.perf_counter()
+        try:
+            async with session.request(method, url + path, json=payload) as resp:
+                body = await resp.json()
+                status = resp.status
+        except aiohttp.ClientError:
+            status, body = 599, None
+        return operation, started_at, status, body
+
+    async def _worker(warmup_until, deadline):
+        while True:
+            operation, started_at, status, body = await _request(random.choices(operations, weights)[0])
+            # созданный счет запоминается и после дедлайна, иначе его не удалит cleanup
+            if status == 200 and operation in ('create_account', 'transaction'):
+                (created_ids if operation == 'create_account' else transaction_ids).append(body['data']['id'])
+            if started_at >= deadline:
+                return
+            if started_at >= warmup_until:
+                recorder.record(operation, started_at, status)
+
+    db_before = await read_db_counters(session, url)
+    warmup_until = time.perf_counter() + args.warmup
+    deadline = warmup_until + args.duration
+    await asyncio.gather(*[_worker(warmup_until, deadline) for _ in range(args.concurrency)])
+    db_after = await read_db_counters(session, url)
+
+    operations_report, throughput = summarize(recorder, args.duration)
+    return {
+        'throughput': throughput,
+        'operations': operations_report,
+        'db': {name: int(db_after[name] - db_before[name]) for name in DB_COUNTERS},
+    }
+
+
+def compare(results, baseline):
+    # изменение в процентах относительно прошлого прогона: rps вверх - хорошо, p99 вверх - плохо
+    diff = {}
+    for profile, report in results['profiles'].items():
+        base_report = baseline['profiles'].get(profile)
+        if base_report is None:
+            continue
+        diff[profile] = {'throughput_pct': _change(base_report['throughput'], report['throughput'])}
+        for operation, stats in report['operations'].items():
+            base_stats = base_report['operations'].get(operation)
+            if base_stats is not None:
+                diff[profile][operation] = {
+                    'rps_pct': _change(base_stats['rps'], stats['rps']),
+                    'p99_pct': _change(base_stats['p99_ms'], stats['p99_ms']),
+                }
+    return diff
+
+
+def _change(before, after):
+    return round((after - before) / before * 100, 1) if before else None
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def seed(db_handler, accounts):
+    # счета и их начальные балансы через журнал, как при POST /account, что бы не сломать сверку
+    async with db_handler._acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch(
+                '''INSERT INTO accounts(email, balance) SELECT $1 || g || '@test.com', $3
+                FROM generate_series(1, $2) AS g RETURNING id''',
+                f'bench_load_{uuid4()}_', accounts, INITIAL_BALANCE
+            )
+            account_ids = sorted(row['id'] for row in rows)
+            await conn.execute(
+                'INSERT INTO transactions(target_account_id, amount) SELECT unnest($1::bigint[]), $2',
+                account_ids, INITIAL_BALANCE
+            )
+    return account_ids
+
+
+async def cleanup(db_handler, account_ids):
+    async with db_handler._acquire() as conn:
+        await conn.execute(
+            'DELETE FROM transactions WHERE source_account_id = ANY($1) OR target_account_id = ANY($1)', account_ids
+        )
+        await conn.execute('DELETE FROM accounts WHERE id = ANY($1)', account_ids)
+
+
+async def main(args):
+    random.seed(args.seed)
+    config = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    if args.concurrency_control:
+        config['database']['concurrency_control'] = args.concurrency_control
+    mix = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    server = None
+    if args.url:
+        url = args.url.rstrip('/')
+    else:
+        server = TestServer(Application(config).webapp)
+        await server.start_server()
+        url = str(server.make_url('')).rstrip('/')
+
+    account_ids = await seed(db_handler, args.accounts)
+    created_ids = []
+    results = {
+        'commit': git_commit(),
+        'settings': {
+            name: getattr(args, name)
+            for name in ('accounts', 'concurrency', 'duration', 'mix', 'zipf_s', 'pairs', 'seed', 'concurrency_control')
+        },
+        'profiles': {},
+    }
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for profile in args.profiles.split(','):
+                picker = AccountPicker(profile, account_ids, args.zipf_s, args.pairs)
+                results['profiles'][profile] = await run_profile(session, url, picker, mix, args, created_ids)
+    finally:
+        if server is not None:
+            await server.close()
+        await cleanup(db_handler, account_ids + created_ids)
+        await db_handler.close()
+
+    if args.compare:
+        with open(args.compare) as file:
+            results['compare'] = compare(results, json.load(file))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='адрес запущенного API, по умолчанию API поднимается в этом процессе')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help=f'через запятую из {", ".join(PROFILES)}')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременных запросов')
+    parser.add_argument('--duration', type=float, default=20, help='секунд замера на каждый профиль')
+    parser.add_argument('--warmup', type=float, default=2, help='секунд прогрева перед замером, не учитываются')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='веса операций')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='параметр распределения для профиля zipf')
+    parser.add_argument('--pairs', type=int, default=4, help='пар счетов для профиля cross')
+    parser.add_argument('--seed', type=int, default=1, help='seed генератора случайных чисел')
+    parser.add_argument(
+        '--concurrency-control', choices=('pessimistic', 'optimistic'),
+        help='database.concurrency_control приложения в этом процессе, по умолчанию - из config.yml'
+    )
+    parser.add_argument('--output', help='записать результат в файл')
+    parser.add_argument('--compare', help='файл с результатом прошлого прогона')
+
+    asyncio.run(main(parser.parse_args()))
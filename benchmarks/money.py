@@ -0,0 +1,135 @@
+# Микробенчмарк сумм: Decimal, как было до перехода на копейки, против целых копеек. по каждой операции
+# горячего пути: приведение суммы из запроса, проверки и изменение балансов, сериализация ответа.
+# с --database еще UPDATE и SUM по временным таблицам с NUMERIC(8, 2) и BIGINT.
+#
+#   python benchmarks/money.py --number 100000
+#   python benchmarks/money.py --number 100000 --database --rows 100000
+#
+# запускается из корня проекта, база - из config.yml. результат - JSON в stdout, время в микросекундах
+# на одну операцию (в базе - на весь запрос). перевод целиком под нагрузкой - benchmarks/load.py --compare
+# с коммитом до перехода
+import os
+import sys
+import json
+import time
+import timeit
+import asyncio
+import argparse
+from decimal import Decimal, ROUND_HALF_UP
+
+import asyncpg
+
+sys.path.insert(0, os.getcwd())
+
+from server.money import to_minor_units, format_money  # noqa: E402
+from server.utils import json_defaults, load_conf  # noqa: E402
+
+
+MONEY_QUANT = Decimal('.01')
+MAX_BALANCE_DECIMAL = Decimal('999999.99')
+MAX_BALANCE = 99999999
+
+TRANSACTION = {'id': 123456, 'source_account_id': 1, 'target_account_id': 2, 'ctime': '2026-10-18T12:00:00'}
+
+
+def decimal_coerce(value):
+    # старый путь: Decimal из json числа, проверка > 0 и округление до копеек, как в NUMERIC(8, 2)
+    value = Decimal(value)
+    assert value.quantize(MONEY_QUANT) > 0
+    return value.quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
+
+
+def int_coerce(value):
+    value = to_minor_units(value)
+    assert value > 0
+    return value
+
+
+def decimal_transfer(balances, amount):
+    source, target = balances
+    if source < amount or amount > MAX_BALANCE_DECIMAL or target + amount > MAX_BALANCE_DECIMAL:
+        raise ValueError
+    return source - amount, target + amount
+
+
+def int_transfer(balances, amount):
+    source, target = balances
+    if source < amount or amount > MAX_BALANCE or target + amount > MAX_BALANCE:
+        raise ValueError
+    return source - amount, target + amount
+
+
+def micro(number):
+    cases = {
+        'coerce': (lambda: decimal_coerce(10.5), lambda: int_coerce(10.5)),
+        'coerce_string': (lambda: decimal_coerce('10.5'), lambda: int_coerce('10.5')),
+        'transfer': (
+            lambda: decimal_transfer((Decimal('500.00'), Decimal('100.00')), Decimal('10.50')),
+            lambda: int_transfer((50000, 10000), 1050),
+        ),
+        'json_dumps': (
+            lambda: json.dumps({'success': True, 'data': dict(TRANSACTION, amount=Decimal('10.50'))},
+                               default=json_defaults),
+            lambda: json.dumps({'success': True, 'data': format_money(dict(TRANSACTION, amount=1050), 'amount')},
+                               default=json_defaults),
+        ),
+    }
+
+    results = {}
+    for name, (decimal_fn, int_fn) in cases.items():
+        decimal_time = timeit.timeit(decimal_fn, number=number)
+        int_time = timeit.timeit(int_fn, number=number)
+        results[name] = {
+            'decimal_us': round(decimal_time / number * 1e6, 3),
+            'int_us': round(int_time / number * 1e6, 3),
+            'speedup': round(decimal_time / int_time, 2),
+        }
+    return results
+
+
+async def database(config, rows, repeat):
+    conn = await asyncpg.connect(config['database']['dsn'])
+    results = {}
+    try:
+        for column_type in ('NUMERIC(8, 2)', 'BIGINT'):
+            await conn.execute('DROP TABLE IF EXISTS bench_money')
+            await conn.execute(f'CREATE TEMP TABLE bench_money (id BIGINT PRIMARY KEY, balance {column_type})')
+            await conn.execute('INSERT INTO bench_money SELECT id, id % 1000 FROM generate_series(1, $1) AS id', rows)
+            await conn.execute('ANALYZE bench_money')
+
+            timings = {'update': [], 'sum': []}
+            for _ in range(repeat):
+                started_at = time.perf_counter()
+                await conn.execute('UPDATE bench_money SET balance = balance + 1 WHERE balance + 1 <= 999999')
+                timings['update'].append(time.perf_counter() - started_at)
+
+                started_at = time.perf_counter()
+                await conn.fetchval('SELECT sum(balance) FROM bench_money')
+                timings['sum'].append(time.perf_counter() - started_at)
+
+            results[column_type] = {
+                f'{name}_us': round(min(values) * 1e6, 1) for name, values in timings.items()
+            }
+        await conn.execute('DROP TABLE bench_money')
+    finally:
+        await conn.close()
+    return results
+
+
+def main(args):
+    results = {'micro': micro(args.number)}
+    if args.database:
+        config = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+        results['database'] = asyncio.get_event_loop().run_until_complete(
+            database(config, args.rows, args.repeat)
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--database', action='store_true', help='сравнить NUMERIC(8, 2) и BIGINT в базе')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    main(parser.parse_args())
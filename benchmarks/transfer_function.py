@@ -0,0 +1,107 @@
+# Переводы четырьмя запросами в транзакции против одного запроса к функции transfer в базе:
+# время удержания соединения (верхняя граница времени, пока счета залочены) и пропускная способность.
+#
+#   python benchmarks/transfer_function.py --accounts 10,1000 --concurrency 64 --duration 10
+#
+# на --accounts 10 переводы постоянно ждут блокировки друг друга, и TPS определяется временем удержания
+# блокировок. чем больше сетевая задержка до базы, тем больше разница. запускается из корня проекта,
+# берет базу из config.yml. результат - JSON в stdout
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from uuid import uuid4
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.getcwd())
+
+from server.exceptions import ApiException, TransactionRetriesExceeded  # noqa: E402
+from server.handlers import DBHandler  # noqa: E402
+from server.utils import load_conf  # noqa: E402
+
+
+class TimedDBHandler(DBHandler):
+    # запоминает, сколько держалось каждое соединение из пула. транзакция перевода занимает его почти целиком
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.hold_times = []
+
+    @asynccontextmanager
+    async def _acquire(self):
+        async with super()._acquire() as conn:
+            started_at = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                self.hold_times.append(time.perf_counter() - started_at)
+
+
+def _ms(timings, q):
+    return round(timings[min(len(timings) - 1, int(len(timings) * q))] * 1000, 3)
+
+
+async def run_load(db_handler, account_ids, concurrency, duration):
+    stats = {'ok': 0, 'rejected': 0, 'gave_up': 0}
+    deadline = time.monotonic() + duration
+
+    async def _worker():
+        while time.monotonic() < deadline:
+            source_id, target_id = random.sample(account_ids, 2)
+            try:
+                await db_handler.create_transaction(source_id, target_id, 100)
+                stats['ok'] += 1
+            except TransactionRetriesExceeded:
+                stats['gave_up'] += 1
+            except ApiException:
+                stats['rejected'] += 1
+
+    db_handler.hold_times.clear()
+    started_at = time.monotonic()
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - started_at
+
+    hold_times = sorted(db_handler.hold_times)
+    stats['tps'] = round(stats['ok'] / elapsed, 1)
+    stats['hold_p50_ms'] = _ms(hold_times, 0.5)
+    stats['hold_p99_ms'] = _ms(hold_times, 0.99)
+    return stats
+
+
+async def run_mode(config, accounts, args, transfer_function):
+    config = dict(config, database=dict(config['database'], transfer_function=transfer_function))
+    db_handler = TimedDBHandler(config)
+    await db_handler.start()
+    account_ids = [
+        (await db_handler.create_account(f'bench_transfer_{uuid4()}@test.com', 10000000))['id']
+        for _ in range(accounts)
+    ]
+    try:
+        return await run_load(db_handler, account_ids, args.concurrency, args.duration)
+    finally:
+        for account_id in account_ids:
+            await db_handler.drop_account(account_id)
+        await db_handler.close()
+
+
+async def main(args):
+    config = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    results = {}
+    for accounts in (int(accounts) for accounts in args.accounts.split(',')):
+        results[accounts] = {
+            'statements': await run_mode(config, accounts, args, transfer_function=False),
+            'function': await run_mode(config, accounts, args, transfer_function=True),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', default='10,1000', help='количество счетов через запятую, по прогону на каждое')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,56 @@
+# Микробенчмарк валидации запросов: скомпилированные схемы против cerberus, по каждой схеме.
+#
+#   python benchmarks/validation.py --number 20000
+#
+# результат - JSON в stdout, время в микросекундах на один документ
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.getcwd())
+
+from server import schemas  # noqa: E402
+from server.utils import cerberus_validate  # noqa: E402
+from server.validation import compile_schema  # noqa: E402
+
+
+TRANSFER = {'source_account_id': 1, 'target_account_id': 2, 'amount': 10.5}
+
+# типичный валидный и невалидный документ для каждой схемы
+DOCUMENTS = {
+    'CREATE_ACCOUNT': ({'email': 'test_account@test.com'}, {'email': 'test'}),
+    'ACCOUNT_PAYMENT': ({'amount': 10.5}, {'amount': 0}),
+    'CREATE_TRANSACTION': (TRANSFER, dict(TRANSFER, amount='x')),
+    'GET_OBJECT_BY_ID': ({'id': '12345'}, {'id': 'x'}),
+    'CREATE_TRANSACTIONS_BATCH': ({'transfers': [TRANSFER] * 100}, {'transfers': [TRANSFER] * 99 + [{}]}),
+    'ACCOUNT_TRANSACTIONS': (
+        {'id': '12345', 'direction': 'in', 'limit': '100', 'from': '2026-10-01T00:00:00'},
+        {'id': '12345', 'limit': '0', 'cursor': 'x'}
+    ),
+}
+
+
+def main(args):
+    results = {}
+    for name, documents in DOCUMENTS.items():
+        schema = getattr(schemas, name)
+        compiled = compile_schema(schema)
+
+        for kind, document in zip(('valid', 'invalid'), documents):
+            cerberus_time = timeit.timeit(lambda: cerberus_validate(schema, document), number=args.number)
+            compiled_time = timeit.timeit(lambda: compiled(document), number=args.number)
+            results[f'{name}/{kind}'] = {
+                'cerberus_us': round(cerberus_time / args.number * 1e6, 2),
+                'compiled_us': round(compiled_time / args.number * 1e6, 2),
+                'speedup': round(cerberus_time / compiled_time, 1),
+            }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    main(parser.parse_args())
@@ -0,0 +1,3 @@
+#!/bin/bash
+# выполняется при инициализации пустого тома основной базы: разрешает подключения по протоколу репликации
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
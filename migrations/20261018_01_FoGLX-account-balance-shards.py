@@ -0,0 +1,25 @@
+"""
+account balance shards
+"""
+
+from yoyo import step
+
+__depends__ = {'20201005_01_VLFX5-initial'}
+
+steps = [
+    step("""
+        ALTER TABLE accounts ADD COLUMN shards SMALLINT NOT NULL DEFAULT 0;
+        CREATE TABLE account_balance_shards (
+            account_id BIGINT NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+            slot SMALLINT NOT NULL,
+            balance NUMERIC(8, 2) NOT NULL DEFAULT 0 CHECK (balance >= 0),
+            PRIMARY KEY (account_id, slot)
+        );
+    """, """
+        UPDATE accounts SET balance = accounts.balance + s.balance
+        FROM (SELECT account_id, SUM(balance) AS balance FROM account_balance_shards GROUP BY account_id) AS s
+        WHERE accounts.id = s.account_id;
+        DROP TABLE account_balance_shards;
+        ALTER TABLE accounts DROP COLUMN shards;
+    """)
+]
@@ -0,0 +1,26 @@
+"""
+transfer requests queue
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_01_FoGLX-account-balance-shards'}
+
+# id запроса берется из transactions_id_seq и после проведения становится id транзакции
+steps = [
+    step("""
+        CREATE TABLE transfer_requests (
+            id BIGINT NOT NULL PRIMARY KEY,
+            source_account_id BIGINT NOT NULL,
+            target_account_id BIGINT NOT NULL,
+            amount NUMERIC(8, 2) NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT NULL,
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now()),
+            mtime TIMESTAMP WITHOUT TIME ZONE NULL
+        );
+        CREATE INDEX transfer_requests_pending_idx ON transfer_requests (id) WHERE status = 'pending';
+    """, """
+        DROP TABLE transfer_requests;
+    """)
+]
@@ -0,0 +1,22 @@
+"""
+transactions history indexes
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_02_Qa7Kd-transfer-requests'}
+
+# индексы под историю счета (GET /account/{id}/transactions) и удаление транзакций счета.
+# target_account_id/source_account_id и amount в конце ключа, что бы страница истории читалась
+# index only scan без обращения к таблице (INCLUDE появился только в postgres 11)
+steps = [
+    step("""
+        CREATE INDEX transactions_source_history_idx
+            ON transactions (source_account_id, ctime, id, target_account_id, amount);
+        CREATE INDEX transactions_target_history_idx
+            ON transactions (target_account_id, ctime, id, source_account_id, amount);
+    """, """
+        DROP INDEX transactions_target_history_idx;
+        DROP INDEX transactions_source_history_idx;
+    """)
+]
@@ -0,0 +1,29 @@
+"""
+balance reconciliation state
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_03_Hx2Pe-transactions-history-indexes'}
+
+# reconciliation_accounts - сумма проводок журнала по счету до last_transaction_id включительно,
+# reconciliation_checkpoint - id, до которого сверены все счета
+steps = [
+    step("""
+        CREATE TABLE reconciliation_accounts (
+            account_id BIGINT NOT NULL PRIMARY KEY REFERENCES accounts(id) ON DELETE CASCADE,
+            ledger_total NUMERIC NOT NULL,
+            last_transaction_id BIGINT NOT NULL,
+            mtime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now())
+        );
+        CREATE TABLE reconciliation_checkpoint (
+            id BOOLEAN NOT NULL PRIMARY KEY DEFAULT TRUE CHECK (id),
+            last_transaction_id BIGINT NOT NULL,
+            mtime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now())
+        );
+        INSERT INTO reconciliation_checkpoint(last_transaction_id) VALUES (0);
+    """, """
+        DROP TABLE reconciliation_checkpoint;
+        DROP TABLE reconciliation_accounts;
+    """)
+]
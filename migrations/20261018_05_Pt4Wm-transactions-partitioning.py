@@ -0,0 +1,121 @@
+"""
+monthly partitioning of transactions, archive of old partitions
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_04_Rc7Tn-reconciliation'}
+
+# transactions становится партиционированной по ctime помесячно (нужен postgres 11+).
+# существующая таблица не переписывается: она подключается партицией transactions_legacy
+# на все время до начала следующего месяца, новые месяцы - отдельными партициями.
+# первичный ключ партиционированной таблицы обязан включать ключ партиционирования, поэтому он (id, ctime),
+# уникальность id по-прежнему обеспечивает sequence. ключ (id) старой таблицы удаляется, (id, ctime)
+# на ней строится при подключении.
+# create_transactions_partitions(n) создает партиции на текущий и n следующих месяцев, ее периодически
+# зовет приложение. параллельные вызовы сериализуются advisory локом, месяцы, которые уже покрыты
+# другой партицией (transactions_legacy), пропускаются
+steps = [
+    step("""
+        CREATE FUNCTION create_transactions_partitions(months_ahead INT) RETURNS VOID AS $$
+        DECLARE
+            month_start TIMESTAMP;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('create_transactions_partitions'));
+            FOR i IN 0..months_ahead LOOP
+                month_start := date_trunc('month', timezone('utc', now())) + make_interval(months => i);
+                BEGIN
+                    EXECUTE format(
+                        'CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                        'transactions_p' || to_char(month_start, 'YYYY_MM'),
+                        month_start, month_start + interval '1 month'
+                    );
+                EXCEPTION WHEN invalid_object_definition THEN
+                    NULL;
+                END;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        ALTER TABLE transactions RENAME TO transactions_legacy;
+        ALTER TABLE transactions_legacy ALTER COLUMN id DROP DEFAULT;
+        ALTER TABLE transactions_legacy DROP CONSTRAINT transactions_pkey;
+        ALTER INDEX transactions_source_history_idx RENAME TO transactions_legacy_source_history_idx;
+        ALTER INDEX transactions_target_history_idx RENAME TO transactions_legacy_target_history_idx;
+
+        CREATE TABLE transactions (
+            id BIGINT NOT NULL DEFAULT nextval('transactions_id_seq'),
+            source_account_id BIGINT NULL REFERENCES accounts(id) ON DELETE RESTRICT,
+            target_account_id BIGINT NOT NULL REFERENCES accounts(id) ON DELETE RESTRICT,
+            amount NUMERIC(8, 2),
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now()),
+            PRIMARY KEY (id, ctime)
+        ) PARTITION BY RANGE (ctime);
+        ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM transactions_legacy) THEN
+                EXECUTE format(
+                    'ALTER TABLE transactions ATTACH PARTITION transactions_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+                    date_trunc('month', timezone('utc', now())) + interval '1 month'
+                );
+            ELSE
+                DROP TABLE transactions_legacy;
+            END IF;
+        END;
+        $$;
+
+        CREATE INDEX transactions_source_history_idx
+            ON transactions (source_account_id, ctime, id, target_account_id, amount);
+        CREATE INDEX transactions_target_history_idx
+            ON transactions (target_account_id, ctime, id, source_account_id, amount);
+
+        SELECT create_transactions_partitions(3);
+    """, """
+        ALTER SEQUENCE transactions_id_seq OWNED BY NONE;
+        CREATE TABLE transactions_plain (
+            id BIGINT NOT NULL DEFAULT nextval('transactions_id_seq') PRIMARY KEY,
+            source_account_id BIGINT NULL REFERENCES accounts(id) ON DELETE RESTRICT,
+            target_account_id BIGINT NOT NULL REFERENCES accounts(id) ON DELETE RESTRICT,
+            amount NUMERIC(8, 2),
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now())
+        );
+        INSERT INTO transactions_plain SELECT * FROM transactions;
+        DROP TABLE transactions;
+        ALTER TABLE transactions_plain RENAME TO transactions;
+        ALTER INDEX transactions_plain_pkey RENAME TO transactions_pkey;
+        ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+        CREATE INDEX transactions_source_history_idx
+            ON transactions (source_account_id, ctime, id, target_account_id, amount);
+        CREATE INDEX transactions_target_history_idx
+            ON transactions (target_account_id, ctime, id, source_account_id, amount);
+        DROP FUNCTION create_transactions_partitions(INT);
+    """),
+    # архивные партиции: строки лежат в сжатых файлах, в базе остается сумма по каждому счету за период
+    step("""
+        CREATE TABLE transactions_archives (
+            partition_name TEXT NOT NULL PRIMARY KEY,
+            period_start TIMESTAMP WITHOUT TIME ZONE NULL,
+            period_end TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            min_id BIGINT NULL,
+            max_id BIGINT NULL,
+            rows BIGINT NOT NULL,
+            path TEXT NOT NULL,
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now())
+        );
+        CREATE TABLE transactions_archive_summary (
+            account_id BIGINT NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+            partition_name TEXT NOT NULL REFERENCES transactions_archives(partition_name),
+            period_start TIMESTAMP WITHOUT TIME ZONE NULL,
+            period_end TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            credit_total NUMERIC NOT NULL,
+            debit_total NUMERIC NOT NULL,
+            transactions_count BIGINT NOT NULL,
+            PRIMARY KEY (account_id, partition_name)
+        );
+    """, """
+        DROP TABLE transactions_archive_summary;
+        DROP TABLE transactions_archives;
+    """)
+]
@@ -0,0 +1,27 @@
+"""
+idempotency keys
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_05_Pt4Wm-transactions-partitioning'}
+
+# ключ вставляется первым запросом в транзакции, которая двигает деньги, вместе с ним в той же
+# транзакции сохраняется ответ. status и response NULL только пока эта транзакция не закоммичена
+steps = [
+    step("""
+        CREATE TABLE idempotency_keys (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status SMALLINT NULL,
+            response TEXT NULL,
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now()),
+            expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (scope, key)
+        );
+        CREATE INDEX idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);
+    """, """
+        DROP TABLE idempotency_keys;
+    """)
+]
@@ -0,0 +1,90 @@
+"""
+transfer function
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_06_Ik9Zq-idempotency-keys'}
+
+# перевод одним запросом: блокировка счетов, проверки, списание, зачисление и вставка транзакции.
+# блокировки держатся только пока выполняется этот запрос, без сетевых задержек между шагами.
+# status: ok, sharded (хотя бы один счет шардированный - перевод надо провести обычным путем),
+# source_not_found, target_not_found, not_found (оба), not_enough_money, balance_exceeded.
+# notify_channel - канал NOTIFY об изменении счетов, NULL - не уведомлять.
+# шардированные счета не лочатся, поэтому shards проверяется до блокировки и еще раз после нее:
+# шардирование могли включить, пока ждали блокировку
+steps = [
+    step("""
+        CREATE FUNCTION transfer(
+            p_source_account_id BIGINT, p_target_account_id BIGINT, p_amount NUMERIC, p_transaction_id BIGINT,
+            p_max_balance NUMERIC, p_notify_channel TEXT
+        )
+        RETURNS TABLE (
+            status TEXT, id BIGINT, source_account_id BIGINT, target_account_id BIGINT, amount NUMERIC(8, 2),
+            ctime TIMESTAMP WITHOUT TIME ZONE
+        )
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_source_balance NUMERIC;
+            v_target_balance NUMERIC;
+            v_shards INTEGER;
+        BEGIN
+            p_amount := round(p_amount, 2);
+
+            IF EXISTS (
+                SELECT 1 FROM accounts a WHERE a.id IN (p_source_account_id, p_target_account_id) AND a.shards > 0
+            ) THEN
+                status := 'sharded';
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            PERFORM 1 FROM accounts a
+            WHERE a.id IN (p_source_account_id, p_target_account_id) ORDER BY a.id FOR UPDATE;
+
+            SELECT a.balance, a.shards INTO v_source_balance, v_shards FROM accounts a WHERE a.id = p_source_account_id;
+            SELECT a.balance, greatest(a.shards, v_shards) INTO v_target_balance, v_shards
+            FROM accounts a WHERE a.id = p_target_account_id;
+
+            IF v_source_balance IS NULL OR v_target_balance IS NULL THEN
+                status := CASE
+                    WHEN v_target_balance IS NOT NULL THEN 'source_not_found'
+                    WHEN v_source_balance IS NOT NULL THEN 'target_not_found'
+                    ELSE 'not_found'
+                END;
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            IF v_shards > 0 THEN
+                status := 'sharded';
+            ELSIF v_source_balance < p_amount THEN
+                status := 'not_enough_money';
+            ELSIF p_amount > p_max_balance OR v_target_balance + p_amount > p_max_balance THEN
+                status := 'balance_exceeded';
+            END IF;
+            IF status IS NOT NULL THEN
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            UPDATE accounts a SET balance = a.balance - p_amount WHERE a.id = p_source_account_id;
+            UPDATE accounts a SET balance = a.balance + p_amount WHERE a.id = p_target_account_id;
+            IF p_notify_channel IS NOT NULL THEN
+                PERFORM pg_notify(p_notify_channel, p_source_account_id || ',' || p_target_account_id);
+            END IF;
+
+            status := 'ok';
+            RETURN QUERY
+            INSERT INTO transactions AS t (id, source_account_id, target_account_id, amount)
+            VALUES (
+                COALESCE(p_transaction_id, nextval('transactions_id_seq')), p_source_account_id,
+                p_target_account_id, p_amount
+            )
+            RETURNING status, t.id, t.source_account_id, t.target_account_id, t.amount, t.ctime;
+        END
+        $$;
+    """, """
+        DROP FUNCTION transfer(BIGINT, BIGINT, NUMERIC, BIGINT, NUMERIC, TEXT);
+    """)
+]
@@ -0,0 +1,31 @@
+"""
+accounts version
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_07_Tf8Qs-transfer-function'}
+
+# версия строки счета для оптимистичного проведения переводов (database.concurrency_control: optimistic).
+# версию поднимает триггер при каждом изменении баланса, поэтому ее видят все пути записи: обычные переводы,
+# пополнения, пачки и функция transfer. WHEN отсекает вызов функции триггера, если баланс не поменялся
+steps = [
+    step("""
+        ALTER TABLE accounts ADD COLUMN version BIGINT NOT NULL DEFAULT 0;
+
+        CREATE FUNCTION accounts_bump_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.version := OLD.version + 1;
+            RETURN NEW;
+        END
+        $$;
+
+        CREATE TRIGGER accounts_bump_version BEFORE UPDATE OF balance ON accounts
+        FOR EACH ROW WHEN (NEW.balance IS DISTINCT FROM OLD.balance)
+        EXECUTE FUNCTION accounts_bump_version();
+    """, """
+        DROP TRIGGER accounts_bump_version ON accounts;
+        DROP FUNCTION accounts_bump_version();
+        ALTER TABLE accounts DROP COLUMN version;
+    """)
+]
@@ -0,0 +1,33 @@
+"""
+balance snapshots
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_08_Ov3Rk-accounts-version'}
+
+# балансы счетов на момент taken_at: сумма всех проводок с ctime < taken_at.
+# строка пишется только для счетов, у которых были проводки с прошлого снимка, остальные счета берут
+# свою последнюю строку. balance_snapshots - сделанные снимки, следующий считается от последнего из них.
+# BRIN по ctime - снимок читает проводки за интервал между снимками. строки журнала вставляются
+# по возрастанию времени, поэтому индекс крошечный и почти не стоит ничего на вставке
+steps = [
+    step("""
+        CREATE TABLE balance_snapshots (
+            taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL PRIMARY KEY,
+            accounts BIGINT NOT NULL,
+            ctime TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT timezone('utc', now())
+        );
+        CREATE TABLE account_balance_snapshots (
+            account_id BIGINT NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+            taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            balance NUMERIC NOT NULL,
+            PRIMARY KEY (account_id, taken_at)
+        );
+        CREATE INDEX transactions_ctime_brin_idx ON transactions USING brin (ctime);
+    """, """
+        DROP INDEX transactions_ctime_brin_idx;
+        DROP TABLE account_balance_snapshots;
+        DROP TABLE balance_snapshots;
+    """)
+]
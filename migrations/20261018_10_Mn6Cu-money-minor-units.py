@@ -0,0 +1,188 @@
+"""
+money minor units
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_09_Bs5Nw-balance-snapshots'}
+
+# суммы и балансы хранятся в копейках в BIGINT: сложение и сравнение целых дешевле NUMERIC, а лимит баланса
+# больше не зашит в тип колонки (money.max_balance в config.yml). ALTER TYPE переписывает таблицы целиком,
+# на большой базе миграцию надо запускать в окно обслуживания.
+# триггер версии висит на UPDATE OF balance, с ним колонку не изменить - он пересоздается.
+# функция transfer принимает суммы в копейках, поэтому она тоже пересоздается
+steps = [
+    step("""
+        DROP TRIGGER accounts_bump_version ON accounts;
+
+        ALTER TABLE accounts ALTER COLUMN balance TYPE BIGINT USING (balance * 100)::bigint;
+        ALTER TABLE account_balance_shards ALTER COLUMN balance TYPE BIGINT USING (balance * 100)::bigint;
+        ALTER TABLE transactions ALTER COLUMN amount TYPE BIGINT USING (amount * 100)::bigint;
+        ALTER TABLE transfer_requests ALTER COLUMN amount TYPE BIGINT USING (amount * 100)::bigint;
+        ALTER TABLE transactions_archive_summary
+            ALTER COLUMN credit_total TYPE BIGINT USING (credit_total * 100)::bigint,
+            ALTER COLUMN debit_total TYPE BIGINT USING (debit_total * 100)::bigint;
+        ALTER TABLE reconciliation_accounts ALTER COLUMN ledger_total TYPE BIGINT USING (ledger_total * 100)::bigint;
+        ALTER TABLE account_balance_snapshots ALTER COLUMN balance TYPE BIGINT USING (balance * 100)::bigint;
+
+        CREATE TRIGGER accounts_bump_version BEFORE UPDATE OF balance ON accounts
+        FOR EACH ROW WHEN (NEW.balance IS DISTINCT FROM OLD.balance)
+        EXECUTE FUNCTION accounts_bump_version();
+
+        DROP FUNCTION transfer(BIGINT, BIGINT, NUMERIC, BIGINT, NUMERIC, TEXT);
+        CREATE FUNCTION transfer(
+            p_source_account_id BIGINT, p_target_account_id BIGINT, p_amount BIGINT, p_transaction_id BIGINT,
+            p_max_balance BIGINT, p_notify_channel TEXT
+        )
+        RETURNS TABLE (
+            status TEXT, id BIGINT, source_account_id BIGINT, target_account_id BIGINT, amount BIGINT,
+            ctime TIMESTAMP WITHOUT TIME ZONE
+        )
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_source_balance BIGINT;
+            v_target_balance BIGINT;
+            v_shards INTEGER;
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM accounts a WHERE a.id IN (p_source_account_id, p_target_account_id) AND a.shards > 0
+            ) THEN
+                status := 'sharded';
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            PERFORM 1 FROM accounts a
+            WHERE a.id IN (p_source_account_id, p_target_account_id) ORDER BY a.id FOR UPDATE;
+
+            SELECT a.balance, a.shards INTO v_source_balance, v_shards FROM accounts a WHERE a.id = p_source_account_id;
+            SELECT a.balance, greatest(a.shards, v_shards) INTO v_target_balance, v_shards
+            FROM accounts a WHERE a.id = p_target_account_id;
+
+            IF v_source_balance IS NULL OR v_target_balance IS NULL THEN
+                status := CASE
+                    WHEN v_target_balance IS NOT NULL THEN 'source_not_found'
+                    WHEN v_source_balance IS NOT NULL THEN 'target_not_found'
+                    ELSE 'not_found'
+                END;
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            IF v_shards > 0 THEN
+                status := 'sharded';
+            ELSIF v_source_balance < p_amount THEN
+                status := 'not_enough_money';
+            ELSIF p_amount > p_max_balance OR v_target_balance + p_amount > p_max_balance THEN
+                status := 'balance_exceeded';
+            END IF;
+            IF status IS NOT NULL THEN
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            UPDATE accounts a SET balance = a.balance - p_amount WHERE a.id = p_source_account_id;
+            UPDATE accounts a SET balance = a.balance + p_amount WHERE a.id = p_target_account_id;
+            IF p_notify_channel IS NOT NULL THEN
+                PERFORM pg_notify(p_notify_channel, p_source_account_id || ',' || p_target_account_id);
+            END IF;
+
+            status := 'ok';
+            RETURN QUERY
+            INSERT INTO transactions AS t (id, source_account_id, target_account_id, amount)
+            VALUES (
+                COALESCE(p_transaction_id, nextval('transactions_id_seq')), p_source_account_id,
+                p_target_account_id, p_amount
+            )
+            RETURNING status, t.id, t.source_account_id, t.target_account_id, t.amount, t.ctime;
+        END
+        $$;
+    """, """
+        DROP FUNCTION transfer(BIGINT, BIGINT, BIGINT, BIGINT, BIGINT, TEXT);
+        CREATE FUNCTION transfer(
+            p_source_account_id BIGINT, p_target_account_id BIGINT, p_amount NUMERIC, p_transaction_id BIGINT,
+            p_max_balance NUMERIC, p_notify_channel TEXT
+        )
+        RETURNS TABLE (
+            status TEXT, id BIGINT, source_account_id BIGINT, target_account_id BIGINT, amount NUMERIC(8, 2),
+            ctime TIMESTAMP WITHOUT TIME ZONE
+        )
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_source_balance NUMERIC;
+            v_target_balance NUMERIC;
+            v_shards INTEGER;
+        BEGIN
+            p_amount := round(p_amount, 2);
+
+            IF EXISTS (
+                SELECT 1 FROM accounts a WHERE a.id IN (p_source_account_id, p_target_account_id) AND a.shards > 0
+            ) THEN
+                status := 'sharded';
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            PERFORM 1 FROM accounts a
+            WHERE a.id IN (p_source_account_id, p_target_account_id) ORDER BY a.id FOR UPDATE;
+
+            SELECT a.balance, a.shards INTO v_source_balance, v_shards FROM accounts a WHERE a.id = p_source_account_id;
+            SELECT a.balance, greatest(a.shards, v_shards) INTO v_target_balance, v_shards
+            FROM accounts a WHERE a.id = p_target_account_id;
+
+            IF v_source_balance IS NULL OR v_target_balance IS NULL THEN
+                status := CASE
+                    WHEN v_target_balance IS NOT NULL THEN 'source_not_found'
+                    WHEN v_source_balance IS NOT NULL THEN 'target_not_found'
+                    ELSE 'not_found'
+                END;
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            IF v_shards > 0 THEN
+                status := 'sharded';
+            ELSIF v_source_balance < p_amount THEN
+                status := 'not_enough_money';
+            ELSIF p_amount > p_max_balance OR v_target_balance + p_amount > p_max_balance THEN
+                status := 'balance_exceeded';
+            END IF;
+            IF status IS NOT NULL THEN
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            UPDATE accounts a SET balance = a.balance - p_amount WHERE a.id = p_source_account_id;
+            UPDATE accounts a SET balance = a.balance + p_amount WHERE a.id = p_target_account_id;
+            IF p_notify_channel IS NOT NULL THEN
+                PERFORM pg_notify(p_notify_channel, p_source_account_id || ',' || p_target_account_id);
+            END IF;
+
+            status := 'ok';
+            RETURN QUERY
+            INSERT INTO transactions AS t (id, source_account_id, target_account_id, amount)
+            VALUES (
+                COALESCE(p_transaction_id, nextval('transactions_id_seq')), p_source_account_id,
+                p_target_account_id, p_amount
+            )
+            RETURNING status, t.id, t.source_account_id, t.target_account_id, t.amount, t.ctime;
+        END
+        $$;
+
+        DROP TRIGGER accounts_bump_version ON accounts;
+
+        ALTER TABLE account_balance_snapshots ALTER COLUMN balance TYPE NUMERIC USING balance / 100.0;
+        ALTER TABLE reconciliation_accounts ALTER COLUMN ledger_total TYPE NUMERIC USING ledger_total / 100.0;
+        ALTER TABLE transactions_archive_summary
+            ALTER COLUMN credit_total TYPE NUMERIC USING credit_total / 100.0,
+            ALTER COLUMN debit_total TYPE NUMERIC USING debit_total / 100.0;
+        ALTER TABLE transfer_requests ALTER COLUMN amount TYPE NUMERIC(8, 2) USING amount / 100.0;
+        ALTER TABLE transactions ALTER COLUMN amount TYPE NUMERIC(8, 2) USING amount / 100.0;
+        ALTER TABLE account_balance_shards ALTER COLUMN balance TYPE NUMERIC(8, 2) USING balance / 100.0;
+        ALTER TABLE accounts ALTER COLUMN balance TYPE NUMERIC(8, 2) USING balance / 100.0;
+
+        CREATE TRIGGER accounts_bump_version BEFORE UPDATE OF balance ON accounts
+        FOR EACH ROW WHEN (NEW.balance IS DISTINCT FROM OLD.balance)
+        EXECUTE FUNCTION accounts_bump_version();
+    """)
+]
@@ -0,0 +1,15 @@
+"""
+drop completed transfer requests
+"""
+
+from yoyo import step
+
+__depends__ = {'20261018_10_Mn6Cu-money-minor-units'}
+
+# проведенный запрос удаляется из очереди в той же транзакции, что и перевод: он уже лежит в transactions
+# с тем же id. здесь удаляются запросы, проведенные до этого. откатывать нечего
+steps = [
+    step("""
+        DELETE FROM transfer_requests WHERE status = 'completed';
+    """)
+]
@@ -1,19 +1,160 @@
 import os
+import sys
 import os.path
+import argparse
+from datetime import datetime
 
 import asyncio
 
 from server.app import Application
-from server.utils import load_conf
+from server.handlers import DBHandler
+from server.reconciliation import Reconciler
+from server.partitions import Archiver
+from server.imports import AccountImporter
+from server.snapshots import BalanceSnapshotter
+from server.supervisor import Supervisor
+from server.constants import StorageBackend
+from server.utils import load_conf, custom_json_dumps
+from server.money import format_money
+
+
+async def shard_balance(config, account_id, shards):
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    try:
+        return await db_handler.enable_balance_sharding(account_id, shards)
+    finally:
+        await db_handler.close()
+
+
+async def reconcile(config, full):
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    try:
+        return await Reconciler(db_handler, config).run(full=full)
+    finally:
+        await db_handler.close()
+
+
+async def archive(config, before):
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    try:
+        return await Archiver(db_handler, config).archive(before)
+    finally:
+        await db_handler.close()
+
+
+async def snapshot_balances(config, at):
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    try:
+        snapshotter = BalanceSnapshotter(db_handler, config)
+        return await snapshotter.take(at) if at is not None else await snapshotter.run()
+    finally:
+        await db_handler.close()
+
+
+async def import_accounts(config, path, import_format):
+    async def _lines():
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                yield line
+
+    async def _print_results(results):
+        sys.stdout.write(''.join(custom_json_dumps(result) + '\n' for result in results))
+
+    db_handler = DBHandler(config)
+    await db_handler.start()
+    try:
+        return await AccountImporter(db_handler, config).run(_lines(), import_format, _print_results)
+    finally:
+        await db_handler.close()
+
+
+def archive_cutoff(retention_months):
+    # начало месяца, который был retention_months месяцев назад
+    now = datetime.utcnow()
+    months = now.year * 12 + now.month - 1 - retention_months
+    return datetime(months // 12, months % 12 + 1, 1)
 
 
 def main():
+    parser = argparse.ArgumentParser(prog='python -m server', description='без команды запускает API')
+    commands = parser.add_subparsers(dest='command')
+
+    shard_parser = commands.add_parser('shard-balance', help='включить шардированный баланс для горячего счета')
+    shard_parser.add_argument('account_id', type=int)
+    shard_parser.add_argument('shards', type=int, help='количество слотов баланса')
+
+    reconcile_parser = commands.add_parser('reconcile', help='сверить балансы счетов с журналом транзакций')
+    reconcile_parser.add_argument(
+        '--full', action='store_true', help='пересчитать журнал с начала, а не только новые транзакции'
+    )
+
+    archive_parser = commands.add_parser('archive', help='выгрузить старые партиции транзакций в архивные файлы')
+    archive_parser.add_argument(
+        '--before', type=datetime.fromisoformat,
+        help='архивировать партиции, которые целиком раньше этой даты. по умолчанию archive.retention_months'
+    )
+
+    snapshot_parser = commands.add_parser('snapshot-balances', help='снять наступившие снимки балансов счетов')
+    snapshot_parser.add_argument(
+        '--at', type=datetime.fromisoformat,
+        help='снять один снимок на этот момент (UTC), а не на границы balance_snapshots.interval'
+    )
+
+    import_parser = commands.add_parser('import-accounts', help='создать счета из NDJSON или CSV файла')
+    import_parser.add_argument('path', help='строки {"email": ..., "initial_balance": ...} или email[,initial_balance]')
+    import_parser.add_argument(
+        '--format', choices=['ndjson', 'csv'], help='по умолчанию csv для файлов *.csv, иначе ndjson'
+    )
+
+    args = parser.parse_args()
+
     config_path = os.path.join(os.getcwd(), 'config.yml')
     config = load_conf(config_path)
+
+    if args.command == 'shard-balance':
+        account = asyncio.get_event_loop().run_until_complete(shard_balance(config, args.account_id, args.shards))
+        print(custom_json_dumps(format_money(account, 'balance'), indent=2))
+        return
+
+    if args.command == 'reconcile':
+        report = asyncio.get_event_loop().run_until_complete(reconcile(config, args.full))
+        drifted = [format_money(account, 'balance', 'expected', 'drift') for account in report['drifted']]
+        print(custom_json_dumps(dict(report, drifted=drifted), indent=2))
+        # ненулевой код, если есть расхождения - для cron и алертов
+        sys.exit(1 if report['drifted'] else 0)
+
+    if args.command == 'archive':
+        before = args.before or archive_cutoff(config.get('archive', {}).get('retention_months', 12))
+        archived = asyncio.get_event_loop().run_until_complete(archive(config, before))
+        print(custom_json_dumps(archived, indent=2))
+        return
+
+    if args.command == 'snapshot-balances':
+        taken = asyncio.get_event_loop().run_until_complete(snapshot_balances(config, args.at))
+        print(custom_json_dumps(taken, indent=2))
+        return
+
+    if args.command == 'import-accounts':
+        import_format = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+        summary = asyncio.get_event_loop().run_until_complete(import_accounts(config, args.path, import_format))
+        # результаты по строкам уже в stdout, последней строкой - итог
+        print(custom_json_dumps({'summary': summary}))
+        return
+
+    if config['http'].get('workers', 1) > 1:
+        # у каждого процесса было бы свое состояние в памяти и общий журнал
+        if config.get('storage', {}).get('backend') == StorageBackend.MEMORY:
+            sys.exit('storage.backend memory works only with http.workers: 1')
+        sys.exit(Supervisor(config).run())
+
     app = Application(config)
 
     app.run()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,132 @@
+import time
+import asyncio
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from server.exceptions import RequestRejected
+
+
+READS = 'reads'
+WRITES = 'writes'
+
+# класс маршрута по (метод, шаблон пути). выгрузка и импорт идут потоком и ограничены сами (export.max_concurrent,
+# пачки импорта), а /stats и /metrics должны отвечать и под перегрузкой, поэтому они не ограничиваются
+ROUTE_CLASSES = {
+    ('GET', '/account/{id}'): READS,
+    ('GET', '/account/{id}/transactions'): READS,
+    ('GET', '/account/{id}/balance'): READS,
+    ('POST', '/accounts/balances'): READS,
+    ('GET', '/transaction/{id}'): READS,
+    ('POST', '/account'): WRITES,
+    ('POST', '/account/{id}/payment'): WRITES,
+    ('POST', '/transaction'): WRITES,
+    ('POST', '/transactions/batch'): WRITES,
+}
+
+# момент time.monotonic(), к которому запрос должен успеть ответить. выставляет admission middleware,
+# по нему ограничиваются ожидание соединения пула и каждый запрос к базе (см. MeteredConnection)
+request_deadline = ContextVar('request_deadline', default=None)
+
+
+def time_left():
+    # сколько секунд осталось до дедлайна текущего запроса, None - у запроса нет дедлайна
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise RequestRejected('deadline')
+    return left
+
+
+class AdmissionGate:
+    # не больше max_concurrent запросов класса в работе и не больше max_queue в очереди за ними.
+    # запрос, которому нет места в очереди или который не дождался ее до своего дедлайна, сразу получает 503,
+    # а не висит в ожидании пула, пока клиент не отвалится по таймауту
+
+    def __init__(self, name, conf):
+        self.name = name
+        self.max_concurrent = conf.get('max_concurrent', 100)
+        self.max_queue = conf.get('max_queue', 100)
+        # сколько секунд дается запросу с момента прихода, вместе с ожиданием в очереди
+        self.deadline = conf.get('deadline', 5.0)
+        self.active = 0
+        self._waiters = deque()
+        # admitted - приняты, queued - ждали очереди, queue_full, queue_timeout и deadline - отказы
+        self.stats = Counter()
+
+    async def acquire(self, deadline):
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self.stats['admitted'] += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.stats['queue_full'] += 1
+            raise RequestRejected('queue_full')
+
+        self.stats['queued'] += 1
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            # release мог успеть отдать слот, тогда запрос принят
+            if not future.cancelled():
+                self.stats['admitted'] += 1
+                return
+            self._waiters.remove(future)
+            self.stats['queue_timeout'] += 1
+            raise RequestRejected('queue_timeout') from None
+        except asyncio.CancelledError:
+            # клиент ушел из очереди. если слот ему уже отдали - отдаем дальше
+            if future.cancelled():
+                self._waiters.remove(future)
+            else:
+                self.release()
+            raise
+        self.stats['admitted'] += 1
+
+    def release(self):
+        # слот переходит первому в очереди, active при этом не меняется
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def get_stats(self):
+        return dict(self.stats, active=self.active, queued_now=len(self._waiters))
+
+
+class AdmissionController:
+    # ограничивает чтения и записи, которые двигают деньги, отдельно: поток чтений не должен занимать
+    # соединения, на которых ждут переводы, и наоборот. лимиты - admission в config.yml
+
+    def __init__(self, config):
+        conf = config.get('admission', {})
+        self.enabled = conf.get('enabled', False)
+        # Retry-After в ответе 503, секунды
+        self.retry_after = conf.get('retry_after', 1)
+        self.gates = {name: AdmissionGate(name, conf.get(name, {})) for name in (READS, WRITES)}
+
+    def gate(self, method, route):
+        route_class = ROUTE_CLASSES.get((method, route))
+        if not self.enabled or route_class is None:
+            return None
+        return self.gates[route_class]
+
+    def get_stats(self):
+        return {name: gate.get_stats() for name, gate in self.gates.items()}
+
+    def collect_metrics(self):
+        reasons = ('queue_full', 'queue_timeout', 'deadline')
+        return [
+            ('http_admission_active', 'gauge', 'Admitted requests being processed', ('class',),
+             [((name,), gate.active) for name, gate in self.gates.items()]),
+            ('http_admission_queued', 'gauge', 'Requests waiting for admission', ('class',),
+             [((name,), len(gate._waiters)) for name, gate in self.gates.items()]),
+            ('http_admission_rejected_total', 'counter', 'Requests rejected with 503', ('class', 'reason'),
+             [((name, reason), gate.stats[reason]) for name, gate in self.gates.items() for reason in reasons]),
+        ]
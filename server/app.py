@@ -1,13 +1,19 @@
+import time
+
 from aiohttp import web
 from loguru import logger
 
-from server.handlers import AppHandlers
+from server.constants import ServiceErrors
+from server.admission import request_deadline
+from server.tracing import record_span
+from server.exceptions import TransactionRetriesExceeded, RequestRejected
+from server.handlers import AppHandlers, CONSISTENCY_TOKEN_HEADER
 
 
 class Application:
-    def __init__(self, config):
+    def __init__(self, config, storage=None):
         self.config = config
-        self.webapp = self._create_webapp(config)
+        self.webapp = self._create_webapp(config, storage)
 
     @staticmethod
     @web.middleware
@@ -18,6 +24,9 @@ class Application:
         except Exception as exc:
             if isinstance(exc, web.HTTPException):
                 message, status = exc.reason,  exc.status_code
+            elif isinstance(exc, TransactionRetriesExceeded):
+                # база так и не смогла провести транзакцию из-за конкуренции за блокировки
+                message, status = ServiceErrors.TRY_AGAIN_LATER, 503
             else:
                 logger.exception('Uncatched exception: ')
                 message, status = 'server error', 500
@@ -26,23 +35,142 @@ class Application:
 
         return response
 
-    def _create_webapp(self, config):
-        webapp = web.Application(middlewares=[self.error_middleware])
+    @staticmethod
+    def metrics_middleware(metrics):
+        # стоит перед error_middleware, поэтому видит итоговый статус, в том числе 500 и 503.
+        # route - шаблон пути (/account/{id}), что бы число рядов метрики не росло с числом счетов
+        @web.middleware
+        async def _metrics_middleware(request, handler):
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'unmatched'
+            metrics.http_in_flight += 1
+            started_at = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as exc:
+                status = exc.status_code
+                raise
+            finally:
+                metrics.http_in_flight -= 1
+                metrics.http_requests.observe(time.perf_counter() - started_at, route, request.method, status)
+
+        return _metrics_middleware
+
+    @staticmethod
+    def admission_middleware(admission):
+        # запросы ограниченных маршрутов проходят через очередь своего класса и получают дедлайн.
+        # стоит после error_middleware: отказ - это обычный ответ 503 с Retry-After, а не исключение
+        @web.middleware
+        async def _admission_middleware(request, handler):
+            resource = request.match_info.route.resource
+            gate = admission.gate(request.method, resource.canonical if resource is not None else None)
+            if gate is None:
+                return await handler(request)
+
+            deadline = time.monotonic() + gate.deadline
+            started_at = time.perf_counter()
+            try:
+                await gate.acquire(deadline)
+            except RequestRejected:
+                return Application.overloaded_response(admission.retry_after)
+            finally:
+                record_span('admission', started_at, time.perf_counter() - started_at)
+
+            token = request_deadline.set(deadline)
+            try:
+                return await handler(request)
+            except RequestRejected:
+                gate.stats['deadline'] += 1
+                return Application.overloaded_response(admission.retry_after)
+            finally:
+                request_deadline.reset(token)
+                gate.release()
+
+        return _admission_middleware
+
+    @staticmethod
+    def overloaded_response(retry_after):
+        response = AppHandlers.error_response(ServiceErrors.TRY_AGAIN_LATER, status=503)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @staticmethod
+    def consistency_middleware(db_handler):
+        # ответ на успешную запись получает токен для чтения своих записей с реплик, см. DBHandler.get_write_lsn.
+        # стоит после error_middleware: ошибка handler проходит мимо, а запись, для которой не удалось
+        # получить токен, все равно отвечает успехом, просто без токена
+        @web.middleware
+        async def _consistency_middleware(request, handler):
+            response = await handler(request)
+            if request.method not in ('GET', 'HEAD') and response.status < 400 and not response.prepared:
+                try:
+                    response.headers[CONSISTENCY_TOKEN_HEADER] = await db_handler.get_write_lsn()
+                except Exception:
+                    logger.exception('Getting consistency token failed: ')
+            return response
+
+        return _consistency_middleware
+
+    def _create_webapp(self, config, storage=None):
+        _handlers = AppHandlers(config, storage=storage)
+        middlewares = [
+            self.metrics_middleware(_handlers.metrics), self.error_middleware,
+            self.admission_middleware(_handlers.admission),
+        ]
+        if _handlers.tracer.enabled:
+            middlewares.insert(0, _handlers.tracer.middleware())
+        # без реплик все читают с основной базы, токены не нужны
+        if _handlers.postgres and _handlers.db_handler.replicas.enabled:
+            middlewares.append(self.consistency_middleware(_handlers.db_handler))
+        webapp = web.Application(middlewares=middlewares)
+
+        # пул открывается и прогревается до того, как приложение начнет принимать запросы.
+        # фоновые задачи стартуют после пула и останавливаются до его закрытия
+        if _handlers.owns_storage:
+            webapp.on_startup.append(_handlers.db_handler.start)
+        if _handlers.postgres:
+            webapp.on_startup.append(_handlers.partition_maintainer.start)
+            webapp.on_startup.append(_handlers.idempotency_cleaner.start)
+            webapp.on_startup.append(_handlers.balance_snapshotter.start)
+            webapp.on_startup.append(_handlers.transfer_workers.start)
+            webapp.on_cleanup.append(_handlers.transfer_workers.stop)
+            webapp.on_cleanup.append(_handlers.balance_snapshotter.stop)
+            webapp.on_cleanup.append(_handlers.idempotency_cleaner.stop)
+            webapp.on_cleanup.append(_handlers.partition_maintainer.stop)
+        if _handlers.owns_storage:
+            webapp.on_cleanup.append(_handlers.db_handler.close)
 
-        _handlers = AppHandlers(config)
         webapp.add_routes([
             web.post('/account', _handlers.create_account),
             web.get('/account/{id}', _handlers.get_account),
             web.post('/account/{id}/payment', _handlers.account_payment),
             web.post('/transaction', _handlers.create_transaction),
-            web.get('/transaction/{id}', _handlers.get_transaction)
+            web.get('/transaction/{id}', _handlers.get_transaction),
+            web.get('/stats', _handlers.get_stats),
+            web.get('/metrics', _handlers.get_metrics),
+            web.get('/admin/profiling', _handlers.get_profiling),
+            web.post('/admin/profiling', _handlers.profiling),
         ])
+        # этих операций нет в интерфейсе Storage, они есть только у базы
+        if _handlers.postgres:
+            webapp.add_routes([
+                web.post('/accounts/import', _handlers.import_accounts),
+                web.get('/account/{id}/transactions', _handlers.get_account_transactions),
+                web.get('/account/{id}/balance', _handlers.get_account_balance),
+                web.post('/accounts/balances', _handlers.get_accounts_balances),
+                web.post('/transactions/batch', _handlers.create_transactions_batch),
+                web.get('/transactions/export', _handlers.export_transactions),
+            ])
         return webapp
 
-    def run(self):
+    def run(self, reuse_port=False):
         logger.info('Starting application')
         web.run_app(
             self.webapp,
             host=self.config['http']['host'],
-            port=self.config['http']['port']
+            port=self.config['http']['port'],
+            reuse_port=reuse_port
         )
@@ -0,0 +1,98 @@
+import asyncio
+from collections import OrderedDict, Counter
+
+import asyncpg
+from loguru import logger
+
+
+MISSING = object()
+
+
+class LRUCache:
+    # кэш ограниченного размера, при переполнении вытесняется ключ, к которому дольше всего не обращались
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.stats = Counter()
+        # растет при каждой инвалидации. значение, прочитанное из базы до инвалидации, в кэш не попадет
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.stats['misses'] += 1
+            return MISSING
+
+        self._data.move_to_end(key)
+        self.stats['hits'] += 1
+        return dict(value)
+
+    def set(self, key, value, generation=None):
+        # generation - значение self.generation до похода в базу за value
+        if generation is not None and generation != self.generation:
+            return
+
+        self._data[key] = dict(value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        self.generation += 1
+        if self._data.pop(key, None) is not None:
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+
+class CacheInvalidationListener:
+    # слушает LISTEN канал в postgres, через который процессы сообщают друг другу об изменении счетов.
+    # пока соединение порвано, об изменениях мы не узнаем, поэтому кэш сбрасывается и соединение переоткрывается
+
+    reconnect_delay = 1
+
+    def __init__(self, dsn, channel, on_message, on_reset):
+        self.dsn = dsn
+        self.channel = channel
+        self.on_message = on_message
+        self.on_reset = on_reset
+        self._conn = None
+
+    async def start(self):
+        self._conn = await asyncpg.connect(self.dsn)
+        self._conn.add_termination_listener(self._on_termination)
+        await self._conn.add_listener(self.channel, self._on_notification)
+
+    async def stop(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            conn.remove_termination_listener(self._on_termination)
+            await conn.close()
+
+    def _on_notification(self, conn, pid, channel, payload):
+        self.on_message(payload)
+
+    def _on_termination(self, conn):
+        logger.warning('Cache invalidation listener disconnected, cache is reset')
+        self.on_reset()
+        asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        while self._conn is not None:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.start()
+            except (OSError, asyncpg.PostgresError):
+                logger.warning('Cache invalidation listener reconnect failed')
+                continue
+            # пока переподключались, могли пропустить уведомления
+            self.on_reset()
+            return
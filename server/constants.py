@@ -1,3 +1,11 @@
+# суммы хранятся в базе BIGINT и считаются в python целыми числами копеек, в рубли они переводятся
+# только на границе json (см. server.money)
+MINOR_UNITS = 100
+# больше сумма не принимается ни в каком запросе: сумма двух таких еще помещается в BIGINT.
+# лимит баланса счета - money.max_balance в config.yml, он не больше этого
+MAX_AMOUNT = 2 ** 62 - 1
+
+
 class ValidationErrors:
     NOT_FOUND = 'not found'
     MUST_BE_INT = 'must be integer'
@@ -6,3 +14,54 @@ class ValidationErrors:
     SAME_AS_SOURCE_ACCOUNT = 'same as source_account'
     NOT_ENOUGHT_MONEY = 'not enought money'
     MUST_BE_GREATER_0 = 'must be greater that 0'
+    NOT_ALLOWED = 'not allowed'
+    MUST_BE_FINITE = 'must be finite number'
+    INVALID_CURSOR = 'invalid cursor'
+    IDEMPOTENCY_KEY_REUSED = 'already used with another request'
+    INVALID_ROW = 'invalid row'
+    HISTORY_ARCHIVED = 'history archived'
+
+
+class ServiceErrors:
+    TRY_AGAIN_LATER = 'try again later'
+    SERVER_ERROR = 'server error'
+
+
+class TransferStatus:
+    PENDING = 'pending'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+
+class TransactionDirection:
+    # направление движения денег относительно счета в истории
+    IN = 'in'
+    OUT = 'out'
+    ALL = 'all'
+
+
+class ExportFormat:
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+
+class ImportStatus:
+    # результат строки массового импорта счетов
+    CREATED = 'created'
+    DUPLICATE = 'duplicate'
+    INVALID = 'invalid'
+
+
+class TransferMode:
+    SYNC = 'sync'
+    ASYNC = 'async'
+
+
+class ProfilingAction:
+    START = 'start'
+    STOP = 'stop'
+
+
+class StorageBackend:
+    POSTGRES = 'postgres'
+    MEMORY = 'memory'
@@ -21,3 +21,44 @@ class AccountNotEnoughtMoney(ApiException):
 
 class TransactionNotFound(ApiException):
     pass
+
+
+class TransactionRetriesExceeded(ApiException):
+    pass
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class OptimisticLockConflict(Exception):
+    # строку счета поменяли между чтением и условным UPDATE, перевод повторяется целиком
+    pass
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class BalanceHistoryArchived(ApiException):
+    # строки журнала между снимком и запрошенным моментом ушли в архив, а суммы архива есть только за месяц целиком
+    pass
+
+
+class RequestRejected(Exception):
+    # запрос не принят (очередь admission переполнена) или не успевает к своему дедлайну, клиент получает 503.
+    # не ApiException: такой отказ не сохраняется как ответ на Idempotency-Key, повтор проводится заново
+    pass
+
+
+class ProfilingError(Exception):
+    pass
+
+
+class StorageLogError(Exception):
+    # журнал MemoryStorage не читается: испорчена строка не в конце файла
+    pass
@@ -0,0 +1,117 @@
+import asyncio
+from collections import Counter
+
+from loguru import logger
+
+from server.admission import request_deadline
+from server.tracing import current_trace
+
+
+class GroupCommitter:
+    # group commit: одиночные платежи и переводы, которые пришли в пределах window секунд (или пока
+    # не набралось max_batch), проводятся в одной транзакции базы, каждый в своем savepoint.
+    # ошибка одного откатывает только его savepoint, остальные коммитятся. коммит (и ожидание fsync)
+    # один на группу, поэтому при частых мелких записях упираемся не в задержку коммита и размер пула
+
+    def __init__(self, db_handler, config, retryable_errors):
+        conf = config['database'].get('group_commit', {})
+        self.window = conf.get('window', 0.002)
+        self.max_batch = conf.get('max_batch', 64)
+        self.db_handler = db_handler
+        self.retryable_errors = retryable_errors
+        # groups - закоммиченные группы, writes - записи в них, retried - записи, повторенные отдельно
+        self.stats = Counter()
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, lock_ids, fn, *args):
+        # выполняет fn(conn, *args) в ближайшей группе, результат или исключение - как у _run_in_transaction.
+        # lock_ids - счета, которые лочит fn
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((lock_ids, fn, args, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, self._flush)
+        return await future
+
+    async def drain(self):
+        # отправляет накопленную группу и дожидается всех групп в работе, вызывается перед закрытием пула
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        group, self._pending = self._pending, []
+        if group:
+            task = asyncio.ensure_future(self._commit(group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _commit(self, group):
+        # задача группы создается в контексте запроса, который ее открыл, но работает на всю группу:
+        # дедлайн того запроса не должен обрывать чужие записи, а его трассировка - собирать их спаны
+        request_deadline.set(None)
+        current_trace.set(None)
+        # запрос, который отменили до начала группы (клиент ушел), не выполняется
+        group = [item for item in group if not item[3].done()]
+        if not group:
+            return
+
+        outcomes, retry = [], []
+        try:
+            async with self.db_handler._acquire() as conn:
+                async with conn.transaction():
+                    # счета всех записей группы лочатся сразу и по возрастанию id, как и в остальных транзакциях.
+                    # иначе записи разных групп лочили бы счета вперемешку и дедлочились, а группа держит
+                    # блокировки до своего коммита
+                    await self.db_handler._lock_transfer_accounts(
+                        conn, sorted({account_id for item in group for account_id in item[0]})
+                    )
+                    for _, fn, args, future in group:
+                        try:
+                            async with conn.transaction():
+                                outcomes.append((future, await fn(conn, *args), None))
+                        except self.retryable_errors:
+                            # дедлок или lock_timeout с другой группой: откатился только savepoint,
+                            # запись повторяется отдельной транзакцией после коммита группы
+                            retry.append((None, fn, args, future))
+                        except Exception as exc:
+                            outcomes.append((future, None, exc))
+        except self.retryable_errors:
+            # база оборвала всю транзакцию группы, каждая запись повторяется отдельно
+            outcomes, retry = [], group
+        except Exception as exc:
+            logger.exception('Group commit failed: ')
+            outcomes, retry = [(future, None, exc) for _, _, _, future in group], []
+
+        self.stats['groups'] += 1
+        self.stats['writes'] += len(outcomes)
+        self.db_handler.metrics.group_size.observe(len(group))
+        for future, result, exc in outcomes:
+            self._resolve(future, result, exc)
+
+        if retry:
+            self.stats['retried'] += len(retry)
+            await asyncio.gather(*[self._run_alone(fn, args, future) for _, fn, args, future in retry])
+
+    async def _run_alone(self, fn, args, future):
+        try:
+            result = await self.db_handler._run_in_transaction(fn, *args)
+        except Exception as exc:
+            self._resolve(future, None, exc)
+        else:
+            self._resolve(future, result, None)
+
+    @staticmethod
+    def _resolve(future, result, exc):
+        if future.done():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
@@ -1,47 +1,717 @@
+import io
+import csv
+import time
+import json
+import random
 import asyncio
-from decimal import Decimal
+import hashlib
+import tempfile
+from datetime import datetime
+from functools import partial
+from contextlib import asynccontextmanager
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncpg
 from aiohttp import web
+from loguru import logger
 import asyncpg.exceptions
 
-from server.constants import ValidationErrors
-from server.utils import custom_json_dumps, validate
-from server.schemas import CREATE_ACCOUNT, ACCOUNT_PAYMENT, CREATE_TRANSACTION, GET_OBJECT_BY_ID
+from server.constants import (
+    ValidationErrors, ServiceErrors, TransferStatus, TransferMode, TransactionDirection, ExportFormat,
+    ProfilingAction, StorageBackend
+)
+from server.cache import LRUCache, CacheInvalidationListener, MISSING
+from server.money import max_balance, format_minor_units, format_money
+from server.utils import custom_json_dumps, json_defaults, validate, encode_cursor, decode_cursor
+from server.worker import TransferWorkerPool
+from server.partitions import PartitionMaintainer, read_archived_transaction
+from server.idempotency import IdempotencyKeysCleaner
+from server.imports import AccountImporter
+from server.snapshots import BalanceSnapshotter
+from server.storage import Storage
+from server.memory import MemoryStorage
+from server.metrics import Metrics, MeteredConnection
+from server.group_commit import GroupCommitter
+from server.admission import AdmissionController, time_left
+from server.tracing import Tracer, record_span
+from server.profiling import SamplingProfiler
+from server.replicas import ReplicaRouter, REPLICA_ERRORS, SQL_REPLICA_CAUGHT_UP, MAX_LSN, parse_lsn
+from server.schemas import (
+    CREATE_ACCOUNT, ACCOUNT_PAYMENT, CREATE_TRANSACTION, CREATE_TRANSACTIONS_BATCH, GET_OBJECT_BY_ID,
+    ACCOUNT_TRANSACTIONS, EXPORT_TRANSACTIONS, ACCOUNT_BALANCE, ACCOUNTS_BALANCES, PROFILING
+)
 from server.exceptions import (
-    DuplicateAccountEmail, AccountNotFound, AccountBalanceExceededMaximum, AccountNotEnoughtMoney, TransactionNotFound
+    ApiException, DuplicateAccountEmail, AccountNotFound, AccountBalanceExceededMaximum, AccountNotEnoughtMoney,
+    TransactionNotFound, TransactionRetriesExceeded, OptimisticLockConflict, BalanceHistoryArchived, RequestRejected,
+    ProfilingError
+)
+
+
+# поля счета и транзакции, которые отдаются наружу
+ACCOUNT_COLUMNS = 'id, email, balance, ctime'
+TRANSACTION_COLUMNS = 'id, source_account_id, target_account_id, amount, ctime'
+
+# размер страницы истории счета по умолчанию
+HISTORY_PAGE_SIZE = 50
+# ответ на импорт счетов отдается из временного файла блоками такого размера
+IMPORT_RESULTS_BLOCK_SIZE = 64 * 1024
+
+# поля выгрузки транзакций, email счетов добавляются по with_accounts
+EXPORT_COLUMNS = ['id', 'source_account_id', 'target_account_id', 'amount', 'ctime']
+EXPORT_ACCOUNT_COLUMNS = ['source_email', 'target_email']
+
+# канал LISTEN/NOTIFY, в который пишутся id измененных счетов
+ACCOUNTS_CHANGED_CHANNEL = 'accounts_changed'
+
+# заголовок с позицией WAL: в ответе на запись и в запросах на чтение, которые должны эту запись увидеть
+CONSISTENCY_TOKEN_HEADER = 'X-Consistency-Token'
+
+
+# запросы с горячего пути. asyncpg готовит каждый при первом выполнении на соединении и держит
+# в кэше подготовленных запросов соединения (database.pool.statement_cache_size), дальше разбора уже нет
+SQL_LOCK_TRANSFER_ACCOUNTS = '''WITH locked AS (
+    SELECT id, balance, shards FROM accounts WHERE id = ANY($1) AND shards = 0 ORDER BY id FOR UPDATE
 )
+SELECT * FROM locked
+UNION ALL
+SELECT id, balance, shards FROM accounts WHERE id = ANY($1) AND shards > 0'''
+
+SQL_GET_ACCOUNT = '''SELECT id, email, ctime, balance + CASE WHEN shards > 0 THEN (
+    SELECT SUM(balance)::bigint FROM account_balance_shards WHERE account_id = accounts.id
+) ELSE 0 END AS balance
+FROM accounts WHERE id = $1'''
+
+# $3 - money.max_balance: баланс в BIGINT сам по себе не переполняется, лимит проверяется здесь
+SQL_CREDIT_PAYMENT = f'''UPDATE accounts SET balance = balance + $1
+WHERE id = $2 AND shards = 0 AND balance + $1 <= $3
+RETURNING {ACCOUNT_COLUMNS}'''
+SQL_INSERT_PAYMENT = 'INSERT INTO transactions(target_account_id, amount) VALUES ($1, $2)'
+
+SQL_INSERT_TRANSFER = '''INSERT INTO transactions(id, source_account_id, target_account_id, amount)
+VALUES (COALESCE($4, nextval('transactions_id_seq')), $1, $2, $3)
+RETURNING *'''
+SQL_CREDIT_ACCOUNT = 'UPDATE accounts SET balance = balance + $1 WHERE id = $2'
+SQL_DEBIT_ACCOUNT = 'UPDATE accounts SET balance = balance - $1 WHERE id = $2'
+
+SQL_ENQUEUE_TRANSFER = '''INSERT INTO transfer_requests(id, source_account_id, target_account_id, amount)
+VALUES (nextval('transactions_id_seq'), $1, $2, $3)
+RETURNING id, source_account_id, target_account_id, amount, ctime, status'''
+
+SQL_GET_TRANSACTION = '''SELECT id, source_account_id, target_account_id, amount, ctime,
+    'completed' AS status, NULL AS error
+FROM transactions WHERE id = $1
+UNION ALL
+SELECT id, source_account_id, target_account_id, amount, ctime, status, error
+FROM transfer_requests WHERE id = $1
+LIMIT 1'''
+
+SQL_NOTIFY = 'SELECT pg_notify($1, $2)'
+
+# перевод одним запросом, функция из миграции transfer-function
+SQL_TRANSFER = 'SELECT * FROM transfer($1, $2, $3, $4, $5, $6)'
 
+# позиция WAL основной базы, до которой видны все закоммиченные записи, см. DBHandler.get_write_lsn
+SQL_GET_WRITE_LSN = 'SELECT pg_current_wal_insert_lsn()::text'
 
-class DBHandler:
+# оптимистичные переводы: счета читаются без блокировки, баланс меняется, только если версия строки не изменилась.
+# version поднимает триггер из миграции accounts-version
+SQL_GET_TRANSFER_ACCOUNTS = 'SELECT id, balance, shards, version FROM accounts WHERE id = ANY($1)'
+SQL_APPLY_VERSIONED_DELTA = '''UPDATE accounts SET balance = balance + $1
+WHERE id = $2 AND version = $3 AND balance + $1 >= 0'''
+
+# баланс счетов $1 на момент $2: последний снимок не позже $2 плюс строки журнала [снимок, $2) из индексов
+# (счет, ctime) и суммы архивных периодов целиком внутри этого интервала. без снимка - журнал с начала.
+# sum(bigint) в postgres - numeric, результат приводится обратно к bigint
+SQL_GET_BALANCES_AT = '''SELECT a.id AS account_id, s.taken_at AS snapshot_at, (COALESCE(s.balance, 0)
+    + COALESCE((SELECT sum(amount) FROM transactions
+        WHERE target_account_id = a.id AND ctime >= COALESCE(s.taken_at, '-infinity') AND ctime < $2), 0)
+    - COALESCE((SELECT sum(amount) FROM transactions
+        WHERE source_account_id = a.id AND ctime >= COALESCE(s.taken_at, '-infinity') AND ctime < $2), 0)
+    + COALESCE((SELECT sum(credit_total - debit_total) FROM transactions_archive_summary
+        WHERE account_id = a.id AND COALESCE(period_start, '-infinity') >= COALESCE(s.taken_at, '-infinity')
+            AND period_end <= $2), 0))::bigint AS balance
+FROM accounts a
+LEFT JOIN LATERAL (
+    SELECT taken_at, balance FROM account_balance_snapshots
+    WHERE account_id = a.id AND taken_at <= $2 ORDER BY taken_at DESC LIMIT 1
+) s ON true
+WHERE a.id = ANY($1)'''
+
+SQL_GET_IDEMPOTENT_RESPONSE = '''SELECT request_hash, status, response, expires_at FROM idempotency_keys
+WHERE scope = $1 AND key = $2 AND status IS NOT NULL AND expires_at > timezone('utc', now())'''
+
+# ключ с истекшим сроком, который еще не удалила очистка, занимается заново
+SQL_CLAIM_IDEMPOTENCY_KEY = '''INSERT INTO idempotency_keys(scope, key, request_hash, expires_at)
+VALUES ($1, $2, $3, timezone('utc', now()) + make_interval(secs => $4))
+ON CONFLICT (scope, key) DO UPDATE SET request_hash = EXCLUDED.request_hash, status = NULL, response = NULL,
+    ctime = EXCLUDED.ctime, expires_at = EXCLUDED.expires_at
+WHERE idempotency_keys.expires_at <= timezone('utc', now())
+RETURNING expires_at'''
+
+SQL_STORE_IDEMPOTENT_RESPONSE = 'UPDATE idempotency_keys SET status = $3, response = $4 WHERE scope = $1 AND key = $2'
+
+# имена запросов в метке statement метрики db_statement_duration_seconds
+STATEMENT_NAMES = {
+    SQL_LOCK_TRANSFER_ACCOUNTS: 'lock_transfer_accounts',
+    SQL_GET_ACCOUNT: 'get_account',
+    SQL_CREDIT_PAYMENT: 'credit_payment',
+    SQL_INSERT_PAYMENT: 'insert_payment',
+    SQL_INSERT_TRANSFER: 'insert_transfer',
+    SQL_CREDIT_ACCOUNT: 'credit_account',
+    SQL_DEBIT_ACCOUNT: 'debit_account',
+    SQL_ENQUEUE_TRANSFER: 'enqueue_transfer',
+    SQL_GET_TRANSACTION: 'get_transaction',
+    SQL_NOTIFY: 'notify',
+    SQL_GET_IDEMPOTENT_RESPONSE: 'get_idempotent_response',
+    SQL_CLAIM_IDEMPOTENCY_KEY: 'claim_idempotency_key',
+    SQL_STORE_IDEMPOTENT_RESPONSE: 'store_idempotent_response',
+    SQL_TRANSFER: 'transfer',
+    SQL_GET_TRANSFER_ACCOUNTS: 'get_transfer_accounts',
+    SQL_APPLY_VERSIONED_DELTA: 'apply_versioned_delta',
+    SQL_GET_WRITE_LSN: 'get_write_lsn',
+    SQL_REPLICA_CAUGHT_UP: 'replica_caught_up',
+    SQL_GET_BALANCES_AT: 'get_balances_at',
+}
+
+# неуспешные статусы функции transfer
+TRANSFER_ERRORS = {
+    'source_not_found': lambda: AccountNotFound(extra_info=['source_account_id']),
+    'target_not_found': lambda: AccountNotFound(extra_info=['target_account_id']),
+    'not_found': lambda: AccountNotFound(extra_info=['source_account_id', 'target_account_id']),
+    'not_enough_money': AccountNotEnoughtMoney,
+    'balance_exceeded': AccountBalanceExceededMaximum,
+}
+
+# запрос с заголовком Idempotency-Key. scope - эндпоинт, render(result) -> (http статус, тело ответа),
+# где result - результат операции или ApiException, которым она закончилась
+Idempotency = namedtuple('Idempotency', 'scope key request_hash render')
+
+
+# ошибки, после которых база откатывает транзакцию целиком и ее можно безопасно повторить
+RETRYABLE_ERRORS = {
+    asyncpg.exceptions.DeadlockDetectedError: 'deadlocks',
+    asyncpg.exceptions.SerializationError: 'serialization_failures',
+    asyncpg.exceptions.LockNotAvailableError: 'lock_timeouts',
+    OptimisticLockConflict: 'version_conflicts',
+}
+
+
+class DBHandler(Storage):
     # в этом классе собраны методы для работы с базой, тут нет бизнес-логики как таковой
 
+    backend = StorageBackend.POSTGRES
+
     def __init__(self, config):
-        _loop = asyncio.get_event_loop()
-        self.db_pool = _loop.run_until_complete(self._create_db_pool(config))
+        retry_conf = config['database'].get('retry', {})
+        self.retry_attempts = retry_conf.get('attempts', 5)
+        self.retry_base_delay = retry_conf.get('base_delay', 0.01)
+        self.retry_max_delay = retry_conf.get('max_delay', 0.2)
+        # конфликты версий у оптимистичных переводов - штатная ситуация, а не сбой, на них попыток больше
+        self.conflict_attempts = retry_conf.get('conflict_attempts', 10)
+
+        # счетчики конкуренции за блокировки: ретраи, отказы, время ожидания локов
+        self.contention_stats = Counter()
+
+        # лимит баланса счета в копейках
+        self.max_balance = max_balance(config)
+
+        cache_conf = config.get('cache', {})
+        self.cache_enabled = cache_conf.get('enabled', False)
+        # транзакции после вставки не меняются, их кэш не надо инвалидировать.
+        # счета инвалидируются при каждой записи, в том числе из других процессов через NOTIFY
+        self.transactions_cache = LRUCache(cache_conf.get('transactions_size', 100000))
+        self.accounts_cache = LRUCache(cache_conf.get('accounts_size', 10000))
+        self.cache_listener = CacheInvalidationListener(
+            config['database']['dsn'], ACCOUNTS_CHANGED_CHANNEL,
+            on_message=self._on_accounts_changed, on_reset=self.accounts_cache.clear
+        )
+
+        idempotency_conf = config.get('idempotency', {})
+        self.idempotency_ttl = idempotency_conf.get('ttl', 86400)
+        # сохраненные ответы не меняются, их кэш не надо инвалидировать
+        self.idempotency_cache = LRUCache(idempotency_conf.get('cache_size', 100000))
+
+        self.metrics = Metrics()
+        self.metrics.statement_names.update(STATEMENT_NAMES)
+        self.metrics.add_collector(self._collect_metrics)
+
+        # pessimistic - счета перевода лочатся FOR UPDATE, optimistic - меняются условными UPDATE по версии строки.
+        # оптимистичные переводы не используют функцию transfer
+        self.optimistic = config['database'].get('concurrency_control', 'pessimistic') == 'optimistic'
+        # переводы одним запросом к функции transfer в базе, а не четырьмя запросами в транзакции
+        self.transfer_function = config['database'].get('transfer_function', False) and not self.optimistic
+        if self.optimistic:
+            self._execute_transfer = self._optimistic_transfer
+        elif self.transfer_function:
+            self._execute_transfer = self._transfer
+        else:
+            self._execute_transfer = self._create_transaction
+
+        # одиночные платежи и переводы проводятся группами, см. GroupCommitter
+        self.group_committer = None
+        if config['database'].get('group_commit', {}).get('enabled', False):
+            self.group_committer = GroupCommitter(self, config, tuple(RETRYABLE_ERRORS))
+
+        # чтения без блокировок идут на реплики из database.replicas, если они есть
+        self.replicas = ReplicaRouter(config)
+        if self.replicas.enabled:
+            self.metrics.add_collector(self.replicas.collect_metrics)
+
+        # архивные файлы читаются в своих потоках, не больше archive.max_concurrent_reads сразу: поиск
+        # в архиве медленный, и он не должен занимать все потоки executor по умолчанию
+        self.archive_executor = ThreadPoolExecutor(
+            config.get('archive', {}).get('max_concurrent_reads', 2), thread_name_prefix='archive'
+        )
+
+        # пул создается в start(), на том event loop, на котором будет работать приложение
+        self.config = config
+        self.db_pool = None
+        # ожидание свободного соединения и занятость пула, по ним подбирается его размер
+        self.pool_stats = Counter()
+        self.pool_in_use = 0
+
+    async def start(self, app=None):
+        self.db_pool = await self._create_db_pool(self.config)
+        await self.replicas.start(self.db_pool, partial(self._create_db_pool, self.config))
+        if self.cache_enabled:
+            await self.cache_listener.start()
+
+    async def close(self, app=None):
+        if self.group_committer is not None:
+            await self.group_committer.drain()
+        if self.cache_enabled:
+            await self.cache_listener.stop()
+        await self.replicas.stop()
+        if self.db_pool is not None:
+            await self.db_pool.close()
+            self.db_pool = None
+        self.archive_executor.shutdown(wait=False)
+
+    async def _create_db_pool(self, config, dsn=None):
+        # dsn задается для пулов реплик, размеры и остальные настройки у всех пулов общие
+        server_settings = {}
+        if config['database'].get('lock_timeout'):
+            server_settings['lock_timeout'] = str(config['database']['lock_timeout'])
+
+        pool_conf = config['database'].get('pool', {})
+        max_size = pool_conf.get('max_size', config['database'].get('max_connections', 10))
+        # create_pool возвращается, когда открыты все min_size соединений
+        return await asyncpg.create_pool(
+            dsn or config['database']['dsn'], server_settings=server_settings,
+            min_size=min(pool_conf.get('min_size', 10), max_size), max_size=max_size,
+            max_queries=pool_conf.get('max_queries', 50000),
+            max_inactive_connection_lifetime=pool_conf.get('max_inactive_connection_lifetime', 300),
+            statement_cache_size=pool_conf.get('statement_cache_size', 100),
+            connection_class=MeteredConnection, init=self._init_connection,
+        )
+
+    async def _init_connection(self, conn):
+        # запросы готовит сам asyncpg при первом выполнении на соединении и держит в кэше на statement_cache_size
+        # запросов. заранее их не подготовить: PreparedStatement из init пула недействителен после возврата
+        # соединения в пул
+        conn.metrics = self.metrics
+
+    @asynccontextmanager
+    async def _acquire(self):
+        # соединение для HTTP запроса с дедлайном ждется не дольше, чем до дедлайна, см. server.admission
+        started_at = time.perf_counter()
+        timeout = time_left()
+        try:
+            conn = await self.db_pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            if timeout is None:
+                raise
+            self.pool_stats['deadline_timeouts'] += 1
+            raise RequestRejected('deadline') from None
+        finally:
+            record_span('pool_acquire', started_at, time.perf_counter() - started_at)
+
+        try:
+            wait = time.perf_counter() - started_at
+            self.metrics.pool_wait.observe(wait)
+            self.pool_stats['acquires'] += 1
+            self.pool_stats['wait_seconds'] += wait
+            self.pool_stats['max_wait_seconds'] = max(self.pool_stats['max_wait_seconds'], wait)
+            self.pool_in_use += 1
+            self.pool_stats['max_in_use'] = max(self.pool_stats['max_in_use'], self.pool_in_use)
+            try:
+                yield conn
+            finally:
+                self.pool_in_use -= 1
+        finally:
+            await self.db_pool.release(conn)
+
+    @asynccontextmanager
+    async def _acquire_read(self, min_lsn=None):
+        # соединение для чтения и признак того, что оно с реплики. реплика берется, только если она
+        # проиграла WAL до min_lsn - токена, который клиент получил в ответ на свою запись. иначе основная база
+        replica = self.replicas.pick()
+        if replica is not None:
+            try:
+                conn = await replica.pool.acquire(timeout=time_left())
+            except REPLICA_ERRORS:
+                # реплика упала между проверками, проверка заметит это сама
+                conn = None
+            if conn is not None:
+                try:
+                    try:
+                        caught_up = await self.replicas.caught_up(conn, replica, min_lsn)
+                    except REPLICA_ERRORS:
+                        caught_up = False
+                    if caught_up:
+                        self.replicas.stats['reads'] += 1
+                        yield conn, True
+                        return
+                finally:
+                    await replica.pool.release(conn)
+                self.replicas.stats['behind'] += 1
+
+        if self.replicas.enabled:
+            self.replicas.stats['primary_reads'] += 1
+        async with self._acquire() as conn:
+            yield conn, False
+
+    async def _read(self, fn, *args, min_lsn=None):
+        # выполняет чтение fn(conn, *args) через _acquire_read, возвращает (результат, прочитано ли с реплики).
+        # то, чего нет на реплике, перечитывается с основной базы: запись могла еще до реплики не доехать
+        async with self._acquire_read(min_lsn) as (conn, from_replica):
+            try:
+                return await fn(conn, *args), from_replica
+            except (AccountNotFound, TransactionNotFound):
+                if not from_replica:
+                    raise
+        self.replicas.stats['not_found'] += 1
+        async with self._acquire() as conn:
+            return await fn(conn, *args), False
+
+    async def get_write_lsn(self):
+        # токен для чтения своих записей с реплик: запрос после коммита записи видит позицию WAL не меньше,
+        # чем у ее коммита. реплика, проигравшая WAL до этой позиции, видит запись
+        async with self._acquire() as conn:
+            return await conn.fetchval(SQL_GET_WRITE_LSN)
+
+    def get_stats(self):
+        return {
+            'db': self.contention_stats,
+            'pool': self.get_pool_stats(),
+            'group_commit': self.group_committer.stats if self.group_committer is not None else None,
+            'replicas': self.replicas.get_stats() if self.replicas.enabled else None,
+            'cache': {
+                'accounts': dict(self.accounts_cache.stats, size=len(self.accounts_cache)),
+                'transactions': dict(self.transactions_cache.stats, size=len(self.transactions_cache)),
+            }
+        }
+
+    def get_pool_stats(self):
+        return dict(
+            self.pool_stats, in_use=self.pool_in_use,
+            size=self.db_pool.get_size(), idle=self.db_pool.get_idle_size(),
+            min_size=self.db_pool.get_min_size(), max_size=self.db_pool.get_max_size(),
+        )
+
+    def _collect_metrics(self):
+        metrics = [
+            (
+                'db_transaction_errors_total', 'counter', 'Transactions aborted by the database', ('error',),
+                [((error,), self.contention_stats[error]) for error in RETRYABLE_ERRORS.values()]
+            ),
+            ('db_transaction_retries_total', 'counter', 'Retried transactions', (),
+             [((), self.contention_stats['retries'])]),
+            ('db_transaction_gave_up_total', 'counter', 'Transactions that ran out of retries', (),
+             [((), self.contention_stats['gave_up'])]),
+        ]
+        if self.db_pool is not None:
+            metrics.append((
+                'db_pool_connections', 'gauge', 'Pool connections by state', ('state',),
+                [(('in_use',), self.pool_in_use), (('idle',), self.db_pool.get_idle_size()),
+                 (('max',), self.db_pool.get_max_size())]
+            ))
+        for name, cache in (('accounts', self.accounts_cache), ('transactions', self.transactions_cache),
+                            ('idempotency', self.idempotency_cache)):
+            metrics.append((
+                f'cache_{name}_requests_total', 'counter', f'{name.capitalize()} cache lookups', ('result',),
+                [(('hit',), cache.stats['hits']), (('miss',), cache.stats['misses'])]
+            ))
+        return metrics
+
+    async def _run_in_transaction(self, fn, *args, implicit=False):
+        # выполняет fn(conn, *args) в транзакции, если база оборвала транзакцию из-за дедлока,
+        # конфликта сериализации или lock_timeout - повторяет ее целиком с рандомизированной задержкой.
+        # implicit - fn делает один запрос, ему хватает неявной транзакции самого запроса, без BEGIN и COMMIT
+        attempt = 1
+        while True:
+            try:
+                async with self._acquire() as conn:
+                    if implicit:
+                        return await fn(conn, *args)
+                    async with conn.transaction():
+                        return await fn(conn, *args)
+            except tuple(RETRYABLE_ERRORS) as exc:
+                self.contention_stats[RETRYABLE_ERRORS[type(exc)]] += 1
+
+                attempts = self.conflict_attempts if type(exc) is OptimisticLockConflict else self.retry_attempts
+                if attempt >= attempts:
+                    self.contention_stats['gave_up'] += 1
+                    logger.warning('Transaction gave up after {} attempts: {}', attempt, exc)
+                    raise TransactionRetriesExceeded from None
+
+            self.contention_stats['retries'] += 1
+            # full jitter, что бы повторы столкнувшихся транзакций разошлись по времени
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    async def _run_write(self, fn, *args, lock_ids=()):
+        # одиночная запись по запросу клиента. с database.group_commit.enabled попадает в общую транзакцию группы,
+        # lock_ids - счета, которые fn лочит: группа лочит счета всех своих записей заранее, по возрастанию id
+        if self.group_committer is not None:
+            return await self.group_committer.submit(lock_ids, fn, *args)
+        return await self._run_in_transaction(fn, *args)
+
+    async def get_idempotent_response(self, scope, key):
+        # сохраненный ответ на запрос с этим ключом или None. счета не читаются и не лочатся
+        response = self.idempotency_cache.get((scope, key))
+        if response is not MISSING and response['expires_at'] > datetime.utcnow():
+            return response
 
-    async def _create_db_pool(self, config):
-        return await asyncpg.create_pool(config['database']['dsn'])
+        async with self._acquire() as conn:
+            response = await conn.fetchrow(SQL_GET_IDEMPOTENT_RESPONSE, scope, key)
+        if response is None:
+            return None
+
+        response = dict(response)
+        self.idempotency_cache.set((scope, key), response)
+        return response
+
+    async def _run_idempotent(self, idempotency, fn, *args, lock_ids=()):
+        # выполняет fn(conn, *args) в транзакции вместе с сохранением ответа под ключом запроса.
+        # возвращает сохраненный ответ: этого запроса или того, который занял ключ раньше
+        response = await self._run_write(self._idempotent, idempotency, fn, args, lock_ids=lock_ids)
+        self.idempotency_cache.set((idempotency.scope, idempotency.key), response)
+        return response
+
+    async def _idempotent(self, conn, idempotency, fn, args):
+        # если ключ вставила еще не закоммиченная транзакция, INSERT ждет ее завершения. после коммита
+        # ключ занят и отдается ее ответ, после отката ключ достается этому запросу
+        expires_at = await conn.fetchval(
+            SQL_CLAIM_IDEMPOTENCY_KEY, idempotency.scope, idempotency.key, idempotency.request_hash,
+            self.idempotency_ttl
+        )
+        if expires_at is None:
+            return dict(await conn.fetchrow(SQL_GET_IDEMPOTENT_RESPONSE, idempotency.scope, idempotency.key))
+
+        try:
+            # savepoint: ошибка операции откатывает ее изменения, но ключ с ответом-ошибкой сохраняется
+            async with conn.transaction():
+                result = await fn(conn, *args)
+        except tuple(RETRYABLE_ERRORS):
+            raise
+        except ApiException as exc:
+            result = exc
+
+        status, response = idempotency.render(result)
+        await conn.execute(SQL_STORE_IDEMPOTENT_RESPONSE, idempotency.scope, idempotency.key, status, response)
+        return {
+            'request_hash': idempotency.request_hash, 'status': status, 'response': response, 'expires_at': expires_at
+        }
+
+    async def delete_expired_idempotency_keys(self, batch_size=10000):
+        # удаляет истекшие ключи пачками, что бы не держать долгую транзакцию. возвращает сколько удалено
+        deleted = 0
+        while True:
+            async with self._acquire() as conn:
+                result = await conn.execute(
+                    '''DELETE FROM idempotency_keys WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM idempotency_keys WHERE expires_at <= timezone('utc', now()) LIMIT $1
+                    ))''',
+                    batch_size
+                )
+            count = int(result.split()[-1])
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    async def _lock_accounts(self, conn, query, *args):
+        # все блокировки счетов берутся в порядке возрастания id, тогда встречные переводы не дедлочатся
+        started_at = time.perf_counter()
+        rows = await conn.fetch(query, *args)
+        wait = time.perf_counter() - started_at
+        record_span('lock_wait', started_at, wait)
+        self.metrics.lock_wait.observe(wait)
+        self.contention_stats['lock_waits'] += 1
+        self.contention_stats['lock_wait_seconds'] += wait
+        return rows
+
+    async def _accounts_changed(self, conn, account_ids):
+        # вызывается в транзакции, которая меняет счета. NOTIFY доставляется всем процессам
+        # (и этому тоже) только после коммита, локально кэш сбрасываем сразу
+        if not self.cache_enabled:
+            return
+
+        for account_id in account_ids:
+            self.accounts_cache.invalidate(account_id)
+        await conn.execute(
+            SQL_NOTIFY, ACCOUNTS_CHANGED_CHANNEL, ','.join(str(i) for i in account_ids)
+        )
+
+    def _on_accounts_changed(self, payload):
+        for account_id in payload.split(','):
+            self.accounts_cache.invalidate(int(account_id))
+
+    async def _lock_transfer_accounts(self, conn, account_ids):
+        # обычные счета лочим FOR UPDATE по возрастанию id, шардированные не лочим вовсе:
+        # их баланс лежит в account_balance_shards и блокируется по слотам
+        return await self._lock_accounts(conn, SQL_LOCK_TRANSFER_ACCOUNTS, account_ids)
+
+    def _slot_limit(self, slot, shards):
+        # money.max_balance делится между слотами поровну, остаток - первому. сумма лимитов слотов равна
+        # лимиту счета, поэтому пополнение одного слота без блокировки остальных не выводит счет за лимит
+        limit, rest = divmod(self.max_balance, shards)
+        return limit + rest if slot == 0 else limit
+
+    async def _change_shards_balance(self, conn, account_id, delta, shards):
+        # меняет баланс шардированного счета на delta через один свободный слот.
+        # SKIP LOCKED - слоты, занятые другими транзакциями, пропускаются без ожидания
+        if delta > 0:
+            limit, rest = divmod(self.max_balance, shards)
+            slot = await conn.fetchval(
+                '''UPDATE account_balance_shards SET balance = balance + $2
+                WHERE (account_id, slot) = (
+                    SELECT account_id, slot FROM account_balance_shards
+                    WHERE account_id = $1
+                        AND balance + $2::bigint <= $3::bigint + CASE WHEN slot = 0 THEN $4::bigint ELSE 0 END
+                    ORDER BY balance LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING slot''',
+                account_id, delta, limit, rest
+            )
+        else:
+            slot = await conn.fetchval(
+                '''UPDATE account_balance_shards SET balance = balance + $2
+                WHERE (account_id, slot) = (
+                    SELECT account_id, slot FROM account_balance_shards
+                    WHERE account_id = $1 AND balance >= -$2::bigint
+                    ORDER BY balance DESC LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING slot''',
+                account_id, delta
+            )
+
+        if slot is not None:
+            return
+
+        # свободного слота, в который помещается операция, нет: ждем все слоты счета
+        # и раскладываем операцию по нескольким (списание занимает деньги у соседних слотов)
+        slots = await self._lock_accounts(
+            conn,
+            '''SELECT account_id, slot, balance FROM account_balance_shards WHERE account_id = $1
+            ORDER BY slot FOR UPDATE''',
+            account_id
+        )
+        await self._apply_shards_delta(conn, {account_id: delta}, slots)
+
+    def _plan_shards_delta(self, slots, delta):
+        # раскладывает delta по слотам: пополнение - в самые пустые, списание - из самых полных.
+        # slots - список (slot, balance) всех слотов счета, возвращает список (slot, изменение).
+        # лимит счета проверяется и по сумме слотов: слоты, пополненные до появления лимитов слотов, могут быть выше них
+        shards = len(slots)
+        if delta > 0:
+            if sum(balance for _, balance in slots) + delta > self.max_balance:
+                raise AccountBalanceExceededMaximum
+            ordered = sorted(slots, key=lambda s: s[1])
+        else:
+            ordered = sorted(slots, key=lambda s: -s[1])
+
+        plan, rest = [], abs(delta)
+        for slot, balance in ordered:
+            if not rest:
+                break
+            room = self._slot_limit(slot, shards) - balance if delta > 0 else balance
+            part = min(rest, room)
+            if part > 0:
+                plan.append((slot, part if delta > 0 else -part))
+                rest -= part
+
+        if rest:
+            raise AccountNotEnoughtMoney if delta < 0 else AccountBalanceExceededMaximum
+        return plan
+
+    async def _apply_shards_delta(self, conn, deltas, slots):
+        # deltas - {account_id: изменение}, slots - залоченные строки account_balance_shards этих счетов
+        account_slots = {}
+        for row in slots:
+            account_slots.setdefault(row['account_id'], []).append((row['slot'], row['balance']))
+
+        changes = [
+            (account_id, slot, change)
+            for account_id, delta in deltas.items()
+            for slot, change in self._plan_shards_delta(account_slots[account_id], delta)
+        ]
+        await conn.execute(
+            '''UPDATE account_balance_shards AS s SET balance = s.balance + d.delta
+            FROM unnest($1::bigint[], $2::smallint[], $3::bigint[]) AS d(account_id, slot, delta)
+            WHERE s.account_id = d.account_id AND s.slot = d.slot''',
+            *zip(*changes)
+        )
 
     async def create_account(self, email, initial_balance=None):
         if not initial_balance:
-            initial_balance = Decimal(0)
+            initial_balance = 0
+        if initial_balance > self.max_balance:
+            raise AccountBalanceExceededMaximum
 
-        async with self.db_pool.acquire() as conn:
+        async with self._acquire() as conn:
             try:
-                account_row = await conn.fetchrow(
-                    'INSERT INTO accounts(email, balance) VALUES ($1, $2) RETURNING *',
-                    email, initial_balance
-                )
+                async with conn.transaction():
+                    account_row = await conn.fetchrow(
+                        f'INSERT INTO accounts(email, balance) VALUES ($1, $2) RETURNING {ACCOUNT_COLUMNS}',
+                        email, initial_balance
+                    )
+                    # начальный баланс проводится через журнал, как пополнение, иначе сверка его не сойдется
+                    if initial_balance:
+                        await conn.execute(SQL_INSERT_PAYMENT, account_row['id'], initial_balance)
             except asyncpg.exceptions.UniqueViolationError:
                 raise DuplicateAccountEmail from None
 
         return dict(account_row)
 
+    async def import_accounts(self, records):
+        # records - [(номер строки, email, начальный баланс)]. возвращает {номер строки: id} для созданных счетов,
+        # строки с email, который уже есть в базе или выше в records, не создаются
+        return await self._run_in_transaction(self._import_accounts, records)
+
+    async def _import_accounts(self, conn, records):
+        # временная таблица живет, пока живет соединение пула, строки из нее удаляются при коммите
+        await conn.execute(
+            '''CREATE TEMP TABLE IF NOT EXISTS accounts_import (
+                line BIGINT NOT NULL, email TEXT NOT NULL, balance BIGINT NOT NULL
+            ) ON COMMIT DELETE ROWS'''
+        )
+        await conn.copy_records_to_table('accounts_import', records=records, columns=['line', 'email', 'balance'])
+        # вставка по порядку email: параллельные импорты с общими email ждут друг друга, а не дедлочатся.
+        # начальный баланс проводится через журнал, как в create_account
+        rows = await conn.fetch(
+            '''WITH staged AS (
+                SELECT DISTINCT ON (email) line, email, balance FROM accounts_import ORDER BY email, line
+            ), created AS (
+                INSERT INTO accounts(email, balance)
+                SELECT email, balance FROM staged ORDER BY email
+                ON CONFLICT (email) DO NOTHING
+                RETURNING id, email, balance
+            ), payments AS (
+                INSERT INTO transactions(target_account_id, amount)
+                SELECT id, balance FROM created WHERE balance > 0
+            )
+            SELECT staged.line, created.id FROM staged JOIN created USING (email)'''
+        )
+        return {row['line']: row['id'] for row in rows}
+
     async def drop_account(self, account_id):
         # используется только для фабрики акаунтов в тестах
-        async with self.db_pool.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.transaction():
+                await self._accounts_changed(conn, [account_id])
                 await conn.execute(
                     'DELETE FROM transactions WHERE source_account_id = $1 OR target_account_id = $1', account_id
                 )
@@ -49,87 +719,585 @@ class DBHandler:
                     'DELETE FROM accounts WHERE id = $1', account_id
                 )
 
-    async def get_account(self, account_id):
-        async with self.db_pool.acquire() as conn:
-            account_data = await conn.fetchrow('SELECT * FROM accounts WHERE id = $1', account_id)
-            if not account_data:
-                raise AccountNotFound
+    async def get_account(self, account_id, min_lsn=None):
+        if self.cache_enabled:
+            # с токеном клиента кэш не читается: инвалидация из другого процесса могла еще не дойти,
+            # и клиент не увидел бы свою запись
+            if min_lsn is None:
+                account_data = self.accounts_cache.get(account_id)
+                if account_data is not MISSING:
+                    return account_data
+            generation = self.accounts_cache.generation
+
+        account_data, from_replica = await self._read(self._get_account, account_id, min_lsn=min_lsn)
+
+        # реплика может отставать от уже полученной инвалидации, ее ответ в кэше остался бы устаревшим навсегда
+        if self.cache_enabled and not from_replica:
+            self.accounts_cache.set(account_id, account_data, generation)
+        return account_data
+
+    async def _get_account(self, conn, account_id):
+        # баланс шардированного счета - сумма его слотов
+        account_data = await conn.fetchrow(SQL_GET_ACCOUNT, account_id)
+        if not account_data:
+            raise AccountNotFound
         return dict(account_data)
 
-    async def create_account_payment(self, account_id, amount):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    account_row = await conn.fetchrow(
-                        'UPDATE accounts SET balance = balance + $1 WHERE id = $2 RETURNING *',
-                        amount, account_id
-                    )
-                except asyncpg.exceptions.NumericValueOutOfRangeError:
-                    raise AccountBalanceExceededMaximum from None
+    async def enable_balance_sharding(self, account_id, shards):
+        # переводит счет в режим шардированного баланса: баланс раскладывается по shards слотам, дальше
+        # пополнения и списания расходятся по ним. количество слотов можно только увеличить
+        return await self._run_in_transaction(self._enable_balance_sharding, account_id, shards)
 
-                if not account_row:
-                    raise AccountNotFound
+    async def _enable_balance_sharding(self, conn, account_id, shards):
+        account = await conn.fetchrow('SELECT balance, shards FROM accounts WHERE id = $1 FOR UPDATE', account_id)
+        if not account:
+            raise AccountNotFound
 
-                await conn.execute(
-                    'INSERT INTO transactions(target_account_id, amount) VALUES ($1, $2)',
-                    account_id, amount
-                )
-        return dict(account_row)
+        if shards > account['shards']:
+            await self._accounts_changed(conn, [account_id])
+            # при увеличении числа слотов лимиты слотов уменьшаются, поэтому весь баланс (и счета, и старых
+            # слотов) раскладывается заново поровну, остаток от деления - в первый слот: так каждый слот
+            # в пределах своего лимита, см. _slot_limit
+            old_slots = await self._lock_accounts(
+                conn, 'DELETE FROM account_balance_shards WHERE account_id = $1 RETURNING balance', account_id
+            )
+            balance = account['balance'] + sum(row['balance'] for row in old_slots)
+            part, rest = divmod(balance, shards)
+            await conn.execute(
+                '''INSERT INTO account_balance_shards(account_id, slot, balance)
+                SELECT $1, slot, CASE WHEN slot = 0 THEN $2::bigint + $4::bigint ELSE $2 END
+                FROM generate_series(0, $3 - 1) AS slot''',
+                account_id, part, shards, rest
+            )
+            await conn.execute('UPDATE accounts SET balance = 0, shards = $2 WHERE id = $1', account_id, shards)
+
+        return await self._get_account(conn, account_id)
 
-    async def create_transaction(self, source_account_id, target_account_id, amount):
-        async with self.db_pool.acquire() as conn:
+    async def create_account_payment(self, account_id, amount, idempotency=None):
+        # с idempotency возвращает сохраненный ответ, см. _run_idempotent
+        if idempotency is not None:
+            return await self._run_idempotent(
+                idempotency, self._create_account_payment, account_id, amount, lock_ids=(account_id,)
+            )
+        return await self._run_write(self._create_account_payment, account_id, amount, lock_ids=(account_id,))
+
+    async def _create_account_payment(self, conn, account_id, amount):
+        await self._accounts_changed(conn, [account_id])
+
+        # лочится одна строка, UPDATE сам берет блокировку
+        account_row = await self._lock_accounts(conn, SQL_CREDIT_PAYMENT, amount, account_id, self.max_balance)
+
+        if account_row:
+            account_row = dict(account_row[0])
+        else:
+            # либо счета нет, либо пополнение не влезает в лимит, либо счет шардированный
+            shards = await conn.fetchval('SELECT shards FROM accounts WHERE id = $1', account_id)
+            if shards is None:
+                raise AccountNotFound
+            if not shards or amount > self.max_balance:
+                raise AccountBalanceExceededMaximum
+
+            await self._change_shards_balance(conn, account_id, amount, shards)
+            account_row = await self._get_account(conn, account_id)
+
+        await conn.execute(SQL_INSERT_PAYMENT, account_id, amount)
+        return account_row
+
+    async def create_transaction(self, source_account_id, target_account_id, amount, idempotency=None):
+        if idempotency is not None:
+            return await self._run_idempotent(
+                idempotency, self._execute_transfer, source_account_id, target_account_id, amount,
+                lock_ids=(source_account_id, target_account_id)
+            )
+        if self.transfer_function and self.group_committer is None:
+            return await self._run_in_transaction(
+                self._transfer, source_account_id, target_account_id, amount, implicit=True
+            )
+        return await self._run_write(
+            self._execute_transfer, source_account_id, target_account_id, amount,
+            lock_ids=(source_account_id, target_account_id)
+        )
+
+    async def _transfer(self, conn, source_account_id, target_account_id, amount, transaction_id=None):
+        # то же, что _create_transaction, но одним запросом: счета лочатся только на время его выполнения
+        if self.cache_enabled:
+            self.accounts_cache.invalidate(source_account_id)
+            self.accounts_cache.invalidate(target_account_id)
+
+        row = await conn.fetchrow(
+            SQL_TRANSFER, source_account_id, target_account_id, amount, transaction_id, self.max_balance,
+            ACCOUNTS_CHANGED_CHANNEL if self.cache_enabled else None
+        )
+        transaction_row = dict(row)
+        status = transaction_row.pop('status')
+
+        if status == 'ok':
+            return transaction_row
+        if status == 'sharded':
+            # баланс шардированного счета раскладывается по слотам, это делает только обычный путь
+            if conn.is_in_transaction():
+                return await self._create_transaction(
+                    conn, source_account_id, target_account_id, amount, transaction_id=transaction_id
+                )
             async with conn.transaction():
-                # ORDER BY нам важен, что бы правильно смапить результаты из базы на переменные
-                accounts = await conn.fetch(
-                    'SELECT * FROM accounts WHERE id = ANY($1) ORDER BY CASE WHEN id = $2 THEN 1 ELSE 2 END FOR UPDATE',
-                    (source_account_id, target_account_id), source_account_id
+                return await self._create_transaction(
+                    conn, source_account_id, target_account_id, amount, transaction_id=transaction_id
                 )
+        raise TRANSFER_ERRORS[status]()
+
+    async def _optimistic_transfer(self, conn, source_account_id, target_account_id, amount, transaction_id=None):
+        # то же, что _create_transaction, но без блокировки счетов на чтении. строка лочится только условным
+        # UPDATE, и если ее успели поменять после чтения, UPDATE ничего не находит: перевод повторяется целиком
+        # через OptimisticLockConflict, как после дедлока, с той же задержкой и тем же числом попыток
+        accounts = await conn.fetch(SQL_GET_TRANSFER_ACCOUNTS, [source_account_id, target_account_id])
+        accounts = {a['id']: a for a in accounts}
 
-                if len(accounts) < 2:
-                    # если пришло меньше 2 строк, то значит что либо один, либо оба аккаунта не существуют.
-                    # определяем какой именно не существует и сохраняем это в Exception
-                    exists_account_ids = [a['id'] for a in accounts]
-                    _map = {'source_account_id': source_account_id, 'target_account_id': target_account_id}
-                    exc_extra_info = [k for k, v in _map.items() if v not in exists_account_ids]
-                    raise AccountNotFound(extra_info=exc_extra_info)
+        if len(accounts) < 2:
+            _map = {'source_account_id': source_account_id, 'target_account_id': target_account_id}
+            raise AccountNotFound(extra_info=[k for k, v in _map.items() if v not in accounts])
 
-                source_account, target_account = accounts
+        source_account, target_account = accounts[source_account_id], accounts[target_account_id]
+        if source_account['shards'] or target_account['shards']:
+            # баланс шардированного счета раскладывается по слотам, это делает только обычный путь
+            return await self._create_transaction(
+                conn, source_account_id, target_account_id, amount, transaction_id=transaction_id
+            )
 
-                if source_account['balance'] < amount:
-                    raise AccountNotEnoughtMoney
+        if source_account['balance'] < amount:
+            raise AccountNotEnoughtMoney
+        if amount > self.max_balance or target_account['balance'] + amount > self.max_balance:
+            raise AccountBalanceExceededMaximum
 
-                try:
-                    transaction_row = await conn.fetchrow(
-                        '''INSERT INTO transactions(source_account_id, target_account_id, amount) VALUES ($1, $2, $3)
-                        RETURNING *''',
-                        source_account_id, target_account_id, amount
-                    )
+        await self._accounts_changed(conn, [source_account_id, target_account_id])
+        # строки меняются по возрастанию id, как и лочатся в остальных транзакциях
+        for account_id, delta in sorted([(source_account_id, -amount), (target_account_id, amount)]):
+            result = await conn.execute(SQL_APPLY_VERSIONED_DELTA, delta, account_id, accounts[account_id]['version'])
+            if result == 'UPDATE 0':
+                raise OptimisticLockConflict
 
-                    await conn.execute(
-                        'UPDATE accounts SET balance = balance + $1 WHERE id = $2', amount, target_account_id
-                    )
-                except asyncpg.exceptions.NumericValueOutOfRangeError:
-                    raise AccountBalanceExceededMaximum from None
+        transaction_row = await conn.fetchrow(
+            SQL_INSERT_TRANSFER, source_account_id, target_account_id, amount, transaction_id
+        )
+        return dict(transaction_row)
 
-                await conn.execute(
-                        'UPDATE accounts SET balance = balance - $1 WHERE id = $2', amount, source_account_id
-                    )
+    async def _create_transaction(self, conn, source_account_id, target_account_id, amount, transaction_id=None):
+        # transaction_id задается, когда проводится перевод из очереди и id уже выдан клиенту
+        accounts = await self._lock_transfer_accounts(conn, (source_account_id, target_account_id))
+        accounts = {a['id']: a for a in accounts}
+
+        if len(accounts) < 2:
+            # если пришло меньше 2 строк, то значит что либо один, либо оба аккаунта не существуют.
+            # определяем какой именно не существует и сохраняем это в Exception
+            _map = {'source_account_id': source_account_id, 'target_account_id': target_account_id}
+            exc_extra_info = [k for k, v in _map.items() if v not in accounts]
+            raise AccountNotFound(extra_info=exc_extra_info)
+
+        source_account, target_account = accounts[source_account_id], accounts[target_account_id]
+        await self._accounts_changed(conn, [source_account_id, target_account_id])
+
+        if source_account['shards']:
+            await self._change_shards_balance(conn, source_account_id, -amount, source_account['shards'])
+        elif source_account['balance'] < amount:
+            raise AccountNotEnoughtMoney
+
+        # лимит шардированного счета проверяется в _change_shards_balance, через лимиты слотов
+        if amount > self.max_balance or (
+            not target_account['shards'] and target_account['balance'] + amount > self.max_balance
+        ):
+            raise AccountBalanceExceededMaximum
+
+        transaction_row = await conn.fetchrow(
+            SQL_INSERT_TRANSFER, source_account_id, target_account_id, amount, transaction_id
+        )
+
+        if target_account['shards']:
+            await self._change_shards_balance(conn, target_account_id, amount, target_account['shards'])
+        else:
+            await conn.execute(SQL_CREDIT_ACCOUNT, amount, target_account_id)
+
+        if not source_account['shards']:
+            await conn.execute(SQL_DEBIT_ACCOUNT, amount, source_account_id)
 
         return dict(transaction_row)
 
-    async def get_transaction(self, transaction_id):
-        async with self.db_pool.acquire() as conn:
-            transaction_data = await conn.fetchrow('SELECT * FROM transactions WHERE id = $1', transaction_id)
-            if not transaction_data:
-                raise TransactionNotFound
-        return dict(transaction_data)
+    async def create_transactions_batch(self, transfers):
+        # transfers - список (source_account_id, target_account_id, amount).
+        # возвращает список той же длины: dict транзакции или ApiException, если перевод не прошел.
+        # неуспешный перевод не откатывает остальные, все успешные проводятся одной транзакцией в базе
+        return await self._run_in_transaction(self._create_transactions_batch, transfers)
+
+    async def _create_transactions_batch(self, conn, transfers):
+        account_ids = sorted({account_id for transfer in transfers for account_id in transfer[:2]})
+
+        accounts = await self._lock_transfer_accounts(conn, account_ids)
+        balances = {a['id']: a['balance'] for a in accounts}
+
+        # у шардированных счетов лочим все слоты разом, баланс - их сумма
+        sharded_ids = [a['id'] for a in accounts if a['shards']]
+        slots = []
+        if sharded_ids:
+            slots = await self._lock_accounts(
+                conn,
+                '''SELECT account_id, slot, balance FROM account_balance_shards WHERE account_id = ANY($1)
+                ORDER BY account_id, slot FOR UPDATE''',
+                sharded_ids
+            )
+            for row in slots:
+                balances[row['account_id']] += row['balance']
+
+        deltas = dict.fromkeys(balances, 0)
+
+        # проводим переводы последовательно в памяти, проверки те же что и в create_transaction
+        results, accepted = [], []
+        for source_account_id, target_account_id, amount in transfers:
+            _map = {'source_account_id': source_account_id, 'target_account_id': target_account_id}
+            not_found = [k for k, v in _map.items() if v not in balances]
+
+            if not_found:
+                results.append(AccountNotFound(extra_info=not_found))
+            elif balances[source_account_id] < amount:
+                results.append(AccountNotEnoughtMoney())
+            elif amount > self.max_balance or balances[target_account_id] + amount > self.max_balance:
+                results.append(AccountBalanceExceededMaximum())
+            else:
+                balances[source_account_id] -= amount
+                balances[target_account_id] += amount
+                deltas[source_account_id] -= amount
+                deltas[target_account_id] += amount
+                accepted.append((len(results), source_account_id, target_account_id, amount))
+                results.append(None)
+
+        if not accepted:
+            return results
+
+        await self._accounts_changed(conn, [k for k, v in deltas.items() if v])
+
+        # id выдаются из sequence в порядке вставки, поэтому сортировка по id восстанавливает порядок
+        positions, source_ids, target_ids, amounts = zip(*accepted)
+        transaction_rows = await conn.fetch(
+            '''INSERT INTO transactions(source_account_id, target_account_id, amount)
+            SELECT source_account_id, target_account_id, amount
+            FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                WITH ORDINALITY AS t(source_account_id, target_account_id, amount, n)
+            ORDER BY n
+            RETURNING *''',
+            source_ids, target_ids, amounts
+        )
+        for position, transaction_row in zip(positions, sorted(transaction_rows, key=lambda r: r['id'])):
+            results[position] = dict(transaction_row)
+
+        changed = [(k, v) for k, v in deltas.items() if v and k not in sharded_ids]
+        if changed:
+            await conn.execute(
+                '''UPDATE accounts AS a SET balance = a.balance + d.delta
+                FROM unnest($1::bigint[], $2::bigint[]) AS d(id, delta)
+                WHERE a.id = d.id''',
+                *zip(*changed)
+            )
+
+        sharded_deltas = {k: v for k, v in deltas.items() if v and k in sharded_ids}
+        if sharded_deltas:
+            await self._apply_shards_delta(conn, sharded_deltas, slots)
+
+        return results
+
+    async def get_account_transactions(
+        self, account_id, direction=TransactionDirection.ALL, limit=HISTORY_PAGE_SIZE, cursor=None,
+        min_amount=None, max_amount=None, since=None, until=None, min_lsn=None
+    ):
+        # страница истории счета от новых к старым по (ctime, id) и курсор следующей страницы.
+        # keyset пагинация: следующая страница начинается строго после последней строки текущей,
+        # поэтому каждая страница - один проход по индексу (счет, ctime, id) на limit строк, сколько бы
+        # транзакций ни было у счета и в таблице
+        args = [account_id, limit + 1]
+
+        def _param(value):
+            args.append(value)
+            return f'${len(args)}'
+
+        conditions = []
+        if cursor is not None:
+            conditions.append('(ctime, id) < ({}, {})'.format(*map(_param, cursor)))
+        if min_amount is not None:
+            conditions.append(f'amount >= {_param(min_amount)}')
+        if max_amount is not None:
+            conditions.append(f'amount <= {_param(max_amount)}')
+        if since is not None:
+            conditions.append(f'ctime >= {_param(since)}')
+        if until is not None:
+            conditions.append(f'ctime < {_param(until)}')
+        filters = ''.join(f' AND {condition}' for condition in conditions)
+
+        # входящие и исходящие лежат в разных индексах, каждая ветка отдает не больше limit + 1 строк
+        columns = {TransactionDirection.OUT: 'source_account_id', TransactionDirection.IN: 'target_account_id'}
+        if direction != TransactionDirection.ALL:
+            columns = {direction: columns[direction]}
+        query = ' UNION ALL '.join(
+            f'''(SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE {column} = $1{filters}
+            ORDER BY ctime DESC, id DESC LIMIT $2)'''
+            for column in columns.values()
+        )
+        if len(columns) > 1:
+            query += ' ORDER BY ctime DESC, id DESC LIMIT $2'
+
+        async def _fetch(conn):
+            rows = await conn.fetch(query, *args)
+            if not rows and not await conn.fetchval('SELECT 1 FROM accounts WHERE id = $1', account_id):
+                raise AccountNotFound
+            return rows
+
+        rows, _ = await self._read(_fetch, min_lsn=min_lsn)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['ctime'], rows[-1]['id'])
+        return [dict(row) for row in rows], next_cursor
+
+    async def get_balance_at(self, account_id, at, min_lsn=None):
+        balance, _ = await self._read(self._get_balance_at, account_id, at, min_lsn=min_lsn)
+        return balance
+
+    async def _get_balance_at(self, conn, account_id, at):
+        balance = (await self._get_balances_at(conn, [account_id], at))[account_id]
+        if isinstance(balance, ApiException):
+            raise balance
+        return balance
+
+    async def get_balances_at(self, account_ids, at, min_lsn=None):
+        # выписки на конец дня: {id: баланс или ошибка} для многих счетов одним запросом
+        async with self._acquire_read(min_lsn) as (conn, _):
+            return await self._get_balances_at(conn, account_ids, at)
+
+    async def _get_balances_at(self, conn, account_ids, at):
+        # баланс на момент at - сумма проводок счета с ctime < at, см. BalanceSnapshotter.
+        # архивные суммы есть только за период целиком: если строки между снимком и at частично в архиве,
+        # баланс не посчитать, и счет получает BalanceHistoryArchived
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            archived = await conn.fetch('SELECT period_start, period_end FROM transactions_archives')
+            rows = await conn.fetch(SQL_GET_BALANCES_AT, account_ids, at)
+
+        balances = {account_id: AccountNotFound(['id']) for account_id in account_ids}
+        for row in rows:
+            since = row['snapshot_at'] or datetime.min
+            if since < at and any(
+                (period_start or datetime.min) < at and period_end > since
+                and not ((period_start or datetime.min) >= since and period_end <= at)
+                for period_start, period_end in archived
+            ):
+                balances[row['account_id']] = BalanceHistoryArchived(['at'])
+            else:
+                balances[row['account_id']] = row['balance']
+        return balances
+
+    async def export_transactions(
+        self, on_chunk, chunk_size, after_id=None, account_id=None, since=None, until=None, with_accounts=False,
+        min_lsn=None
+    ):
+        # читает транзакции по возрастанию id через серверный курсор по chunk_size строк и отдает каждую
+        # пачку в on_chunk. следующая пачка читается только после того, как on_chunk ее обработал, поэтому
+        # в памяти одновременно не больше одной пачки, сколько бы строк ни выгружалось.
+        # after_id - id последней полученной транзакции, с него выгрузка продолжается после обрыва
+        args, conditions = [], []
+
+        def _param(value):
+            args.append(value)
+            return f'${len(args)}'
+
+        if after_id is not None:
+            conditions.append(f't.id > {_param(after_id)}')
+        if account_id is not None:
+            account_param = _param(account_id)
+            conditions.append(f'(t.source_account_id = {account_param} OR t.target_account_id = {account_param})')
+        if since is not None:
+            conditions.append(f't.ctime >= {_param(since)}')
+        if until is not None:
+            conditions.append(f't.ctime < {_param(until)}')
+
+        columns = ', '.join(f't.{column}' for column in EXPORT_COLUMNS)
+        query = f'SELECT {columns} FROM transactions t'
+        if with_accounts:
+            query = f'''SELECT {columns}, s.email AS source_email, r.email AS target_email FROM transactions t
+            LEFT JOIN accounts s ON s.id = t.source_account_id
+            JOIN accounts r ON r.id = t.target_account_id'''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY t.id'
+
+        # курсор живет только внутри транзакции, repeatable read - вся выгрузка из одного снимка базы.
+        # долгая выгрузка с реплики может быть прервана, если реплике надо проиграть конфликтующий WAL
+        # (max_standby_streaming_delay)
+        async with self._acquire_read(min_lsn) as (conn, _):
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                cursor = await conn.cursor(query, *args)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    await on_chunk(rows)
+
+    async def enqueue_transaction(self, source_account_id, target_account_id, amount, idempotency=None):
+        # ставит перевод в очередь, его проведут фоновые воркеры. id выдается из той же sequence,
+        # что и у транзакций, и после проведения становится id транзакции
+        if idempotency is not None:
+            return await self._run_idempotent(
+                idempotency, self._enqueue_transaction, source_account_id, target_account_id, amount
+            )
+        async with self._acquire() as conn:
+            return await self._enqueue_transaction(conn, source_account_id, target_account_id, amount)
+
+    async def _enqueue_transaction(self, conn, source_account_id, target_account_id, amount):
+        # сумма больше лимита не пройдет ни на какой счет, такой перевод в очередь не ставится
+        if amount > self.max_balance:
+            raise AccountBalanceExceededMaximum
+
+        request_row = await conn.fetchrow(SQL_ENQUEUE_TRANSFER, source_account_id, target_account_id, amount)
+        return dict(request_row)
+
+    async def process_transfer_request(self, describe_error):
+        # проводит один перевод из очереди, возвращает False если очередь пуста.
+        # describe_error превращает ошибку перевода в то, что увидит клиент в статусе
+        return await self._run_in_transaction(self._process_transfer_request, describe_error)
+
+    async def _process_transfer_request(self, conn, describe_error):
+        # запрос остается залоченным до конца транзакции: если процесс упадет, транзакция откатится
+        # и запрос снова окажется в очереди
+        request = await conn.fetchrow(
+            '''SELECT * FROM transfer_requests WHERE status = 'pending'
+            ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED'''
+        )
+        if not request:
+            return False
+
+        try:
+            # savepoint, что бы неуспешный перевод откатился, а статус запроса сохранился
+            async with conn.transaction():
+                await self._execute_transfer(
+                    conn, request['source_account_id'], request['target_account_id'], request['amount'],
+                    transaction_id=request['id']
+                )
+        except tuple(RETRYABLE_ERRORS) + REPLICA_ERRORS:
+            # ретраи и обрыв соединения с базой (те же ошибки, что и у реплик): транзакция откатывается,
+            # запрос остается pending и проводится заново
+            raise
+        except ApiException as exc:
+            status, error = TransferStatus.FAILED, describe_error(exc)
+        except Exception:
+            logger.exception('Transfer request {} failed: ', request['id'])
+            status, error = TransferStatus.FAILED, ServiceErrors.SERVER_ERROR
+        else:
+            # проведенный перевод уже лежит в transactions с тем же id, запрос больше не нужен
+            await conn.execute('DELETE FROM transfer_requests WHERE id = $1', request['id'])
+            return True
+
+        await conn.execute(
+            '''UPDATE transfer_requests SET status = $2, error = $3, mtime = timezone('utc', now())
+            WHERE id = $1''',
+            request['id'], status, error and json.dumps(error)
+        )
+        return True
+
+    async def get_transaction(self, transaction_id, min_lsn=None):
+        if self.cache_enabled:
+            transaction_data = self.transactions_cache.get(transaction_id)
+            if transaction_data is not MISSING:
+                return transaction_data
+
+        (transaction_data, archive_paths), _ = await self._read(
+            self._get_transaction, transaction_id, min_lsn=min_lsn
+        )
+        if transaction_data:
+            transaction_data = dict(transaction_data)
+            error = transaction_data.pop('error')
+            if error:
+                transaction_data['error'] = json.loads(error)
+        else:
+            transaction_data = await self._get_archived_transaction(
+                transaction_id, [row['path'] for row in archive_paths]
+            )
+
+        # у проведенного или отклоненного перевода статус уже не поменяется
+        if self.cache_enabled and transaction_data['status'] != TransferStatus.PENDING:
+            self.transactions_cache.set(transaction_id, transaction_data)
+        return transaction_data
+
+    async def _get_transaction(self, conn, transaction_id):
+        # проведенные переводы лежат в transactions, еще не проведенные и неуспешные - в transfer_requests,
+        # транзакции из отключенных старых партиций - в архивных файлах. возвращает (строку, пути архивов)
+        transaction_data = await conn.fetchrow(SQL_GET_TRANSACTION, transaction_id)
+        if transaction_data:
+            return transaction_data, None
+
+        archive_paths = await conn.fetch(
+            '''SELECT path FROM transactions_archives WHERE $1 BETWEEN min_id AND max_id
+            ORDER BY period_end DESC''',
+            transaction_id
+        )
+        if not archive_paths:
+            raise TransactionNotFound
+        return None, archive_paths
+
+    async def _get_archived_transaction(self, transaction_id, paths):
+        loop = asyncio.get_event_loop()
+        for path in paths:
+            transaction_data = await loop.run_in_executor(
+                self.archive_executor, read_archived_transaction, path, transaction_id
+            )
+            if transaction_data:
+                return dict(transaction_data, status=TransferStatus.COMPLETED)
+        raise TransactionNotFound
+
+    async def get_account_archive_summaries(self, account_id, since=None, until=None):
+        # суммы по счету за архивные периоды, вместо строк истории из отключенных партиций
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                '''SELECT period_start, period_end, credit_total, debit_total, transactions_count
+                FROM transactions_archive_summary
+                WHERE account_id = $1 AND ($2::timestamp IS NULL OR period_end > $2)
+                    AND ($3::timestamp IS NULL OR period_start IS NULL OR period_start < $3)
+                ORDER BY period_end DESC''',
+                account_id, since, until
+            )
+        return [dict(row) for row in rows]
+
+
+def create_storage(config):
+    # storage.backend в config.yml: postgres (DBHandler) или memory (MemoryStorage)
+    backend = config.get('storage', {}).get('backend', StorageBackend.POSTGRES)
+    if backend == StorageBackend.POSTGRES:
+        return DBHandler(config)
+    if backend == StorageBackend.MEMORY:
+        return MemoryStorage(config)
+    raise ValueError(f'unknown storage backend {backend!r}')
 
 
 class AppHandlers:
     # в этом классе собраны хэндлеры для апи (эндпоинты).
 
-    def __init__(self, config):
-        self.db_handler = DBHandler(config)
+    def __init__(self, config, storage=None):
+        self.compiled_validation = config.get('validation', {}).get('compiled', True)
+        # storage - уже запущенное хранилище, его закрывает тот, кто передал (тесты).
+        # история, выгрузка, импорт, балансы на момент и очередь переводов есть только у postgres
+        self.db_handler = storage if storage is not None else create_storage(config)
+        self.owns_storage = storage is None
+        self.postgres = self.db_handler.backend == StorageBackend.POSTGRES
+        self.transfer_modes = (TransferMode.SYNC, TransferMode.ASYNC) if self.postgres else (TransferMode.SYNC,)
+        self.metrics = self.db_handler.metrics
+        self.transfer_workers = TransferWorkerPool(self.db_handler, config, describe_error=self.transaction_error)
+        self.partition_maintainer = PartitionMaintainer(self.db_handler, config)
+        self.idempotency_cleaner = IdempotencyKeysCleaner(self.db_handler, config)
+        self.balance_snapshotter = BalanceSnapshotter(self.db_handler, config)
+        self.account_importer = AccountImporter(self.db_handler, config)
+        self.admission = AdmissionController(config)
+        self.metrics.add_collector(self.admission.collect_metrics)
+        self.tracer = Tracer(config)
+        self.profiler = SamplingProfiler(config)
+
+        export_conf = config.get('export', {})
+        self.export_chunk_size = export_conf.get('chunk_size', 1000)
+        # каждая выгрузка держит соединение из пула все время, пока идет
+        self.export_max_concurrent = export_conf.get('max_concurrent', 2)
+        self.active_exports = 0
 
     @staticmethod
     def success_response(data, status=200):
@@ -145,6 +1313,73 @@ class AppHandlers:
             status=status, dumps=custom_json_dumps
         )
 
+    @staticmethod
+    def text_response(text, status=200):
+        # готовый json, например сохраненный ответ на запрос с Idempotency-Key
+        return web.Response(text=text, status=status, content_type='application/json')
+
+    @staticmethod
+    def payment_result(result):
+        # (http статус, тело ответа) пополнения: result - счет или ошибка
+        if isinstance(result, AccountNotFound):
+            status, error = 404, {'account_id': ValidationErrors.NOT_FOUND}
+        elif isinstance(result, AccountBalanceExceededMaximum):
+            status, error = 422, {'amount': ValidationErrors.TOO_BIG}
+        elif isinstance(result, ApiException):
+            raise result
+        else:
+            return 200, custom_json_dumps({'success': True, 'data': format_money(result, 'balance')})
+        return status, custom_json_dumps({'success': False, 'error': error})
+
+    @classmethod
+    def transaction_result(cls, result, success_status=200):
+        # (http статус, тело ответа) перевода: result - транзакция (запрос в очереди) или ошибка
+        if isinstance(result, ApiException):
+            return 422, custom_json_dumps({'success': False, 'error': cls.transaction_error(result)})
+        return success_status, custom_json_dumps({'success': True, 'data': format_money(result, 'amount')})
+
+    def idempotency(self, request, scope, data, render):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return None
+        # один и тот же ключ с другим запросом - ошибка клиента, ее видно по хэшу запроса
+        request_hash = hashlib.sha256(custom_json_dumps([request.path, data], sort_keys=True).encode()).hexdigest()
+        return Idempotency(scope, key, request_hash, render)
+
+    @staticmethod
+    def consistency_token(request):
+        # min_lsn для чтений с реплик. токен, который не удалось разобрать, не догонит ни одна реплика,
+        # и такой запрос читает с основной базы
+        token = request.headers.get(CONSISTENCY_TOKEN_HEADER)
+        if token is None:
+            return None
+        try:
+            return parse_lsn(token)
+        except ValueError:
+            return MAX_LSN
+
+    async def idempotent_response(self, idempotency, operation, *args):
+        # повтор отдается из кэша или таблицы ключей без транзакции над счетами.
+        # первый запрос (и параллельные ему дубли) идет в operation, см. DBHandler._run_idempotent
+        response = await self.db_handler.get_idempotent_response(idempotency.scope, idempotency.key)
+        if response is None:
+            response = await operation(*args, idempotency=idempotency)
+
+        if response['request_hash'] != idempotency.request_hash:
+            return self.error_response({'Idempotency-Key': ValidationErrors.IDEMPOTENCY_KEY_REUSED})
+        return self.text_response(response['response'], status=response['status'])
+
+    @staticmethod
+    def transaction_error(exc):
+        # ошибки проведения перевода в формате ответа апи
+        if isinstance(exc, AccountNotFound):
+            return {field_name: ValidationErrors.NOT_FOUND for field_name in exc.extra_info}
+        if isinstance(exc, AccountNotEnoughtMoney):
+            return {'source_account_id': ValidationErrors.NOT_ENOUGHT_MONEY}
+        if isinstance(exc, AccountBalanceExceededMaximum):
+            return {'amount': ValidationErrors.TOO_BIG}
+        raise exc
+
     @validate(CREATE_ACCOUNT)
     async def create_account(self, request, data):
         try:
@@ -154,15 +1389,164 @@ class AppHandlers:
         except DuplicateAccountEmail:
             return self.error_response({'email': ValidationErrors.NOT_UNIQUE})
 
-        return self.success_response(account_data)
+        return self.success_response(format_money(account_data, 'balance'))
+
+    async def import_accounts(self, request):
+        # тело запроса - NDJSON или CSV файл, читается потоком, не через @validate
+        import_format = request.query.get('format', ExportFormat.NDJSON)
+        if import_format not in (ExportFormat.NDJSON, ExportFormat.CSV):
+            return self.error_response({'format': ValidationErrors.NOT_ALLOWED})
+
+        # результаты копятся во временном файле и отдаются, когда тело прочитано целиком. если отвечать
+        # во время загрузки, клиент, который читает ответ только после отправки, повиснет вместе с сервером
+        with tempfile.TemporaryFile() as results_file:
+            async def _write_results(results):
+                results_file.write(''.join(custom_json_dumps(result) + '\n' for result in results).encode())
+
+            summary = await self.account_importer.run(request.content, import_format, _write_results)
+            results_file.write((custom_json_dumps({'summary': summary}) + '\n').encode())
+            results_file.seek(0)
+
+            response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            while True:
+                block = results_file.read(IMPORT_RESULTS_BLOCK_SIZE)
+                if not block:
+                    break
+                await response.write(block)
+            await response.write_eof()
+
+        return response
 
     @validate(GET_OBJECT_BY_ID)
     async def get_account(self, request, data):
         try:
-            return self.success_response(await self.db_handler.get_account(data['id']))
+            account_data = await self.db_handler.get_account(data['id'], min_lsn=self.consistency_token(request))
+            return self.success_response(format_money(account_data, 'balance'))
+        except AccountNotFound:
+            return self.error_response({'id': ValidationErrors.NOT_FOUND}, status=404)
+
+    @staticmethod
+    def balance_error(exc):
+        if isinstance(exc, AccountNotFound):
+            return 404, {'id': ValidationErrors.NOT_FOUND}
+        return 422, {'at': ValidationErrors.HISTORY_ARCHIVED}
+
+    @validate(ACCOUNT_BALANCE)
+    async def get_account_balance(self, request, data):
+        try:
+            balance = await self.db_handler.get_balance_at(
+                data['id'], data['at'], min_lsn=self.consistency_token(request)
+            )
+        except (AccountNotFound, BalanceHistoryArchived) as exc:
+            status, error = self.balance_error(exc)
+            return self.error_response(error, status=status)
+        return self.success_response({
+            'account_id': data['id'], 'at': data['at'], 'balance': format_minor_units(balance)
+        })
+
+    @validate(ACCOUNTS_BALANCES)
+    async def get_accounts_balances(self, request, data):
+        # балансы многих счетов на один момент, результат по каждому счету в том же порядке, что и account_ids
+        balances = await self.db_handler.get_balances_at(
+            list(set(data['account_ids'])), data['at'], min_lsn=self.consistency_token(request)
+        )
+        results = []
+        for account_id in data['account_ids']:
+            balance = balances[account_id]
+            if isinstance(balance, ApiException):
+                results.append({'success': False, 'error': self.balance_error(balance)[1]})
+            else:
+                results.append({'success': True, 'data': {
+                    'account_id': account_id, 'at': data['at'], 'balance': format_minor_units(balance)
+                }})
+        return self.success_response(results)
+
+    @validate(ACCOUNT_TRANSACTIONS)
+    async def get_account_transactions(self, request, data):
+        try:
+            transactions, next_cursor = await self.db_handler.get_account_transactions(
+                data['id'],
+                direction=data.get('direction', TransactionDirection.ALL),
+                limit=data.get('limit', HISTORY_PAGE_SIZE),
+                cursor=decode_cursor(data['cursor']) if 'cursor' in data else None,
+                min_amount=data.get('min_amount'),
+                max_amount=data.get('max_amount'),
+                since=data.get('from'),
+                until=data.get('to'),
+                min_lsn=self.consistency_token(request),
+            )
         except AccountNotFound:
             return self.error_response({'id': ValidationErrors.NOT_FOUND}, status=404)
 
+        response = {
+            'transactions': [format_money(transaction, 'amount') for transaction in transactions],
+            'next_cursor': next_cursor,
+        }
+        # на последней странице - суммы за периоды, строки которых ушли в архив
+        if next_cursor is None:
+            response['archived_periods'] = [
+                format_money(period, 'credit_total', 'debit_total')
+                for period in await self.db_handler.get_account_archive_summaries(
+                    data['id'], since=data.get('from'), until=data.get('to')
+                )
+            ]
+        return self.success_response(response)
+
+    @validate(EXPORT_TRANSACTIONS)
+    async def export_transactions(self, request, data):
+        if self.active_exports >= self.export_max_concurrent:
+            return self.error_response(ServiceErrors.TRY_AGAIN_LATER, status=503)
+
+        export_format = data.get('format', ExportFormat.NDJSON)
+        with_accounts = data.get('with_accounts', False)
+        columns = EXPORT_COLUMNS + EXPORT_ACCOUNT_COLUMNS if with_accounts else EXPORT_COLUMNS
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/csv' if export_format == ExportFormat.CSV else 'application/x-ndjson'
+        })
+        response.enable_chunked_encoding()
+
+        self.active_exports += 1
+        try:
+            await response.prepare(request)
+            if export_format == ExportFormat.CSV:
+                await response.write((','.join(columns) + '\r\n').encode())
+
+            async def _write_chunk(rows):
+                if export_format == ExportFormat.CSV:
+                    buffer = io.StringIO()
+                    # None csv пишет пустой строкой, время и суммы - так же, как в json
+                    csv.writer(buffer).writerows(
+                        [format_minor_units(value) if key == 'amount'
+                         else value if value is None or isinstance(value, (int, str)) else json_defaults(value)
+                         for key, value in row.items()]
+                        for row in rows
+                    )
+                    chunk = buffer.getvalue()
+                else:
+                    chunk = ''.join(custom_json_dumps(format_money(row, 'amount')) + '\n' for row in rows)
+                # write ждет, пока клиент вычитает буфер сокета, и пока он ждет - из курсора ничего не читается
+                await response.write(chunk.encode())
+
+            # после prepare ответ об ошибке уже не отправить: при ошибке соединение рвется без последнего
+            # чанка, и клиент видит, что выгрузка неполная
+            await self.db_handler.export_transactions(
+                _write_chunk, self.export_chunk_size,
+                after_id=data.get('after_id'),
+                account_id=data.get('account_id'),
+                since=data.get('from'),
+                until=data.get('to'),
+                with_accounts=with_accounts,
+                min_lsn=self.consistency_token(request),
+            )
+            await response.write_eof()
+        finally:
+            self.active_exports -= 1
+
+        return response
+
     @validate(ACCOUNT_PAYMENT)
     async def account_payment(self, request, data):
         raw_account_id = request.match_info['id']
@@ -172,36 +1556,113 @@ class AppHandlers:
 
         account_id = int(raw_account_id)
 
+        idempotency = self.idempotency(request, 'payment', data, self.payment_result)
+        if idempotency is not None:
+            return await self.idempotent_response(
+                idempotency, self.db_handler.create_account_payment, account_id, data['amount']
+            )
+
         try:
-            account_data = await self.db_handler.create_account_payment(account_id, data['amount'])
-        except AccountNotFound:
-            return self.error_response({'account_id': ValidationErrors.NOT_FOUND}, status=404)
-        except AccountBalanceExceededMaximum:
-            return self.error_response({'amount': ValidationErrors.TOO_BIG})
+            result = await self.db_handler.create_account_payment(account_id, data['amount'])
+        except (AccountNotFound, AccountBalanceExceededMaximum) as exc:
+            result = exc
 
-        return self.success_response(account_data)
+        status, text = self.payment_result(result)
+        return self.text_response(text, status=status)
 
     @validate(CREATE_TRANSACTION)
     async def create_transaction(self, request, data):
+        mode = request.query.get('mode', TransferMode.SYNC)
+        if mode not in self.transfer_modes:
+            return self.error_response({'mode': ValidationErrors.NOT_ALLOWED})
+
         if data['source_account_id'] == data['target_account_id']:
             return self.error_response({'target_account': ValidationErrors.SAME_AS_SOURCE_ACCOUNT})
 
-        try:
-            transaction_data = await self.db_handler.create_transaction(
-                data['source_account_id'], data['target_account_id'], data['amount']
-            )
-        except AccountNotFound as exc:
-            return self.error_response({field_name: ValidationErrors.NOT_FOUND for field_name in exc.extra_info})
-        except AccountNotEnoughtMoney:
-            return self.error_response({'source_account_id': ValidationErrors.NOT_ENOUGHT_MONEY})
-        except AccountBalanceExceededMaximum:
-            return self.error_response({'amount': ValidationErrors.TOO_BIG})
+        if mode == TransferMode.ASYNC:
+            operation = self.db_handler.enqueue_transaction
+            render = partial(self.transaction_result, success_status=202)
+        else:
+            operation, render = self.db_handler.create_transaction, self.transaction_result
+        args = data['source_account_id'], data['target_account_id'], data['amount']
+
+        # ключ переводов общий для обоих режимов, режим входит в хэш запроса
+        idempotency = self.idempotency(request, 'transaction', dict(data, mode=mode), render)
+        if idempotency is not None:
+            response = await self.idempotent_response(idempotency, operation, *args)
+        else:
+            try:
+                result = await operation(*args)
+            except (AccountNotFound, AccountNotEnoughtMoney, AccountBalanceExceededMaximum) as exc:
+                result = exc
+            status, text = render(result)
+            response = self.text_response(text, status=status)
+
+        if mode == TransferMode.ASYNC:
+            self.transfer_workers.wakeup()
+        return response
+
+    @validate(CREATE_TRANSACTIONS_BATCH)
+    async def create_transactions_batch(self, request, data):
+        # результат по каждому переводу в том же порядке, в котором они пришли
+        results = [None] * len(data['transfers'])
+        positions, transfers = [], []
+
+        for position, transfer in enumerate(data['transfers']):
+            if transfer['source_account_id'] == transfer['target_account_id']:
+                results[position] = {
+                    'success': False, 'error': {'target_account': ValidationErrors.SAME_AS_SOURCE_ACCOUNT}
+                }
+            else:
+                positions.append(position)
+                transfers.append((transfer['source_account_id'], transfer['target_account_id'], transfer['amount']))
 
-        return self.success_response(transaction_data)
+        if transfers:
+            for position, result in zip(positions, await self.db_handler.create_transactions_batch(transfers)):
+                if isinstance(result, ApiException):
+                    results[position] = {'success': False, 'error': self.transaction_error(result)}
+                else:
+                    results[position] = {'success': True, 'data': format_money(result, 'amount')}
+
+        return self.success_response(results)
 
     @validate(GET_OBJECT_BY_ID)
     async def get_transaction(self, request, data):
         try:
-            return self.success_response(await self.db_handler.get_transaction(data['id']))
+            transaction_data = await self.db_handler.get_transaction(
+                data['id'], min_lsn=self.consistency_token(request)
+            )
+            return self.success_response(format_money(transaction_data, 'amount'))
         except TransactionNotFound:
             return self.error_response({'id': ValidationErrors.NOT_FOUND}, status=404)
+
+    async def get_metrics(self, request):
+        return web.Response(
+            text=self.metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def get_profiling(self, request):
+        return self.success_response(self.profiler.get_status())
+
+    @validate(PROFILING)
+    async def profiling(self, request, data):
+        # включает и выключает семплирующий профайлер этого процесса, профиль пишется в profiling.directory
+        if not self.profiler.enabled:
+            return self.error_response({'profiling': ValidationErrors.NOT_ALLOWED}, status=403)
+        try:
+            if data['action'] == ProfilingAction.START:
+                interval = data['interval_ms'] / 1000 if 'interval_ms' in data else None
+                status = self.profiler.start(duration=data.get('duration'), interval=interval)
+            else:
+                # поток профайлера пишет файл, event loop его не ждет
+                status = await asyncio.get_event_loop().run_in_executor(None, self.profiler.stop)
+        except ProfilingError as exc:
+            return self.error_response({'action': str(exc)}, status=409)
+        return self.success_response(status)
+
+    async def get_stats(self, request):
+        return self.success_response({
+            **self.db_handler.get_stats(),
+            'admission': self.admission.get_stats() if self.admission.enabled else None,
+            'slow_requests': self.tracer.slow_requests,
+        })
@@ -0,0 +1,35 @@
+import asyncio
+
+from loguru import logger
+
+
+class IdempotencyKeysCleaner:
+    # удаляет ключи идемпотентности с истекшим сроком раз в idempotency.cleanup_interval.
+    # истекший, но еще не удаленный ключ уже не действует, поэтому очистке некуда торопиться
+
+    def __init__(self, db_handler, config):
+        conf = config.get('idempotency', {})
+        self.cleanup_interval = conf.get('cleanup_interval', 60)
+        self.batch_size = conf.get('cleanup_batch_size', 10000)
+        self.db_handler = db_handler
+        self._task = None
+
+    async def start(self, app=None):
+        self._task = asyncio.ensure_future(self._work())
+
+    async def stop(self, app=None):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                deleted = await self.db_handler.delete_expired_idempotency_keys(self.batch_size)
+            except Exception:
+                logger.exception('Deleting expired idempotency keys failed: ')
+            else:
+                if deleted:
+                    logger.info('Deleted {} expired idempotency keys', deleted)
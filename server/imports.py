@@ -0,0 +1,105 @@
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+from server.constants import ExportFormat, ImportStatus, ValidationErrors
+from server.money import format_minor_units
+from server.schemas import IMPORT_ACCOUNT
+from server.validation import compile_schema
+
+
+validate_row = compile_schema(IMPORT_ACCOUNT)
+
+
+def parse_ndjson(line):
+    # суммы парсятся сразу в Decimal, через float они бы потеряли точность. в копейки их переводит схема
+    row = json.loads(line, parse_float=Decimal)
+    if not isinstance(row, dict):
+        raise ValueError
+    return row
+
+
+def parse_csv(line):
+    values = next(csv.reader([line]))
+    if not 1 <= len(values) <= 2:
+        raise ValueError
+    row = {'email': values[0]}
+    if len(values) == 2 and values[1]:
+        row['initial_balance'] = values[1]
+    return row
+
+
+class AccountImporter:
+    # массовое создание счетов из NDJSON ({"email": ..., "initial_balance": ...}) или CSV (email[,initial_balance]).
+    # строки читаются и валидируются по одной, в базу уходят пачками по account_import.chunk_size:
+    # COPY во временную таблицу и одна вставка в accounts с ON CONFLICT. память не зависит от размера файла
+
+    def __init__(self, db_handler, config):
+        self.chunk_size = config.get('account_import', {}).get('chunk_size', 10000)
+        self.db_handler = db_handler
+
+    async def run(self, lines, import_format, on_results):
+        # lines - асинхронный итератор строк файла (bytes или str), on_results(results) получает
+        # результаты каждой пачки: [{'line', 'email', 'status', 'id' или 'error'}] в порядке строк.
+        # каждая пачка коммитится отдельно, повторный импорт того же файла отдаст уже созданные счета как duplicate
+        parse = parse_csv if import_format == ExportFormat.CSV else parse_ndjson
+        summary = dict.fromkeys((ImportStatus.CREATED, ImportStatus.DUPLICATE, ImportStatus.INVALID), 0)
+        results, records = [], []
+
+        line_number = 0
+        async for line in lines:
+            line_number += 1
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', errors='replace')
+            line = line.strip()
+            if not line:
+                continue
+            # заголовок csv необязателен
+            if line_number == 1 and import_format == ExportFormat.CSV and line.split(',')[0] == 'email':
+                continue
+
+            result = self._validate(line_number, line, parse, self.db_handler.max_balance)
+            results.append(result)
+            if result['status'] is None:
+                records.append((line_number, result['email'], result.pop('initial_balance')))
+
+            if len(results) >= self.chunk_size:
+                await self._flush(results, records, summary, on_results)
+                results, records = [], []
+
+        if results:
+            await self._flush(results, records, summary, on_results)
+        return summary
+
+    @staticmethod
+    def _validate(line_number, line, parse, max_balance):
+        try:
+            row = parse(line)
+        except (ValueError, InvalidOperation):
+            return {'line': line_number, 'email': None, 'status': ImportStatus.INVALID,
+                    'error': ValidationErrors.INVALID_ROW}
+
+        is_valid, row, errors = validate_row(row)
+        if not is_valid:
+            email = row.get('email') if isinstance(row.get('email'), str) else None
+            return {'line': line_number, 'email': email, 'status': ImportStatus.INVALID, 'error': errors}
+
+        initial_balance = row.get('initial_balance') or 0
+        if initial_balance > max_balance:
+            # лимит из конфига, схема про него не знает. ошибка в том же виде, что и у схемы
+            return {'line': line_number, 'email': row['email'], 'status': ImportStatus.INVALID,
+                    'error': {'initial_balance': [f'max value is {format_minor_units(max_balance)}']}}
+        return {'line': line_number, 'email': row['email'], 'status': None, 'initial_balance': initial_balance}
+
+    async def _flush(self, results, records, summary, on_results):
+        created = await self.db_handler.import_accounts(records) if records else {}
+        for result in results:
+            if result['status'] is None:
+                # в created нет строки, если email уже был в базе или выше в этой же пачке
+                account_id = created.get(result['line'])
+                if account_id is None:
+                    result['status'] = ImportStatus.DUPLICATE
+                else:
+                    result['status'], result['id'] = ImportStatus.CREATED, account_id
+            summary[result['status']] += 1
+        await on_results(results)
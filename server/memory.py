@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import asyncio
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+
+from loguru import logger
+
+from server.constants import StorageBackend, TransferStatus
+from server.money import max_balance
+from server.metrics import Metrics
+from server.storage import Storage
+from server.tracing import record_span
+from server.utils import json_defaults
+from server.exceptions import (
+    ApiException, DuplicateAccountEmail, AccountNotFound, AccountBalanceExceededMaximum, AccountNotEnoughtMoney,
+    TransactionNotFound, StorageLogError
+)
+
+
+# поля записей журнала, которые при чтении превращаются обратно из строк. суммы в копейках пишутся числами
+DATETIME_FIELDS = ('ctime', 'expires_at')
+
+
+def decode_record(record):
+    for field in DATETIME_FIELDS:
+        if field in record:
+            record[field] = datetime.fromisoformat(record[field])
+    return record
+
+
+class AppendOnlyLog:
+    # журнал MemoryStorage. строка - json список записей одного изменения, поэтому изменение из нескольких
+    # записей (счет с начальным балансом, перевод вместе с ответом на Idempotency-Key) восстанавливается
+    # целиком или никак. строка дописывается в конец файла и сразу уходит в ОС: падение процесса ее не теряет.
+    # с fsync изменение подтверждается клиенту только после fsync, один fsync - на все изменения, которые
+    # успели дописать, пока шел предыдущий
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+        # сколько строк дописано и сколько из них точно на диске
+        self._written = 0
+        self._synced = 0
+        self._syncing = None
+        self.stats = Counter()
+
+    def read(self):
+        # -> изменения из журнала по порядку. недописанная последняя строка (процесс упал посреди записи)
+        # отрезается, испорченная строка в середине - ошибка: за ней могут быть подтвержденные изменения
+        if not os.path.exists(self.path):
+            return []
+        changes, offset = [], 0
+        with open(self.path, 'rb') as file:
+            for number, line in enumerate(file, 1):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    changes.append([decode_record(record) for record in json.loads(line)])
+                except ValueError:
+                    raise StorageLogError(f'{self.path}: invalid line {number}') from None
+                offset += len(line)
+
+        if offset < os.path.getsize(self.path):
+            logger.warning('Truncating unfinished last line of {} at offset {}', self.path, offset)
+            os.truncate(self.path, offset)
+        return changes
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'ab')
+
+    def append(self, records):
+        line = json.dumps(records, default=json_defaults, separators=(',', ':')).encode() + b'\n'
+        self._file.write(line)
+        self._file.flush()
+        self._written += 1
+        self.stats['changes'] += 1
+        self.stats['bytes'] += len(line)
+
+    async def sync(self):
+        # ждет, пока на диске окажутся все строки, дописанные до вызова
+        if not self.fsync:
+            return
+        position = self._written
+        started_at = time.perf_counter()
+        while self._synced < position:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._fsync())
+            # fsync общий, отмена одного ожидающего его не прерывает
+            await asyncio.shield(self._syncing)
+        record_span('log_fsync', started_at, time.perf_counter() - started_at)
+
+    async def _fsync(self):
+        position = self._written
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, self._file.fileno())
+        finally:
+            self._syncing = None
+        self._synced = position
+        self.stats['fsyncs'] += 1
+
+    async def close(self):
+        if self._syncing is not None:
+            await asyncio.gather(self._syncing, return_exceptions=True)
+        if self._file is not None:
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def get_stats(self):
+        return dict(self.stats, path=self.path, fsync=self.fsync)
+
+
+class MemoryStorage(Storage):
+    # счета и транзакции в памяти процесса, с той же семантикой, что и в postgres (см. Storage).
+    # изменение проверяется и применяется без await внутри, поэтому блокировки не нужны: операция видит
+    # состояние целиком и проводится целиком. с storage.memory.log_path изменения пишутся в журнал до того,
+    # как применяются, а при старте состояние восстанавливается из него. состояние одно на процесс,
+    # поэтому только с http.workers: 1
+
+    backend = StorageBackend.MEMORY
+
+    def __init__(self, config):
+        conf = config.get('storage', {}).get('memory', {})
+        self.log = None
+        if conf.get('log_path'):
+            self.log = AppendOnlyLog(conf['log_path'], fsync=conf.get('fsync', True))
+        self.idempotency_ttl = config.get('idempotency', {}).get('ttl', 86400)
+        self.max_balance = max_balance(config)
+
+        self.accounts = {}
+        self.account_ids_by_email = {}
+        self.transactions = {}
+        # ответы на запросы с Idempotency-Key в порядке сохранения. срок у всех одинаковый,
+        # поэтому истекшие всегда в начале
+        self.idempotent_responses = OrderedDict()
+        # id не переиспользуются, как и у последовательностей в базе
+        self.last_account_id = 0
+        self.last_transaction_id = 0
+
+        self.metrics = Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+
+    async def start(self, app=None):
+        if self.log is None:
+            return
+        changes = self.log.read()
+        for records in changes:
+            for record in records:
+                self._apply(record)
+        self.log.open()
+        logger.info(
+            'Restored {} accounts and {} transactions from {} changes in {}',
+            len(self.accounts), len(self.transactions), len(changes), self.log.path
+        )
+
+    async def close(self, app=None):
+        if self.log is not None:
+            await self.log.close()
+
+    def get_stats(self):
+        return {'memory': {
+            'accounts': len(self.accounts),
+            'transactions': len(self.transactions),
+            'idempotency_keys': len(self.idempotent_responses),
+            'log': self.log.get_stats() if self.log is not None else None,
+        }}
+
+    def _collect_metrics(self):
+        metrics = [
+            ('memory_storage_accounts', 'gauge', 'Accounts in memory', (), [((), len(self.accounts))]),
+            ('memory_storage_transactions', 'gauge', 'Transactions in memory', (), [((), len(self.transactions))]),
+        ]
+        if self.log is not None:
+            metrics.append(
+                ('memory_storage_log_fsyncs_total', 'counter', 'Log fsyncs', (), [((), self.log.stats['fsyncs'])])
+            )
+        return metrics
+
+    async def _commit(self, records):
+        # журнал пишется до изменения памяти: если запись не удалась, состояние не поменялось.
+        # изменение видно другим запросам сразу, а подтверждается после fsync журнала
+        if self.log is not None:
+            self.log.append(records)
+        for record in records:
+            self._apply(record)
+        if self.log is not None:
+            await self.log.sync()
+
+    def _apply(self, record):
+        getattr(self, '_apply_' + record['op'])(record)
+
+    def _apply_account(self, record):
+        self.accounts[record['id']] = {
+            'id': record['id'], 'email': record['email'], 'balance': 0, 'ctime': record['ctime']
+        }
+        self.account_ids_by_email[record['email']] = record['id']
+        self.last_account_id = record['id']
+
+    def _apply_payment(self, record):
+        self.accounts[record['account_id']]['balance'] += record['amount']
+        self.transactions[record['id']] = {
+            'id': record['id'], 'source_account_id': None, 'target_account_id': record['account_id'],
+            'amount': record['amount'], 'ctime': record['ctime'],
+        }
+        self.last_transaction_id = record['id']
+
+    def _apply_transfer(self, record):
+        self.accounts[record['source_account_id']]['balance'] -= record['amount']
+        self.accounts[record['target_account_id']]['balance'] += record['amount']
+        self.transactions[record['id']] = {
+            'id': record['id'], 'source_account_id': record['source_account_id'],
+            'target_account_id': record['target_account_id'], 'amount': record['amount'], 'ctime': record['ctime'],
+        }
+        self.last_transaction_id = record['id']
+
+    def _apply_drop(self, record):
+        account = self.accounts.pop(record['account_id'])
+        del self.account_ids_by_email[account['email']]
+        self.transactions = {
+            transaction_id: transaction for transaction_id, transaction in self.transactions.items()
+            if record['account_id'] not in (transaction['source_account_id'], transaction['target_account_id'])
+        }
+
+    def _apply_idempotency(self, record):
+        key = (record['scope'], record['key'])
+        # занятый заново истекший ключ переезжает в конец
+        self.idempotent_responses.pop(key, None)
+        self.idempotent_responses[key] = {
+            'request_hash': record['request_hash'], 'status': record['status'], 'response': record['response'],
+            'expires_at': record['expires_at'],
+        }
+        now = datetime.utcnow()
+        while self.idempotent_responses:
+            first_key = next(iter(self.idempotent_responses))
+            if self.idempotent_responses[first_key]['expires_at'] > now:
+                break
+            del self.idempotent_responses[first_key]
+
+    async def create_account(self, email, initial_balance=None):
+        if email in self.account_ids_by_email:
+            raise DuplicateAccountEmail
+        initial_balance = initial_balance or 0
+        if initial_balance > self.max_balance:
+            raise AccountBalanceExceededMaximum
+
+        account_id, now = self.last_account_id + 1, datetime.utcnow()
+        records = [{'op': 'account', 'id': account_id, 'email': email, 'ctime': now}]
+        # начальный баланс проводится как пополнение, как и в базе
+        if initial_balance:
+            records.append({
+                'op': 'payment', 'id': self.last_transaction_id + 1, 'account_id': account_id,
+                'amount': initial_balance, 'ctime': now,
+            })
+        await self._commit(records)
+        return {'id': account_id, 'email': email, 'balance': initial_balance, 'ctime': now}
+
+    async def drop_account(self, account_id):
+        if account_id in self.accounts:
+            await self._commit([{'op': 'drop', 'account_id': account_id}])
+
+    async def get_account(self, account_id, min_lsn=None):
+        account = self.accounts.get(account_id)
+        if account is None:
+            raise AccountNotFound
+        return dict(account)
+
+    async def create_account_payment(self, account_id, amount, idempotency=None):
+        if idempotency is not None:
+            return await self._run_idempotent(idempotency, self._plan_payment, account_id, amount)
+        records, account_data = self._plan_payment(account_id, amount)
+        await self._commit(records)
+        return account_data
+
+    def _plan_payment(self, account_id, amount):
+        # -> (записи изменения, результат). состояние не меняется, ошибки - как у DBHandler
+        account = self.accounts.get(account_id)
+        if account is None:
+            raise AccountNotFound
+        if account['balance'] + amount > self.max_balance:
+            raise AccountBalanceExceededMaximum
+
+        record = {
+            'op': 'payment', 'id': self.last_transaction_id + 1, 'account_id': account_id, 'amount': amount,
+            'ctime': datetime.utcnow(),
+        }
+        return [record], dict(account, balance=account['balance'] + amount)
+
+    async def create_transaction(self, source_account_id, target_account_id, amount, idempotency=None):
+        if idempotency is not None:
+            return await self._run_idempotent(
+                idempotency, self._plan_transfer, source_account_id, target_account_id, amount
+            )
+        records, transaction_data = self._plan_transfer(source_account_id, target_account_id, amount)
+        await self._commit(records)
+        return transaction_data
+
+    def _plan_transfer(self, source_account_id, target_account_id, amount):
+        if source_account_id not in self.accounts or target_account_id not in self.accounts:
+            _map = {'source_account_id': source_account_id, 'target_account_id': target_account_id}
+            raise AccountNotFound(extra_info=[k for k, v in _map.items() if v not in self.accounts])
+
+        if self.accounts[source_account_id]['balance'] < amount:
+            raise AccountNotEnoughtMoney
+        if self.accounts[target_account_id]['balance'] + amount > self.max_balance:
+            raise AccountBalanceExceededMaximum
+
+        transaction_data = {
+            'id': self.last_transaction_id + 1, 'source_account_id': source_account_id,
+            'target_account_id': target_account_id, 'amount': amount, 'ctime': datetime.utcnow(),
+        }
+        return [dict(transaction_data, op='transfer')], transaction_data
+
+    async def get_transaction(self, transaction_id, min_lsn=None):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None:
+            raise TransactionNotFound
+        return dict(transaction, status=TransferStatus.COMPLETED)
+
+    async def get_idempotent_response(self, scope, key):
+        response = self.idempotent_responses.get((scope, key))
+        if response is None or response['expires_at'] <= datetime.utcnow():
+            return None
+        # повтор не отдает ответ раньше, чем изменение первого запроса окажется на диске
+        if self.log is not None:
+            await self.log.sync()
+        return response
+
+    async def _run_idempotent(self, idempotency, plan, *args):
+        # ответ сохраняется в той же строке журнала, что и изменение. между проверкой ключа и записью
+        # нет await, поэтому параллельные дубли получают ответ первого запроса
+        response = await self.get_idempotent_response(idempotency.scope, idempotency.key)
+        if response is not None:
+            return response
+
+        try:
+            records, result = plan(*args)
+        except ApiException as exc:
+            records, result = [], exc
+        status, body = idempotency.render(result)
+        response = {
+            'request_hash': idempotency.request_hash, 'status': status, 'response': body,
+            'expires_at': datetime.utcnow() + timedelta(seconds=self.idempotency_ttl),
+        }
+        record = dict(response, op='idempotency', scope=idempotency.scope, key=idempotency.key)
+        await self._commit(records + [record])
+        return response
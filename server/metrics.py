@@ -0,0 +1,184 @@
+import time
+import asyncio
+from bisect import bisect_left
+from functools import partial
+
+import asyncpg
+
+from server.admission import time_left
+from server.tracing import record_span
+from server.exceptions import RequestRejected
+
+
+# границы корзин гистограмм в секундах. от миллисекунды до десяти секунд - от чтения по ключу до ожидания локов
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    # запись - один bisect и два сложения без аллокаций, корзины создаются один раз.
+    # все пишут из одного event loop, поэтому блокировки не нужны
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # последняя корзина - значения больше всех границ (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # в prometheus корзина le включает свою границу, bisect_left дает первую границу >= value
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class HistogramFamily:
+    # гистограммы одной метрики с разными значениями меток
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self.children = {}
+
+    def labels(self, *values):
+        # гистограмма создается при первой встрече набора меток, дальше берется из словаря
+        histogram = self.children.get(values)
+        if histogram is None:
+            histogram = self.children[values] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.description}')
+        lines.append(f'# TYPE {self.name} histogram')
+        bucket_names = self.label_names + ('le',)
+        for values, histogram in sorted(self.children.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                total += count
+                labels = _format_labels(bucket_names, values + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = _format_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(histogram.sum)}')
+            lines.append(f'{self.name}_count{labels} {total}')
+
+
+class Metrics:
+    # метрики процесса для GET /metrics в текстовом формате prometheus.
+    # счетчики, которые уже ведутся в других местах (конкуренция, пул, кэши), не дублируются,
+    # а читаются при отдаче через коллекторы
+
+    def __init__(self):
+        self.http_requests = HistogramFamily(
+            'http_request_duration_seconds', 'HTTP request latency', ('route', 'method', 'status')
+        )
+        self.http_in_flight = 0
+        self.pool_wait = HistogramFamily('db_pool_wait_seconds', 'Time spent waiting for a pool connection')
+        self.statements = HistogramFamily('db_statement_duration_seconds', 'SQL statement latency', ('statement',))
+        self.lock_wait = HistogramFamily('db_lock_wait_seconds', 'Time spent waiting for account row locks')
+        self.group_size = HistogramFamily(
+            'db_group_commit_size', 'Writes per group commit', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+        )
+        # текст запроса -> короткое имя для метки, остальные запросы попадают в other
+        self.statement_names = {}
+        self._collectors = []
+
+    def add_collector(self, collector):
+        # collector() -> [(имя, тип, описание, имена меток, [(значения меток, значение)])]
+        self._collectors.append(collector)
+
+    def statement_name(self, query):
+        return self.statement_names.get(query, 'other')
+
+    def observe_statement(self, query, elapsed):
+        self.statements.observe(elapsed, self.statement_name(query))
+
+    def render(self):
+        lines = [
+            '# HELP http_requests_in_flight HTTP requests being processed',
+            '# TYPE http_requests_in_flight gauge',
+            f'http_requests_in_flight {self.http_in_flight}',
+        ]
+        for family in (self.http_requests, self.pool_wait, self.statements, self.lock_wait, self.group_size):
+            family.render(lines)
+
+        for collector in self._collectors:
+            for name, metric_type, description, label_names, samples in collector():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for values, value in samples:
+                    lines.append(f'{name}{_format_labels(label_names, values)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class MeteredConnection(asyncpg.Connection):
+    # соединение пула, которое пишет время каждого запроса с параметрами (fetch*, execute с аргументами)
+    # в metrics. metrics выставляет init пула, соединения вне пула ничего не пишут.
+    # переопределены только публичные методы: внутренние методы asyncpg меняются между версиями
+
+    __slots__ = ('metrics',)
+
+    async def _metered(self, query, call, timeout):
+        # запрос HTTP запроса с дедлайном ждет не дольше, чем до дедлайна: по таймауту asyncpg отменяет
+        # его в базе, в том числе ожидание блокировки. BEGIN и COMMIT идут без параметров и не прерываются
+        left = time_left()
+        bounded = left is not None and (timeout is None or left < timeout)
+        if bounded:
+            timeout = left
+
+        metrics = getattr(self, 'metrics', None)
+        started_at = time.perf_counter()
+        try:
+            return await call(timeout=timeout)
+        except asyncio.TimeoutError:
+            if bounded:
+                raise RequestRejected('deadline') from None
+            raise
+        finally:
+            elapsed = time.perf_counter() - started_at
+            if metrics is not None:
+                metrics.observe_statement(query, elapsed)
+                record_span('sql:' + metrics.statement_name(query), started_at, elapsed)
+            else:
+                record_span('sql:other', started_at, elapsed)
+
+    async def fetch(self, query, *args, timeout=None, **kwargs):
+        return await self._metered(query, partial(super().fetch, query, *args, **kwargs), timeout)
+
+    async def fetchrow(self, query, *args, timeout=None, **kwargs):
+        return await self._metered(query, partial(super().fetchrow, query, *args, **kwargs), timeout)
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        return await self._metered(query, partial(super().fetchval, query, *args, column=column), timeout)
+
+    async def execute(self, query, *args, timeout=None):
+        if args:
+            return await self._metered(query, partial(super().execute, query, *args), timeout)
+        # запросы без параметров (BEGIN, COMMIT, SAVEPOINT) в метрики не пишутся, а в трассировку запроса
+        # попадают: время COMMIT - это ожидание fsync
+        started_at = time.perf_counter()
+        try:
+            return await super().execute(query, timeout=timeout)
+        finally:
+            name = 'sql:' + (query.split(None, 1) or ['?'])[0].rstrip(';').lower()
+            record_span(name, started_at, time.perf_counter() - started_at)
@@ -0,0 +1,66 @@
+import math
+from decimal import Decimal
+
+from server.constants import ValidationErrors, MINOR_UNITS, MAX_AMOUNT
+
+
+# дробная часть для каждого остатка от деления на MINOR_UNITS, что бы не форматировать ее на каждую сумму
+_FRACTIONS = [f'.{cents:02d}' for cents in range(MINOR_UNITS)]
+
+
+def _round_half_up(numerator, denominator):
+    # numerator / denominator до целого, половина - от нуля, как округлял NUMERIC(8, 2)
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def to_minor_units(value):
+    # сумма в рублях из запроса -> целое число копеек. число json приходит int или float, query string и csv -
+    # строкой, ndjson импорта - Decimal. float переводится точно, через as_integer_ratio, без Decimal
+    value_type = type(value)
+    if value_type is int:
+        return value * MINOR_UNITS
+    if value_type is float:
+        if not math.isfinite(value):
+            raise ValueError(ValidationErrors.MUST_BE_FINITE)
+        numerator, denominator = value.as_integer_ratio()
+        return _round_half_up(numerator * MINOR_UNITS, denominator)
+
+    value = Decimal(value)
+    if not value.is_finite():
+        raise ValueError(ValidationErrors.MUST_BE_FINITE)
+    # 1e999999999 точно в целое не переводится: все, что больше MAX_AMOUNT, отсечет валидация
+    if value.adjusted() > 20:
+        return (MAX_AMOUNT + 1) * (1 if value > 0 else -1)
+    numerator, denominator = value.as_integer_ratio()
+    return _round_half_up(numerator * MINOR_UNITS, denominator)
+
+
+def format_minor_units(value):
+    # 1050 -> '10.50', -5 -> '-0.05'
+    if value < 0:
+        return '-' + format_minor_units(-value)
+    units, cents = divmod(value, MINOR_UNITS)
+    return f'{units}{_FRACTIONS[cents]}'
+
+
+def format_money(row, *fields):
+    # копия row (dict или asyncpg Record), в которой суммы в копейках из fields - строки рублей: "10.50".
+    # зовется там, где собирается ответ: по имени ключа в произвольном json сумму не отличить от счетчика
+    result = dict(row)
+    for field in fields:
+        value = result.get(field)
+        if value is not None:
+            result[field] = format_minor_units(value)
+    return result
+
+
+def max_balance(config):
+    # money.max_balance из config.yml в копейках
+    value = config.get('money', {}).get('max_balance', '999999.99')
+    balance = to_minor_units(value if isinstance(value, str) else str(value))
+    if not 0 < balance <= MAX_AMOUNT:
+        raise ValueError(f'money.max_balance must be between 0.01 and {format_minor_units(MAX_AMOUNT)}')
+    return balance
@@ -0,0 +1,275 @@
+import os
+import re
+import csv
+import gzip
+import asyncio
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+from loguru import logger
+
+from server.money import to_minor_units
+from server.exceptions import ArchiveError
+
+
+# границы партиции в том виде, в котором их отдает pg_get_expr(relpartbound)
+PARTITION_BOUND_RE = re.compile(r"FROM \((?:MINVALUE|'([^']+)')\) TO \('([^']+)'\)")
+
+ARCHIVE_COLUMNS = ('id', 'source_account_id', 'target_account_id', 'amount', 'ctime')
+
+# архив пишется по возрастанию id блоками по столько строк, каждый блок - отдельный gzip member. файл
+# остается обычным gzip (zcat читает его целиком), а индекс рядом с ним - первый id и смещение каждого блока.
+# поиск по id читает один блок, а не весь месяц
+ARCHIVE_BLOCK_ROWS = 10000
+
+
+class PartitionMaintainer:
+    # держит созданными партиции transactions на partitions.months_ahead месяцев вперед.
+    # вставка в месяц без партиции упадет, поэтому проверка идет при старте и дальше раз в check_interval
+
+    def __init__(self, db_handler, config):
+        conf = config.get('partitions', {})
+        self.months_ahead = conf.get('months_ahead', 3)
+        self.check_interval = conf.get('check_interval', 3600)
+        self.db_handler = db_handler
+        self._task = None
+
+    async def start(self, app=None):
+        await self.create_partitions()
+        self._task = asyncio.ensure_future(self._work())
+
+    async def stop(self, app=None):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def create_partitions(self):
+        async with self.db_handler._acquire() as conn:
+            await conn.execute('SELECT create_transactions_partitions($1)', self.months_ahead)
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.create_partitions()
+            except Exception:
+                logger.exception('Creating transactions partitions failed: ')
+
+
+async def list_partitions(conn):
+    # [(имя, начало или None для MINVALUE, конец)] по возрастанию конца
+    rows = await conn.fetch(
+        '''SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transactions'::regclass'''
+    )
+    partitions = []
+    for row in rows:
+        period_start, period_end = PARTITION_BOUND_RE.search(row['bound']).groups()
+        partitions.append((
+            row['relname'],
+            datetime.fromisoformat(period_start) if period_start else None,
+            datetime.fromisoformat(period_end),
+        ))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+class Archiver:
+    # выгружает партиции transactions, которые целиком старше before, в сжатые csv файлы и отключает их.
+    # вместо строк в базе остается сумма зачислений и списаний по каждому счету за период партиции
+
+    def __init__(self, db_handler, config):
+        conf = config.get('archive', {})
+        self.directory = conf.get('directory', './archive')
+        self.block_rows = conf.get('block_rows', ARCHIVE_BLOCK_ROWS)
+        self.db_handler = db_handler
+
+    async def archive(self, before):
+        os.makedirs(self.directory, exist_ok=True)
+        async with self.db_handler._acquire() as conn:
+            partitions = [p for p in await list_partitions(conn) if p[2] <= before]
+            # сверка хранит суммы по счетам, а строк архивной партиции в журнале уже не будет.
+            # поэтому архивируются только полностью сверенные партиции
+            checkpoint = await conn.fetchval('SELECT last_transaction_id FROM reconciliation_checkpoint')
+
+            archived = []
+            for name, period_start, period_end in partitions:
+                archived.append(await self._archive_partition(conn, name, period_start, period_end, checkpoint))
+        return archived
+
+    async def _archive_partition(self, conn, name, period_start, period_end, checkpoint):
+        min_id, max_id, rows = await conn.fetchrow(f'SELECT min(id), max(id), count(*) FROM {name}')
+        if max_id is not None and max_id > checkpoint:
+            raise ArchiveError(f'{name} is not reconciled yet, run reconcile first')
+
+        # сначала файл, потом отключение партиции: если процесс упадет между ними, повторный запуск
+        # просто перезапишет файл. старые месяцы уже не меняются, новых строк в партиции не будет
+        path = os.path.join(self.directory, f'{name}.csv.gz')
+        with open(path + '.tmp', 'wb') as raw_file:
+            writer = ArchiveWriter(raw_file, self.block_rows)
+            await conn.copy_from_query(
+                f'SELECT {", ".join(ARCHIVE_COLUMNS)} FROM {name} ORDER BY id',
+                output=writer.write, format='csv', header=True
+            )
+            writer.close()
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        with open(path + '.idx.tmp', 'w') as index_file:
+            index_file.writelines(f'{first_id} {offset}\n' for first_id, offset in writer.index)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        # без индекса архив читается целиком, поэтому индекс кладется после файла
+        os.replace(path + '.tmp', path)
+        os.replace(path + '.idx.tmp', path + '.idx')
+
+        async with conn.transaction():
+            await conn.execute(
+                '''INSERT INTO transactions_archives(
+                    partition_name, period_start, period_end, min_id, max_id, rows, path
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7)''',
+                name, period_start, period_end, min_id, max_id, rows, os.path.abspath(path)
+            )
+            await conn.execute(
+                f'''INSERT INTO transactions_archive_summary(
+                    account_id, partition_name, period_start, period_end, credit_total, debit_total, transactions_count
+                )
+                SELECT account_id, $1, $2, $3, sum(credit), sum(debit), count(*) FROM (
+                    SELECT target_account_id AS account_id, amount AS credit, 0 AS debit FROM {name}
+                    UNION ALL
+                    SELECT source_account_id, 0, amount FROM {name} WHERE source_account_id IS NOT NULL
+                ) AS entries
+                GROUP BY account_id''',
+                name, period_start, period_end
+            )
+            await conn.execute(f'ALTER TABLE transactions DETACH PARTITION {name}')
+            await conn.execute(f'DROP TABLE {name}')
+
+        logger.info('Archived {} ({} rows) to {}', name, rows, path)
+        return {'partition': name, 'period_start': period_start, 'period_end': period_end, 'rows': rows, 'path': path}
+
+
+class ArchiveWriter:
+    # принимает csv из COPY кусками и пишет его блоками по block_rows строк, см. ARCHIVE_BLOCK_ROWS.
+    # заголовок - отдельный блок в начале файла. в строках только числа и время, кавычек и переводов строк нет
+
+    def __init__(self, file, block_rows):
+        self.file = file
+        self.block_rows = block_rows
+        # [(первый id блока, смещение блока в файле)]
+        self.index = []
+        self._header_written = False
+        self._block = None
+        self._rows = 0
+        self._tail = b''
+
+    async def write(self, chunk):
+        lines = (self._tail + chunk).split(b'\n')
+        self._tail = lines.pop()
+        for line in lines:
+            self._write_line(line + b'\n')
+
+    def _write_line(self, line):
+        if not self._header_written:
+            self._open_block().write(line)
+            self._close_block()
+            self._header_written = True
+            return
+        if self._block is None or self._rows == self.block_rows:
+            self._close_block()
+            self.index.append((int(line.split(b',', 1)[0]), self.file.tell()))
+            self._open_block()
+        self._block.write(line)
+        self._rows += 1
+
+    def _open_block(self):
+        self._block = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self._rows = 0
+        return self._block
+
+    def _close_block(self):
+        if self._block is not None:
+            self._block.close()
+            self._block = None
+
+    def close(self):
+        if self._tail:
+            self._write_line(self._tail)
+            self._tail = b''
+        self._close_block()
+
+
+def _parse_timestamp(value):
+    # postgres отбрасывает нули в конце микросекунд, fromisoformat до python 3.11 их требует
+    if '.' in value:
+        value, fraction = value.split('.')
+        value = f'{value}.{fraction.ljust(6, "0")}'
+    return datetime.fromisoformat(value)
+
+
+def _parse_amount(value):
+    # архивы до перехода на копейки хранят сумму в рублях: '10.50'
+    return to_minor_units(value) if '.' in value else int(value)
+
+
+def _archived_row(row):
+    return {
+        'id': int(row['id']),
+        'source_account_id': int(row['source_account_id']) if row['source_account_id'] else None,
+        'target_account_id': int(row['target_account_id']),
+        'amount': _parse_amount(row['amount']),
+        'ctime': _parse_timestamp(row['ctime']),
+    }
+
+
+@lru_cache(maxsize=256)
+def _read_index(path, mtime):
+    # (первые id блоков, смещения блоков). индекс файла не меняется, mtime в ключе - на случай,
+    # если архивация партиции запускалась повторно и перезаписала его
+    first_ids, offsets = [], []
+    with open(path) as file:
+        for line in file:
+            first_id, offset = line.split()
+            first_ids.append(int(first_id))
+            offsets.append(int(offset))
+    return first_ids, offsets
+
+
+def read_archived_transaction(path, transaction_id):
+    # по индексу читает один блок, в котором может быть transaction_id. архивы без индекса, записанные
+    # до него, читаются целиком. архив - холодные данные, поэтому вызывается в отдельном потоке,
+    # что бы не блокировать event loop
+    if not os.path.exists(path):
+        logger.warning('Archive file {} is missing', path)
+        return None
+
+    try:
+        first_ids, offsets = _read_index(path + '.idx', os.stat(path + '.idx').st_mtime_ns)
+    except FileNotFoundError:
+        return _scan_archive(path, transaction_id)
+
+    block = bisect_right(first_ids, transaction_id) - 1
+    if block < 0:
+        return None
+    with open(path, 'rb') as raw_file:
+        raw_file.seek(offsets[block])
+        # строки в архиве идут по возрастанию id: после большего id искать дальше нечего
+        with gzip.GzipFile(fileobj=raw_file, mode='rb') as file:
+            for values in csv.reader(line.decode() for line in file):
+                row_id = int(values[0])
+                if row_id == transaction_id:
+                    return _archived_row(dict(zip(ARCHIVE_COLUMNS, values)))
+                if row_id > transaction_id:
+                    break
+    return None
+
+
+def _scan_archive(path, transaction_id):
+    transaction_id = str(transaction_id)
+    with gzip.open(path, 'rt', newline='') as file:
+        for row in csv.DictReader(file):
+            if row['id'] == transaction_id:
+                return _archived_row(row)
+    return None
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from datetime import datetime
+
+from loguru import logger
+
+from server.exceptions import ProfilingError
+
+
+class SamplingProfiler:
+    # семплирующий профайлер, который включается и выключается на работающем процессе (POST /admin/profiling).
+    # отдельный поток раз в interval секунд снимает стек потока event loop и считает одинаковые стеки.
+    # event loop не инструментируется, поэтому цена - только GIL на время снятия стека.
+    # профиль пишется в profiling.directory в collapsed формате (строка "a;b;c <число семплов>"),
+    # его понимают flamegraph.pl и speedscope
+
+    def __init__(self, config):
+        conf = config.get('profiling', {})
+        self.enabled = conf.get('enabled', False)
+        self.directory = conf.get('directory', './profiles')
+        self.interval = conf.get('interval', 0.005)
+        # профайлер, который забыли выключить, останавливается сам через столько секунд
+        self.max_duration = conf.get('max_duration', 300)
+        self._thread = None
+        self._stop = None
+        self._started_at = None
+        self._samples = None
+        self.last_path = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def get_status(self):
+        return {
+            'running': self.running,
+            'started_at': self._started_at if self.running else None,
+            'samples': sum(self._samples.values()) if self._samples is not None else 0,
+            'path': self.last_path,
+        }
+
+    def start(self, duration=None, interval=None):
+        # вызывается из потока event loop, его стек и снимается
+        if self.running:
+            raise ProfilingError('profiler is already running')
+        duration = min(duration or self.max_duration, self.max_duration)
+        self._stop = threading.Event()
+        self._samples = Counter()
+        self._started_at = datetime.utcnow()
+        self.last_path = None
+        self._thread = threading.Thread(
+            target=self._run, args=(threading.get_ident(), interval or self.interval, duration, self._stop),
+            name='sampling-profiler', daemon=True,
+        )
+        self._thread.start()
+        return self.get_status()
+
+    def stop(self):
+        # поток дописывает файл сам, но это быстро: stop ждет его, что бы вернуть путь к профилю
+        if not self.running:
+            raise ProfilingError('profiler is not running')
+        self._stop.set()
+        self._thread.join()
+        return self.get_status()
+
+    def _run(self, thread_id, interval, duration, stop):
+        deadline = time.monotonic() + duration
+        samples = self._samples
+        while not stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{frame.f_globals.get("__name__", "?")}.{getattr(code, "co_qualname", code.co_name)}')
+                frame = frame.f_back
+            samples[';'.join(reversed(stack))] += 1
+
+        try:
+            self.last_path = self._write(samples)
+        except OSError:
+            logger.exception('Writing profile failed: ')
+
+    def _write(self, samples):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f'profile-{os.getpid()}-{self._started_at.strftime("%Y%m%dT%H%M%S")}.folded'
+        )
+        with open(path, 'w') as file:
+            for stack, count in samples.most_common():
+                file.write(f'{stack} {count}\n')
+        logger.info('Profile with {} samples written to {}', sum(samples.values()), path)
+        return os.path.abspath(path)
@@ -0,0 +1,151 @@
+import time
+import asyncio
+
+from loguru import logger
+
+from server.exceptions import ReconciliationError
+
+
+# ключ pg_advisory_lock, что бы сверки из разных процессов не шли одновременно
+RECONCILIATION_LOCK_KEY = 7209431
+
+
+class Reconciler:
+    # сверяет accounts.balance с журналом transactions. по каждому счету хранится сумма его проводок
+    # до last_transaction_id, поэтому каждый запуск читает только новые строки журнала.
+    # баланс счета должен быть равен сумме всех его проводок: зачисления с плюсом, списания с минусом
+
+    def __init__(self, db_handler, config):
+        conf = config.get('reconciliation', {})
+        self.workers = conf.get('workers', 4)
+        self.settle_timeout = conf.get('settle_timeout', 30)
+        self.db_handler = db_handler
+
+    async def run(self, full=False):
+        started_at = time.monotonic()
+        async with self.db_handler._acquire() as lock_conn:
+            if not await lock_conn.fetchval('SELECT pg_try_advisory_lock($1)', RECONCILIATION_LOCK_KEY):
+                raise ReconciliationError('another reconciliation is running')
+            try:
+                if full:
+                    # строк архивных партиций в журнале нет, пересчет начинается с их сумм по счетам
+                    await lock_conn.execute(
+                        '''TRUNCATE reconciliation_accounts;
+                        INSERT INTO reconciliation_accounts(account_id, ledger_total, last_transaction_id)
+                        SELECT account_id, sum(credit_total - debit_total), 0 FROM transactions_archive_summary
+                        GROUP BY account_id;
+                        UPDATE reconciliation_checkpoint SET last_transaction_id = 0, mtime = timezone('utc', now())'''
+                    )
+                previous = await lock_conn.fetchval('SELECT last_transaction_id FROM reconciliation_checkpoint')
+                checkpoint = await self._next_checkpoint(lock_conn, previous)
+
+                min_id, max_id = await lock_conn.fetchrow('SELECT min(id), max(id) FROM accounts')
+                ranges = self._split_range(min_id, max_id) if min_id is not None else []
+                results = await asyncio.gather(
+                    *[self._reconcile_range(previous, checkpoint, low, high) for low, high in ranges]
+                )
+
+                await lock_conn.execute(
+                    '''UPDATE reconciliation_checkpoint SET last_transaction_id = $1, mtime = timezone('utc', now())''',
+                    checkpoint
+                )
+            finally:
+                await lock_conn.execute('SELECT pg_advisory_unlock($1)', RECONCILIATION_LOCK_KEY)
+
+        drifted = sorted((account for drifted, _ in results for account in drifted), key=lambda a: a['account_id'])
+        for account in drifted:
+            logger.warning('Account {account_id} balance drifted: {balance} != {expected}', **account)
+
+        return {
+            'from_transaction_id': previous,
+            'to_transaction_id': checkpoint,
+            'ledger_rows': sum(rows for _, rows in results),
+            'seconds': round(time.monotonic() - started_at, 3),
+            'drifted': drifted,
+        }
+
+    async def _next_checkpoint(self, conn, previous):
+        # id транзакций выдаются из sequence до коммита, поэтому строка с меньшим id может стать видна
+        # позже строки с большим. если сдвинуть checkpoint через нее, она никогда не будет сверена.
+        # поэтому checkpoint - последний выданный id на момент t0, но только после того, как закончились
+        # все клиентские транзакции, начатые до t0 (у служебных процессов вроде autovacuum нет client_port).
+        # id, зарезервированные очередью переводов, тоже не проходим: транзакция с таким id появится,
+        # когда воркер проведет перевод
+        upper, t0 = await conn.fetchrow('SELECT last_value, clock_timestamp() FROM transactions_id_seq')
+
+        deadline = time.monotonic() + self.settle_timeout
+        while await conn.fetchval(
+            '''SELECT count(*) FROM pg_stat_activity
+            WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start < $1
+                AND client_port IS NOT NULL''',
+            t0
+        ):
+            if time.monotonic() > deadline:
+                raise ReconciliationError('transactions started before reconciliation did not finish in time')
+            await asyncio.sleep(0.1)
+
+        pending = await conn.fetchval("SELECT min(id) FROM transfer_requests WHERE status = 'pending'")
+        if pending is not None:
+            upper = min(upper, pending - 1)
+        return max(upper, previous)
+
+    def _split_range(self, min_id, max_id):
+        step = (max_id - min_id) // self.workers + 1
+        return [(low, min(low + step - 1, max_id)) for low in range(min_id, max_id + 1, step)]
+
+    async def _reconcile_range(self, previous, checkpoint, low, high):
+        # счета [low, high] сверяются в одном снимке базы: баланс и строки журнала, которые его изменили,
+        # видны или не видны вместе. в сохраненную сумму попадают только строки до checkpoint,
+        # а с балансом сравнивается сумма всех видимых строк
+        async with self.db_handler._acquire() as conn:
+            async with conn.transaction(isolation='repeatable_read'):
+                rows = await conn.fetch(
+                    '''WITH entries AS (
+                        SELECT id, target_account_id AS account_id, amount FROM transactions
+                        WHERE id > $1 AND target_account_id BETWEEN $3 AND $4
+                        UNION ALL
+                        SELECT id, source_account_id, -amount FROM transactions
+                        WHERE id > $1 AND source_account_id BETWEEN $3 AND $4
+                    ), deltas AS (
+                        SELECT e.account_id, count(*) AS entries,
+                            COALESCE(sum(e.amount) FILTER (WHERE e.id <= $2), 0)::bigint AS settled,
+                            sum(e.amount)::bigint AS visible
+                        FROM entries e LEFT JOIN reconciliation_accounts r USING (account_id)
+                        WHERE e.id > COALESCE(r.last_transaction_id, 0)
+                        GROUP BY e.account_id
+                    )
+                    SELECT a.id, a.balance + COALESCE((
+                            SELECT sum(balance)::bigint FROM account_balance_shards WHERE account_id = a.id
+                        ), 0) AS balance,
+                        COALESCE(r.ledger_total, 0) AS ledger_total, r.account_id IS NOT NULL AS known,
+                        COALESCE(d.entries, 0) AS entries, COALESCE(d.settled, 0) AS settled,
+                        COALESCE(d.visible, 0) AS visible
+                    FROM accounts a
+                    LEFT JOIN reconciliation_accounts r ON r.account_id = a.id
+                    LEFT JOIN deltas d ON d.account_id = a.id
+                    WHERE a.id BETWEEN $3 AND $4''',
+                    previous, checkpoint, low, high
+                )
+
+                drifted, changed = [], []
+                for row in rows:
+                    expected = row['ledger_total'] + row['visible']
+                    if row['balance'] != expected:
+                        drifted.append({
+                            'account_id': row['id'], 'balance': row['balance'], 'expected': expected,
+                            'drift': row['balance'] - expected,
+                        })
+                    if row['settled'] or not row['known']:
+                        changed.append((row['id'], row['ledger_total'] + row['settled']))
+
+                if changed:
+                    await conn.execute(
+                        '''INSERT INTO reconciliation_accounts(account_id, ledger_total, last_transaction_id)
+                        SELECT account_id, ledger_total, $3 FROM unnest($1::bigint[], $2::bigint[])
+                            AS c(account_id, ledger_total)
+                        ON CONFLICT (account_id) DO UPDATE SET ledger_total = EXCLUDED.ledger_total,
+                            last_transaction_id = EXCLUDED.last_transaction_id, mtime = timezone('utc', now())''',
+                        *zip(*changed), checkpoint
+                    )
+
+        return drifted, sum(row['entries'] for row in rows)
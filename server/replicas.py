@@ -0,0 +1,173 @@
+import asyncio
+from collections import Counter
+
+import asyncpg
+from loguru import logger
+
+
+# позиция WAL основной базы, с которой сравнивается реплика
+SQL_PRIMARY_LSN = 'SELECT pg_current_wal_lsn()'
+
+# состояние реплики: lag - насколько проигранный WAL отстает от основной базы, в секундах. реплика, которая
+# проиграла WAL до позиции основной базы $1, не отстает, иначе отставание - время с последней проигранной
+# транзакции. streaming - на реплике работает WAL receiver: отключившаяся от основной базы реплика дальше
+# не догонит, даже если пока проиграла все, что получила. status виден только с ролью pg_read_all_stats,
+# без нее достаточно того, что процесс receiver есть
+SQL_REPLICA_STATE = '''SELECT pg_is_in_recovery() AS in_recovery, pg_last_wal_replay_lsn() AS replay_lsn,
+    EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status IS NULL OR status = 'streaming') AS streaming,
+    CASE WHEN pg_last_wal_replay_lsn() >= $1::pg_lsn THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8 END AS lag'''
+
+# проиграла ли реплика WAL до позиции из токена клиента. на основной базе replay_lsn - NULL, ответ тоже NULL
+SQL_REPLICA_CAUGHT_UP = 'SELECT pg_last_wal_replay_lsn() >= $1::pg_lsn'
+
+# ошибки соединения с репликой, после которых чтение уходит на основную базу
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresConnectionError,
+                  asyncpg.exceptions.InterfaceError, asyncpg.exceptions.CannotConnectNowError)
+
+# asyncpg отдает и принимает pg_lsn числом. позиция WAL, до которой не дойдет ни одна реплика
+MAX_LSN = 2 ** 64 - 1
+
+
+def parse_lsn(text):
+    # '16/B374D848' из токена клиента -> число. ValueError, если это не позиция WAL
+    high, low = text.split('/')
+    high, low = int(high, 16), int(low, 16)
+    if not (0 <= high <= 0xFFFFFFFF and 0 <= low <= 0xFFFFFFFF):
+        raise ValueError(text)
+    return (high << 32) + low
+
+
+class Replica:
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        # реплика получает чтения, пока проверка состояния видит ее в recovery, с работающим WAL receiver
+        # и отставанием не больше max_lag
+        self.available = False
+        self.lag = None
+        # последняя известная позиция проигранного WAL, на реплике она только растет
+        self.replay_lsn = 0
+
+
+class ReplicaRouter:
+    # чтения без блокировок (счет, транзакция, история, выгрузка) расходятся по репликам из
+    # database.replicas.dsns по кругу, что бы не занимать соединения основной базы, на которых висят переводы.
+    # раз в check_interval секунд проверяется отставание каждой реплики, отстающие больше max_lag
+    # и недоступные пропускаются, пока не догонят. если подходящих реплик нет - читаем с основной базы
+
+    def __init__(self, config):
+        conf = config['database'].get('replicas', {})
+        self.replicas = [Replica(dsn) for dsn in conf.get('dsns', [])]
+        self.max_lag = conf.get('max_lag', 1.0)
+        self.check_interval = conf.get('check_interval', 1.0)
+        # reads - чтения с реплик, primary_reads - с основной базы, потому что подходящих реплик не было,
+        # behind - реплика не догнала токен клиента, not_found - не нашли на реплике и перечитали с основной
+        self.stats = Counter()
+        self._next = 0
+        self._task = None
+        self._primary = None
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    async def start(self, primary, create_pool):
+        # primary - пул основной базы, с ее позицией WAL сравниваются реплики. create_pool(dsn) - пул
+        # соединений к реплике с теми же настройками, что и к основной базе.
+        # недоступная при старте реплика не мешает запуску: проверка будет пытаться открыть пул дальше
+        self._primary = primary
+        for replica in self.replicas:
+            await self._open(replica, create_pool)
+            await self.check(replica)
+        if self.replicas:
+            self._task = asyncio.ensure_future(self._work(create_pool))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for replica in self.replicas:
+            replica.available = False
+            if replica.pool is not None:
+                await replica.pool.close()
+                replica.pool = None
+        self._primary = None
+
+    async def _open(self, replica, create_pool):
+        try:
+            replica.pool = await create_pool(replica.dsn)
+        except REPLICA_ERRORS + (asyncpg.exceptions.PostgresError,) as exc:
+            logger.warning('Replica {} is unavailable: {}', replica.dsn, exc)
+
+    async def _work(self, create_pool):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for replica in self.replicas:
+                if replica.pool is None:
+                    await self._open(replica, create_pool)
+                try:
+                    await self.check(replica)
+                except Exception:
+                    logger.exception('Replica {} check failed: ', replica.dsn)
+
+    async def check(self, replica):
+        if replica.pool is None:
+            return
+
+        # позиция основной базы берется до запроса к реплике: реплика, которая ее проиграла, не отстает
+        primary_lsn = await self._primary.fetchval(SQL_PRIMARY_LSN)
+        try:
+            async with replica.pool.acquire() as conn:
+                state = await conn.fetchrow(SQL_REPLICA_STATE, primary_lsn)
+        except REPLICA_ERRORS as exc:
+            if replica.available:
+                logger.warning('Replica {} is unavailable: {}', replica.dsn, exc)
+            replica.available, replica.lag = False, None
+            return
+
+        replica.lag = state['lag']
+        if state['replay_lsn'] is not None:
+            replica.replay_lsn = max(replica.replay_lsn, state['replay_lsn'])
+        available = (state['in_recovery'] and state['streaming'] and replica.lag is not None
+                     and replica.lag <= self.max_lag)
+        if available != replica.available:
+            logger.info('Replica {} is {}, lag {}, streaming {}', replica.dsn, 'in use' if available else 'skipped',
+                        replica.lag, state['streaming'])
+        replica.available = available
+
+    def pick(self):
+        # следующая по кругу доступная реплика или None
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if replica.available:
+                return replica
+        return None
+
+    async def caught_up(self, conn, replica, min_lsn):
+        # проиграла ли реплика запись клиента с токеном min_lsn. сначала по известной позиции,
+        # и только если она позади - спрашиваем реплику, пока клиент ждет
+        if min_lsn is None or replica.replay_lsn >= min_lsn:
+            return True
+        if await conn.fetchval(SQL_REPLICA_CAUGHT_UP, min_lsn):
+            replica.replay_lsn = max(replica.replay_lsn, min_lsn)
+            return True
+        return False
+
+    def get_stats(self):
+        return dict(self.stats, replicas=[
+            {'dsn': replica.dsn.rsplit('@', 1)[-1], 'available': replica.available, 'lag': replica.lag}
+            for replica in self.replicas
+        ])
+
+    def collect_metrics(self):
+        return [
+            ('db_replica_reads_total', 'counter', 'Reads routed by replica availability', ('result',),
+             [((name,), self.stats[name]) for name in ('reads', 'primary_reads', 'behind', 'not_found')]),
+            ('db_replica_lag_seconds', 'gauge', 'Replica replay lag, -1 if unavailable', ('replica',),
+             [((replica.dsn.rsplit('@', 1)[-1],), -1 if replica.lag is None else replica.lag)
+              for replica in self.replicas]),
+        ]
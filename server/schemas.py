@@ -1,28 +1,117 @@
 
-from decimal import Decimal
+from datetime import datetime, timezone
 
-from server.constants import ValidationErrors
+from server.constants import ValidationErrors, TransactionDirection, ExportFormat, ProfilingAction, MAX_AMOUNT
+from server.money import to_minor_units
+from server.utils import decode_cursor
 
 
 def gt_zero(field, value, error):
-    if (isinstance(value, Decimal) and value.quantize(Decimal('.00')) <= 0) or value <= 0:
+    # cerberus зовет check_with и для null, ошибку про null он добавляет сам.
+    # суммы сюда приходят уже в копейках, поэтому 0.001 - это 0
+    if value is None:
+        return
+
+    if value <= 0:
         error(field, ValidationErrors.MUST_BE_GREATER_0)
 
 
+def valid_cursor(field, value, error):
+    try:
+        decode_cursor(value)
+    except ValueError:
+        error(field, ValidationErrors.INVALID_CURSOR)
+
+
+def to_utc_datetime(value):
+    # время в базе хранится в UTC без таймзоны, время с таймзоной приводим к нему
+    value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def to_bool(value):
+    # булевы параметры из query string
+    if value in ('true', '1'):
+        return True
+    if value in ('false', '0'):
+        return False
+    raise ValueError(f'expected true or false, got {value!r}')
+
+
 CREATE_ACCOUNT = {
     'email': dict(type='string', required=True, regex=r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$')
 }
 
+# сумма в рублях -> целое число копеек. лимит баланса счета (money.max_balance) проверяет хранилище
+MONEY = dict(type='integer', coerce=to_minor_units, check_with=gt_zero, max=MAX_AMOUNT)
+
+# строка массового импорта счетов, лимит баланса проверяет AccountImporter
+IMPORT_ACCOUNT = {
+    'email': CREATE_ACCOUNT['email'],
+    'initial_balance': dict(MONEY, nullable=True),
+}
+
 ACCOUNT_PAYMENT = {
-    'amount': dict(type='decimal', required=True, coerce=Decimal, check_with=gt_zero)
+    'amount': dict(MONEY, required=True)
 }
 
 CREATE_TRANSACTION = {
     'source_account_id': dict(type='integer', required=True),
     'target_account_id': dict(type='integer', required=True),
-    'amount': dict(type='decimal', required=True, coerce=Decimal, check_with=gt_zero)
+    'amount': dict(MONEY, required=True)
 }
 
 GET_OBJECT_BY_ID = {
     'id': dict(type='integer', coerce=int, check_with=gt_zero)
 }
+
+CREATE_TRANSACTIONS_BATCH = {
+    'transfers': dict(
+        type='list', required=True, minlength=1, maxlength=10000,
+        schema=dict(type='dict', schema=CREATE_TRANSACTION)
+    )
+}
+
+ACCOUNT_TRANSACTIONS = {
+    'id': dict(type='integer', coerce=int, check_with=gt_zero),
+    'direction': dict(
+        type='string', allowed=[TransactionDirection.IN, TransactionDirection.OUT, TransactionDirection.ALL]
+    ),
+    'min_amount': MONEY,
+    'max_amount': MONEY,
+    # [from, to) по времени транзакции
+    'from': dict(type='datetime', coerce=to_utc_datetime),
+    'to': dict(type='datetime', coerce=to_utc_datetime),
+    'limit': dict(type='integer', coerce=int, min=1, max=500),
+    'cursor': dict(type='string', check_with=valid_cursor),
+}
+
+EXPORT_TRANSACTIONS = {
+    'format': dict(type='string', allowed=[ExportFormat.NDJSON, ExportFormat.CSV]),
+    'account_id': dict(type='integer', coerce=int, check_with=gt_zero),
+    'from': dict(type='datetime', coerce=to_utc_datetime),
+    'to': dict(type='datetime', coerce=to_utc_datetime),
+    # id последней полученной транзакции, выгрузка продолжится после него
+    'after_id': dict(type='integer', coerce=int, min=0),
+    'with_accounts': dict(type='boolean', coerce=to_bool),
+}
+
+# баланс счета на момент at, см. DBHandler.get_balances_at
+ACCOUNT_BALANCE = {
+    'id': dict(type='integer', coerce=int, check_with=gt_zero),
+    'at': dict(type='datetime', required=True, coerce=to_utc_datetime),
+}
+
+ACCOUNTS_BALANCES = {
+    'account_ids': dict(type='list', required=True, minlength=1, maxlength=10000, schema=dict(type='integer')),
+    'at': dict(type='datetime', required=True, coerce=to_utc_datetime),
+}
+
+PROFILING = {
+    'action': dict(type='string', required=True, allowed=[ProfilingAction.START, ProfilingAction.STOP]),
+    # сколько секунд профилировать, не больше profiling.max_duration
+    'duration': dict(type='integer', min=1, max=3600),
+    'interval_ms': dict(type='integer', min=1, max=1000),
+}
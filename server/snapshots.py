@@ -0,0 +1,167 @@
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+from server.exceptions import SnapshotError
+
+
+# ключ pg_advisory_lock, что бы снимки из разных процессов API не снимались одновременно
+SNAPSHOTS_LOCK_KEY = 7209432
+
+EPOCH = datetime(1970, 1, 1)
+
+# балансы на taken_at ($1) по строкам журнала [$2, $1) поверх строки предыдущего снимка каждого счета,
+# $2 - NULL для первого снимка. суммы архивных периодов заменяют строки отключенных партиций, если период
+# целиком внутри интервала. строки пишутся только для счетов, у которых в интервале были проводки
+SQL_TAKE_SNAPSHOT = '''WITH entries AS (
+    SELECT target_account_id AS account_id, amount FROM transactions
+    WHERE ctime >= COALESCE($2::timestamp, '-infinity') AND ctime < $1
+    UNION ALL
+    SELECT source_account_id, -amount FROM transactions
+    WHERE source_account_id IS NOT NULL AND ctime >= COALESCE($2::timestamp, '-infinity') AND ctime < $1
+    UNION ALL
+    SELECT account_id, credit_total - debit_total FROM transactions_archive_summary
+    WHERE COALESCE(period_start, '-infinity') >= COALESCE($2::timestamp, '-infinity') AND period_end <= $1
+), deltas AS (
+    SELECT account_id, sum(amount) AS delta FROM entries GROUP BY account_id
+)
+INSERT INTO account_balance_snapshots(account_id, taken_at, balance)
+SELECT d.account_id, $1, COALESCE(p.balance, 0) + d.delta FROM deltas d
+JOIN accounts a ON a.id = d.account_id
+LEFT JOIN LATERAL (
+    SELECT balance FROM account_balance_snapshots
+    WHERE account_id = d.account_id AND taken_at < $1 ORDER BY taken_at DESC LIMIT 1
+) p ON true'''
+
+
+def floor_boundary(value, interval):
+    # последняя граница снимков не позже value. границы выровнены по эпохе: при interval 86400 - полночь UTC
+    seconds = int((value - EPOCH).total_seconds()) // interval * interval
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class BalanceSnapshotter:
+    # раз в balance_snapshots.interval секунд сохраняет балансы счетов на границу интервала, по ним
+    # DBHandler.get_balances_at считает баланс на любой момент: снимок плюс строки журнала после него.
+    # первый снимок считается по всему журналу, следующие - по строкам с предыдущего снимка.
+    # пропущенные, пока API не работало, границы снимаются по очереди, но не старше retention_days
+
+    def __init__(self, db_handler, config):
+        conf = config.get('balance_snapshots', {})
+        self.interval = conf.get('interval', 86400)
+        self.retention_days = conf.get('retention_days', 400)
+        self.check_interval = conf.get('check_interval', 60)
+        self.settle_timeout = conf.get('settle_timeout', 30)
+        self.db_handler = db_handler
+        self._task = None
+
+    async def start(self, app=None):
+        self._task = asyncio.ensure_future(self._work())
+
+    async def stop(self, app=None):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _work(self):
+        while True:
+            try:
+                await self.run()
+            except SnapshotError as exc:
+                logger.warning('Balance snapshot postponed: {}', exc)
+            except Exception:
+                logger.exception('Taking balance snapshots failed: ')
+            await asyncio.sleep(self.check_interval)
+
+    async def run(self):
+        # снимает все наступившие границы после последнего снимка, возвращает их список.
+        # если снимки уже снимает другой процесс, ничего не делает
+        async with self.db_handler._acquire() as conn:
+            if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', SNAPSHOTS_LOCK_KEY):
+                return []
+            try:
+                now = await conn.fetchval("SELECT timezone('utc', clock_timestamp())")
+                latest = floor_boundary(now, self.interval)
+                cutoff = latest - timedelta(days=self.retention_days)
+
+                last = await conn.fetchval('SELECT max(taken_at) FROM balance_snapshots')
+                if last is None:
+                    boundaries = [latest]
+                else:
+                    boundary = max(floor_boundary(last, self.interval), floor_boundary(cutoff, self.interval))
+                    boundaries = []
+                    while boundary + timedelta(seconds=self.interval) <= latest:
+                        boundary += timedelta(seconds=self.interval)
+                        boundaries.append(boundary)
+
+                for taken_at in boundaries:
+                    await self._take(conn, taken_at, last)
+                    last = taken_at
+
+                if boundaries:
+                    await self._cleanup(conn, cutoff)
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', SNAPSHOTS_LOCK_KEY)
+        return boundaries
+
+    async def take(self, taken_at):
+        # снимок на произвольный момент после последнего снимка, для python -m server snapshot-balances
+        async with self.db_handler._acquire() as conn:
+            if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', SNAPSHOTS_LOCK_KEY):
+                raise SnapshotError('another snapshot is running')
+            try:
+                last = await conn.fetchval('SELECT max(taken_at) FROM balance_snapshots')
+                if last is not None and taken_at <= last:
+                    raise SnapshotError(f'snapshot at {last} is already taken')
+                return await self._take(conn, taken_at, last)
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', SNAPSHOTS_LOCK_KEY)
+
+    async def _take(self, conn, taken_at, previous):
+        # ctime строки журнала - начало ее транзакции, а видна она становится только после коммита.
+        # поэтому снимок на taken_at ждет, пока закончатся все клиентские транзакции, начатые до taken_at,
+        # иначе их строки с ctime < taken_at не попадут ни в этот снимок, ни в следующий
+        deadline = time.monotonic() + self.settle_timeout
+        while await conn.fetchval(
+            '''SELECT count(*) FROM pg_stat_activity
+            WHERE datname = current_database() AND pid <> pg_backend_pid()
+                AND xact_start < $1::timestamp AT TIME ZONE 'UTC' AND client_port IS NOT NULL''',
+            taken_at
+        ):
+            if time.monotonic() > deadline:
+                raise SnapshotError(f'transactions started before {taken_at} did not finish in time')
+            await asyncio.sleep(0.1)
+
+        started_at = time.monotonic()
+        async with conn.transaction():
+            result = await conn.execute(SQL_TAKE_SNAPSHOT, taken_at, previous)
+            accounts = int(result.rsplit(' ', 1)[-1])
+            await conn.execute(
+                'INSERT INTO balance_snapshots(taken_at, accounts) VALUES ($1, $2)', taken_at, accounts
+            )
+
+        logger.info(
+            'Balance snapshot at {}: {} accounts in {:.3f}s', taken_at, accounts, time.monotonic() - started_at
+        )
+        return {'taken_at': taken_at, 'accounts': accounts}
+
+    async def _cleanup(self, conn, cutoff):
+        # строки старше cutoff не нужны, если у счета есть более новая строка не позже cutoff:
+        # от нее считаются и снимки после cutoff, и балансы на моменты до нее (по журналу с начала).
+        # последний снимок остается всегда, от него считается следующий
+        async with conn.transaction():
+            await conn.execute(
+                '''DELETE FROM account_balance_snapshots s WHERE taken_at < $1 AND EXISTS (
+                    SELECT 1 FROM account_balance_snapshots n
+                    WHERE n.account_id = s.account_id AND n.taken_at > s.taken_at AND n.taken_at <= $1
+                )''',
+                cutoff
+            )
+            await conn.execute(
+                '''DELETE FROM balance_snapshots
+                WHERE taken_at < $1 AND taken_at < (SELECT max(taken_at) FROM balance_snapshots)''',
+                cutoff
+            )
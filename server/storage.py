@@ -0,0 +1,47 @@
+class Storage:
+    # хранилище счетов и транзакций, с которым работают хэндлеры апи: DBHandler (postgres) и MemoryStorage
+    # (память процесса и журнал в файле). семантика одна: email счета уникален, суммы и балансы - целые копейки,
+    # баланс не больше money.max_balance, id транзакций растут в порядке проведения.
+    # ошибки - исключения из server.exceptions: DuplicateAccountEmail, AccountNotFound (в переводе extra_info -
+    # поля несуществующих счетов), AccountNotEnoughtMoney, AccountBalanceExceededMaximum, TransactionNotFound.
+    # остальные методы DBHandler (история, выгрузка, очередь переводов, балансы на момент) есть только у postgres
+
+    # StorageBackend, от него зависят маршруты и фоновые задачи приложения
+    backend = None
+
+    async def start(self, app=None):
+        raise NotImplementedError
+
+    async def close(self, app=None):
+        raise NotImplementedError
+
+    async def create_account(self, email, initial_balance=None):
+        # -> счет. начальный баланс проводится как пополнение
+        raise NotImplementedError
+
+    async def drop_account(self, account_id):
+        # удаляет счет вместе с его транзакциями, используется только фабрикой счетов в тестах
+        raise NotImplementedError
+
+    async def get_account(self, account_id, min_lsn=None):
+        raise NotImplementedError
+
+    async def create_account_payment(self, account_id, amount, idempotency=None):
+        # -> счет после пополнения. с idempotency -> сохраненный ответ, см. get_idempotent_response
+        raise NotImplementedError
+
+    async def create_transaction(self, source_account_id, target_account_id, amount, idempotency=None):
+        # -> транзакция. с idempotency -> сохраненный ответ
+        raise NotImplementedError
+
+    async def get_transaction(self, transaction_id, min_lsn=None):
+        # -> транзакция со статусом
+        raise NotImplementedError
+
+    async def get_idempotent_response(self, scope, key):
+        # {'request_hash', 'status', 'response', 'expires_at'} ответа на запрос с этим ключом или None
+        raise NotImplementedError
+
+    def get_stats(self):
+        # счетчики хранилища для GET /stats
+        raise NotImplementedError
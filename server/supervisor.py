@@ -0,0 +1,113 @@
+import os
+import time
+import signal
+import multiprocessing
+
+from loguru import logger
+
+from server.app import Application
+
+
+def _serve(config, index):
+    logger.info('Starting worker {} (pid {})', index, os.getpid())
+    Application(config).run(reuse_port=True)
+
+
+class Supervisor:
+    # родительский процесс pre-fork режима: запускает http.workers процессов API, которые слушают
+    # один порт через SO_REUSEPORT (балансирует ядро), перезапускает упавшие и гасит всех по SIGTERM/SIGINT.
+    # каждый процесс поднимает свой пул соединений, общий бюджет database.max_connections делится поровну.
+    # процесс, который упал, не проработав startup_grace секунд, считается не запустившимся (база недоступна,
+    # ошибка в конфиге): его перезапуск откладывается экспоненциально, после max_start_failures таких
+    # падений подряд супервизор останавливает все процессы и выходит
+
+    check_interval = 1
+    shutdown_timeout = 30
+    startup_grace = 10
+    restart_base_delay = 1
+    restart_max_delay = 60
+    max_start_failures = 5
+
+    def __init__(self, config):
+        self.workers = config['http']['workers']
+        self.config = self.worker_config(config, self.workers)
+        # spawn, а не fork: процессы не наследуют event loop и соединения родителя
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        # index -> (время запуска, неудачных запусков подряд, когда перезапустить)
+        self._starts = {}
+        self._stopping = False
+        self.exitcode = 0
+
+    @staticmethod
+    def worker_config(config, workers):
+        # кроме пула каждый процесс держит к основной базе соединение LISTEN для инвалидации кэша,
+        # оно вычитается из доли процесса. пулы реплик открываются к репликам и в бюджет не входят
+        database_conf = dict(config['database'])
+        if database_conf.get('max_connections'):
+            listener = 1 if config.get('cache', {}).get('enabled', False) else 0
+            pool_conf = dict(database_conf.get('pool', {}))
+            pool_conf['max_size'] = max(1, database_conf['max_connections'] // workers - listener)
+            database_conf['pool'] = pool_conf
+        return dict(config, database=database_conf)
+
+    def run(self):
+        logger.info('Starting supervisor with {} workers', self.workers)
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while not self._stopping:
+            for index, process in list(self._processes.items()):
+                if not self._stopping and not process.is_alive():
+                    self._restart(index, process)
+            time.sleep(self.check_interval)
+
+        self._shutdown()
+        return self.exitcode
+
+    def _restart(self, index, process):
+        started_at, failures, restart_at = self._starts[index]
+        now = time.monotonic()
+        if restart_at is None:
+            failures = failures + 1 if now - started_at < self.startup_grace else 0
+            if failures >= self.max_start_failures:
+                logger.error('Worker {} failed to start {} times in a row, stopping', index, failures)
+                self.exitcode = 1
+                self._stopping = True
+                return
+            restart_at = now
+            if failures:
+                restart_at += min(self.restart_max_delay, self.restart_base_delay * 2 ** (failures - 1))
+            logger.warning(
+                'Worker {} exited with code {}, restarting in {:.1f}s', index, process.exitcode, restart_at - now
+            )
+            self._starts[index] = (started_at, failures, restart_at)
+        if now >= restart_at:
+            self._spawn(index, failures)
+
+    def _spawn(self, index, failures=0):
+        process = self._context.Process(target=_serve, args=(self.config, index), name=f'api-worker-{index}')
+        process.start()
+        self._processes[index] = process
+        self._starts[index] = (time.monotonic(), failures, None)
+
+    def _on_stop_signal(self, signum, frame):
+        self._stopping = True
+
+    def _shutdown(self):
+        # aiohttp в воркерах по SIGTERM дожидается текущих запросов и закрывает пул
+        logger.info('Stopping workers')
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in self._processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning('Worker {} did not stop in time, killing', process.name)
+                process.kill()
+                process.join()
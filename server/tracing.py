@@ -0,0 +1,131 @@
+import re
+import json
+import time
+from uuid import uuid4
+from contextvars import ContextVar
+
+from aiohttp import web
+from loguru import logger
+
+
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+# id трассировки, который пришел от клиента или балансировщика, берем как есть, если он похож на id
+TRACE_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# трассировка текущего HTTP запроса. ее выставляет tracing middleware, спаны пишутся в нее из любого места
+# обработки запроса: валидация, ожидание пула, запросы к базе, ожидание блокировок, сериализация ответа
+current_trace = ContextVar('current_trace', default=None)
+
+
+class Trace:
+    # спаны одного запроса: суммы по имени и первые max_spans спанов по порядку.
+    # спаны могут вкладываться друг в друга (запрос к базе внутри ожидания блокировки), суммы не складываются
+
+    __slots__ = ('trace_id', 'started_at', 'spans', 'totals', 'max_spans', 'dropped')
+
+    def __init__(self, trace_id, max_spans):
+        self.trace_id = trace_id
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.totals = {}
+        self.max_spans = max_spans
+        self.dropped = 0
+
+    def add(self, name, started_at, duration):
+        total = self.totals.get(name)
+        if total is None:
+            self.totals[name] = [1, duration]
+        else:
+            total[0] += 1
+            total[1] += duration
+        if len(self.spans) < self.max_spans:
+            self.spans.append((name, started_at - self.started_at, duration))
+        else:
+            self.dropped += 1
+
+    def to_record(self):
+        return {
+            'spans': {
+                name: {'count': count, 'ms': round(seconds * 1000, 3)}
+                for name, (count, seconds) in sorted(self.totals.items(), key=lambda item: -item[1][1])
+            },
+            # [имя, начало от начала запроса, длительность] в миллисекундах
+            'timeline': [[name, round(offset * 1000, 3), round(duration * 1000, 3)]
+                         for name, offset, duration in self.spans],
+            'dropped_spans': self.dropped,
+        }
+
+
+def record_span(name, started_at, duration):
+    # started_at - time.perf_counter() начала. вне HTTP запроса ничего не делает
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, started_at, duration)
+
+
+class span:
+    # with span('validate'): ... - время блока попадает в трассировку запроса.
+    # класс, а не contextmanager: вне запроса это один ContextVar.get, без генератора
+    # (custom_json_dumps зовется на каждую строку выгрузки)
+
+    __slots__ = ('name', 'trace', 'started_at')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.add(self.name, self.started_at, time.perf_counter() - self.started_at)
+
+
+class Tracer:
+    # каждый запрос получает id трассировки (заголовок X-Trace-Id в ответе), запросы дольше
+    # tracing.slow_request_threshold секунд пишутся в лог одной json строкой с разбивкой по спанам
+
+    def __init__(self, config):
+        conf = config.get('tracing', {})
+        self.enabled = conf.get('enabled', False)
+        self.slow_request_threshold = conf.get('slow_request_threshold', 0.5)
+        self.max_spans = conf.get('max_spans', 200)
+        self.slow_requests = 0
+
+    def middleware(self):
+        # стоит первым: время запроса включает все остальные middleware, в том числе очередь admission
+        @web.middleware
+        async def _tracing_middleware(request, handler):
+            trace_id = request.headers.get(TRACE_ID_HEADER)
+            if trace_id is None or not TRACE_ID_RE.match(trace_id):
+                trace_id = uuid4().hex
+            trace = Trace(trace_id, self.max_spans)
+            token = current_trace.set(trace)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                # у потоковых ответов (выгрузка, импорт) заголовки уже отправлены
+                if not response.prepared:
+                    response.headers[TRACE_ID_HEADER] = trace_id
+                return response
+            except web.HTTPException as exc:
+                status = exc.status_code
+                raise
+            finally:
+                current_trace.reset(token)
+                duration = time.perf_counter() - trace.started_at
+                if duration >= self.slow_request_threshold:
+                    self.slow_requests += 1
+                    resource = request.match_info.route.resource
+                    logger.warning('Slow request: {}', json.dumps({
+                        'trace_id': trace_id, 'method': request.method,
+                        'route': resource.canonical if resource is not None else 'unmatched',
+                        'path': request.path, 'status': status, 'ms': round(duration * 1000, 3),
+                        **trace.to_record(),
+                    }))
+
+        return _tracing_middleware
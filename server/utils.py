@@ -1,10 +1,14 @@
 import json
+import base64
 import datetime
 from decimal import Decimal
 
 import yaml
 from cerberus import Validator, TypeDefinition
 
+from server.validation import compile_schema, UnsupportedSchema
+from server.tracing import span
+
 
 def load_conf(path):
     with open(path) as file:
@@ -19,33 +23,66 @@ class CustomValidator(Validator):
     types_mapping['decimal'] = TypeDefinition('decimal', (Decimal,), ())
 
 
+def cerberus_validate(schema, data):
+    v = CustomValidator(schema)
+    is_valid = v.validate(data)
+    return is_valid, v.document, v.errors
+
+
 def validate(schema):
+    # схема компилируется один раз при импорте. cerberus остается запасным вариантом:
+    # для схем, которые компилятор не поддерживает, и если выключен validation.compiled в конфиге
+    try:
+        compiled = compile_schema(schema)
+    except UnsupportedSchema:
+        compiled = None
+
     def wrapper(fn):
         async def deco(_self, request):
             # для исключение рекурсивного импорта
             from server.handlers import AppHandlers
 
-            if request.method == 'GET':
-                data = dict(request.query)
-                data.update(request.match_info)
-            else:
-                try:
-                    data = await request.json()
-                except json.decoder.JSONDecodeError:
-                    data = {}
+            with span('parse_request'):
+                if request.method == 'GET':
+                    data = dict(request.query)
+                    data.update(request.match_info)
+                else:
+                    try:
+                        data = await request.json()
+                    except json.decoder.JSONDecodeError:
+                        data = {}
+                    if not isinstance(data, dict):
+                        data = {}
 
-            v = CustomValidator(schema)
-            is_valid = v.validate(data)
+            with span('validate'):
+                if compiled is not None and _self.compiled_validation:
+                    is_valid, document, errors = compiled(data)
+                else:
+                    is_valid, document, errors = cerberus_validate(schema, data)
 
             if is_valid:
-                result = await fn(_self, request, v.document)
+                result = await fn(_self, request, document)
                 return result
             else:
-                return AppHandlers.error_response(v.errors, status=422)
+                return AppHandlers.error_response(errors, status=422)
         return deco
     return wrapper
 
 
+def encode_cursor(ctime, row_id):
+    # курсор страницы - позиция последней отданной строки, для клиента это непрозрачная строка
+    return base64.urlsafe_b64encode(f'{ctime.isoformat()},{row_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # бросает ValueError, если курсор не выдавался сервером
+    try:
+        ctime, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+        return datetime.datetime.fromisoformat(ctime), int(row_id)
+    except (ValueError, UnicodeError, TypeError) as exc:
+        raise ValueError(f'invalid cursor: {exc}') from None
+
+
 def json_defaults(obj):
     if isinstance(obj, datetime.datetime):
         return obj.isoformat()
@@ -53,6 +90,7 @@ def json_defaults(obj):
         return str(obj)
 
 
-def custom_json_dumps(*args, **kwargs):
+def custom_json_dumps(obj, **kwargs):
     kwargs['default'] = json_defaults
-    return json.dumps(*args, **kwargs)
+    with span('json_dumps'):
+        return json.dumps(obj, **kwargs)
@@ -0,0 +1,194 @@
+import re
+from decimal import Decimal
+from datetime import datetime
+from collections.abc import Mapping, Sequence
+
+
+# типы, которые понимает компилятор схем. сообщения об ошибках повторяют cerberus
+TYPES = {
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: isinstance(value, int),
+    'boolean': lambda value: isinstance(value, bool),
+    'decimal': lambda value: isinstance(value, Decimal),
+    'datetime': lambda value: isinstance(value, datetime),
+    'dict': lambda value: isinstance(value, Mapping),
+    'list': lambda value: isinstance(value, Sequence) and not isinstance(value, str),
+}
+
+# правила, которые выполняются после проверки типа. cerberus выполняет их в алфавитном порядке
+CHECK_RULES = ('allowed', 'check_with', 'max', 'maxlength', 'min', 'minlength', 'regex', 'schema')
+SUPPORTED_RULES = {'type', 'required', 'nullable', 'coerce'} | set(CHECK_RULES)
+
+
+class UnsupportedSchema(Exception):
+    pass
+
+
+def compile_schema(schema):
+    # превращает cerberus схему в функцию document -> (is_valid, normalized_document, errors).
+    # ошибки и нормализация такие же как у CustomValidator, но без интерпретации схемы на каждый запрос.
+    # если в схеме есть правила, которые компилятор не знает, бросает UnsupportedSchema
+    return _compile_document(schema, nested=False)
+
+
+def _compile_document(schema, nested):
+    fields = {name: _compile_field(name, rules, nested) for name, rules in schema.items()}
+    required = [name for name, rules in schema.items() if rules.get('required')]
+
+    def validate_document(document):
+        result, errors = {}, {}
+
+        for name in required:
+            if name not in document:
+                errors[name] = ['required field']
+
+        for name, value in document.items():
+            field = fields.get(name)
+            if field is None:
+                errors[name] = ['unknown field']
+                result[name] = value
+                continue
+
+            value, field_errors = field(value)
+            result[name] = value
+            if field_errors:
+                errors[name] = field_errors
+
+        if errors:
+            # cerberus отдает ошибки отсортированными по имени поля
+            return False, result, dict(sorted(errors.items()))
+        return True, result, errors
+
+    return validate_document
+
+
+def _compile_field(name, rules, nested):
+    unsupported = set(rules) - SUPPORTED_RULES
+    if unsupported:
+        raise UnsupportedSchema(f'{name}: {", ".join(sorted(unsupported))}')
+
+    coerce = rules.get('coerce')
+    nullable = rules.get('nullable', False)
+    check_with = rules.get('check_with')
+
+    type_name = rules.get('type')
+    if type_name is not None and type_name not in TYPES:
+        raise UnsupportedSchema(f'{name}: type {type_name}')
+    type_check = TYPES.get(type_name)
+    type_error = f'must be of {type_name} type'
+
+    checks = [_compile_check(rule, rules[rule]) for rule in CHECK_RULES if rule in rules]
+
+    def validate_field(value, name=name):
+        # name передается для элементов списка, у них в ошибках вместо имени поля индекс
+        errors, coerce_error = [], None
+
+        # null в nullable поле cerberus не приводит
+        if coerce is not None and not (value is None and nullable):
+            try:
+                value = coerce(value)
+            except Exception as exc:
+                coerce_error = f"field '{name}' cannot be coerced: {exc}"
+
+        if value is None:
+            if not nullable:
+                errors.append('null value not allowed')
+            # check_with cerberus вызывает даже для null
+            if check_with is not None:
+                check_with(name, value, lambda _field, message: errors.append(message))
+        elif type_check is not None and not type_check(value):
+            errors.append(type_error)
+        else:
+            for check in checks:
+                value = check(value, errors, name)
+
+        if coerce_error is not None:
+            # у вложенных документов cerberus отдает ошибку приведения типа последней
+            if nested:
+                errors.append(coerce_error)
+            else:
+                errors.insert(0, coerce_error)
+
+        return value, errors
+
+    return validate_field
+
+
+def _compile_check(rule, constraint):
+    # каждая проверка - функция (value, errors, name) -> value, которая дописывает ошибки в errors
+    if rule == 'allowed':
+        allowed = set(constraint)
+
+        def check(value, errors, name):
+            if value not in allowed:
+                errors.append(f'unallowed value {value}')
+            return value
+
+    elif rule == 'check_with':
+        def check(value, errors, name):
+            constraint(name, value, lambda _field, message: errors.append(message))
+            return value
+
+    elif rule in ('min', 'max'):
+        compare = (lambda value: value < constraint) if rule == 'min' else (lambda value: value > constraint)
+        message = f'{rule} value is {constraint}'
+
+        def check(value, errors, name):
+            if compare(value):
+                errors.append(message)
+            return value
+
+    elif rule in ('minlength', 'maxlength'):
+        compare = (lambda value: len(value) < constraint) if rule == 'minlength' else (
+            lambda value: len(value) > constraint
+        )
+        message = f'{rule[:3]} length is {constraint}'
+
+        def check(value, errors, name):
+            if compare(value):
+                errors.append(message)
+            return value
+
+    elif rule == 'regex':
+        pattern = re.compile(constraint if constraint.endswith('$') else constraint + '$')
+        message = f"value does not match regex '{constraint}'"
+
+        def check(value, errors, name):
+            if not pattern.match(value):
+                errors.append(message)
+            return value
+
+    elif rule == 'schema':
+        check = _compile_subschema(constraint)
+
+    return check
+
+
+def _compile_subschema(constraint):
+    # schema у dict - схема вложенного документа, у list - правила для каждого элемента
+    if 'type' not in constraint and all(isinstance(rules, Mapping) for rules in constraint.values()):
+        validate_document = _compile_document(constraint, nested=True)
+
+        def check(value, errors, name):
+            is_valid, value, document_errors = validate_document(value)
+            if not is_valid:
+                errors.append(document_errors)
+            return value
+
+        return check
+
+    validate_item = _compile_field(None, constraint, nested=True)
+
+    def check(value, errors, name):
+        result, items_errors = [], {}
+        for index, item in enumerate(value):
+            item, item_errors = validate_item(item, index)
+            result.append(item)
+            if item_errors:
+                items_errors[index] = item_errors
+
+        if items_errors:
+            errors.append(items_errors)
+        return result
+
+    return check
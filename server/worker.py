@@ -0,0 +1,56 @@
+import asyncio
+
+from loguru import logger
+
+from server.exceptions import TransactionRetriesExceeded
+
+
+class TransferWorkerPool:
+    # фоновые воркеры, которые проводят переводы, поставленные в очередь через POST /transaction?mode=async.
+    # очередь лежит в базе, поэтому воркеры разных процессов разбирают ее параллельно (SKIP LOCKED)
+
+    def __init__(self, db_handler, config, describe_error):
+        conf = config.get('async_transfers', {})
+        self.workers = conf.get('workers', 4)
+        self.poll_interval = conf.get('poll_interval', 0.5)
+
+        self.db_handler = db_handler
+        self.describe_error = describe_error
+        self._wakeup_event = None
+        self._tasks = []
+
+    async def start(self, app=None):
+        self._wakeup_event = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, app=None):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wakeup(self):
+        # будим воркеры этого процесса сразу после постановки перевода в очередь, не дожидаясь poll_interval
+        if self._wakeup_event is not None:
+            self._wakeup_event.set()
+
+    async def _work(self):
+        while True:
+            try:
+                processed = await self.db_handler.process_transfer_request(self.describe_error)
+            except TransactionRetriesExceeded:
+                # перевод остался в очереди, его подберут на следующей итерации
+                processed = False
+            except Exception:
+                logger.exception('Transfer worker error: ')
+                processed = False
+
+            if not processed:
+                await self._wait()
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wakeup_event.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup_event.clear()
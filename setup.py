@@ -14,7 +14,7 @@ setup(
     packages=find_packages(exclude=['tests']),
     long_description=open(os.path.join(os.path.dirname(__file__), 'README.md')).read(),
     install_requires=load_requires(),
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'run_api = server.__main__:main'
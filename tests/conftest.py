@@ -6,22 +6,51 @@ from decimal import Decimal
 import pytest
 
 from server.app import Application
-from server.handlers import DBHandler
+from server.handlers import create_storage
+from server.constants import StorageBackend
+from server.money import to_minor_units
 from server.utils import load_conf
 
 
+STORAGE_BACKENDS = [StorageBackend.POSTGRES, StorageBackend.MEMORY]
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'postgres: test uses what only the postgres storage has')
+
+
+def pytest_generate_tests(metafunc):
+    # тесты с cli, db_handler и account_factory проходят на каждом хранилище, помеченные postgres - только на базе
+    if 'storage_backend' in metafunc.fixturenames:
+        postgres_only = metafunc.definition.get_closest_marker('postgres') is not None
+        metafunc.parametrize('storage_backend', [StorageBackend.POSTGRES] if postgres_only else STORAGE_BACKENDS)
+
+
 @pytest.fixture
-def cli(loop, aiohttp_client):
+def storage_conf(storage_backend):
     conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
-    app = Application(conf).webapp
+    conf['storage'] = {'backend': storage_backend}
+    return conf
+
+
+@pytest.fixture
+def cli(loop, aiohttp_client, storage_conf, db_handler):
+    # приложение работает с тем же хранилищем, что и фабрика счетов: у хранилища в памяти нет общей базы,
+    # а для postgres в тесте открывается один пул, а не по пулу на фабрику и приложение
+    app = Application(storage_conf, storage=db_handler).webapp
     return loop.run_until_complete(aiohttp_client(app))
 
 
-@pytest.fixture(scope="function")
-def account_factory(loop):
-    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
-    db_handler = DBHandler(conf)
+@pytest.fixture
+def db_handler(loop, storage_conf):
+    db_handler = create_storage(storage_conf)
+    loop.run_until_complete(db_handler.start())
+    yield db_handler
+    loop.run_until_complete(db_handler.close())
+
 
+@pytest.fixture(scope="function")
+def account_factory(loop, db_handler):
     account_ids = []
 
     async def _account_factory(email=None, initial_balance=None):
@@ -29,6 +58,9 @@ def account_factory(loop):
         if not email:
             email = f'test_account_{str(uuid4())}@test.com'
 
+        # initial_balance в рублях, как в запросах к апи
+        if initial_balance is not None:
+            initial_balance = to_minor_units(initial_balance)
         account_data = await db_handler.create_account(email, initial_balance)
         account_ids.append(account_data['id'])
         return account_data
@@ -1,8 +1,13 @@
+import json
 import uuid
+import asyncio
 
 import pytest
 
 from conftest import decimal_to_str
+from server.app import Application
+from server.handlers import DBHandler
+from server.exceptions import AccountBalanceExceededMaximum
 
 
 async def test_create_account_success(cli):
@@ -92,3 +97,223 @@ async def test_get_account_fail(cli, account_factory, account_id, http_status):
     response = await resp.json()
     assert response['success'] is False
     assert 'id' in response['error']
+
+
+@pytest.mark.postgres
+async def test_sharded_account_balance(cli, account_factory, db_handler):
+    hot_account = await account_factory(initial_balance=10)
+    other_account = await account_factory(initial_balance=100)
+
+    sharded = await db_handler.enable_balance_sharding(hot_account['id'], 4)
+    assert sharded['balance'] == hot_account['balance']
+
+    resp = await cli.post(f"/account/{hot_account['id']}/payment", json={'amount': 5})
+    assert (await resp.json())['data']['balance'] == decimal_to_str(15)
+
+    for amount in (20, 30):
+        payload = {'source_account_id': other_account['id'], 'target_account_id': hot_account['id'], 'amount': amount}
+        resp = await cli.post('/transaction', json=payload)
+        assert resp.status == 200
+
+    # списание больше, чем лежит в любом отдельном слоте - деньги занимаются у соседних слотов
+    payload = {'source_account_id': hot_account['id'], 'target_account_id': other_account['id'], 'amount': 60}
+    resp = await cli.post('/transaction', json=payload)
+    assert resp.status == 200
+
+    payload['amount'] = 6
+    resp = await cli.post('/transaction', json=payload)
+    assert resp.status == 422
+    assert 'source_account_id' in (await resp.json())['error']
+
+    resp = await cli.get(f"/account/{hot_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(5)
+
+    transfers = [
+        {'source_account_id': hot_account['id'], 'target_account_id': other_account['id'], 'amount': 5},
+        {'source_account_id': hot_account['id'], 'target_account_id': other_account['id'], 'amount': 1},
+    ]
+    resp = await cli.post('/transactions/batch', json={'transfers': transfers})
+    assert [r['success'] for r in (await resp.json())['data']] == [True, False]
+
+    resp = await cli.get(f"/account/{hot_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(0)
+
+
+@pytest.mark.postgres
+async def test_sharded_account_max_balance(cli, account_factory, db_handler):
+    # money.max_balance действует на сумму всех слотов, а не на каждый слот
+    hot_account = await account_factory(initial_balance='999990')
+    other_account = await account_factory(initial_balance=100)
+    await db_handler.enable_balance_sharding(hot_account['id'], 4)
+
+    # помещается в один слот
+    resp = await cli.post(f"/account/{hot_account['id']}/payment", json={'amount': 1})
+    assert resp.status == 200
+
+    resp = await cli.post(f"/account/{hot_account['id']}/payment", json={'amount': 20})
+    assert resp.status == 422
+    with pytest.raises(AccountBalanceExceededMaximum):
+        await db_handler.create_account_payment(hot_account['id'], 2000)
+
+    payload = {'source_account_id': other_account['id'], 'target_account_id': hot_account['id'], 'amount': 20}
+    resp = await cli.post('/transaction', json=payload)
+    assert resp.status == 422
+    assert 'amount' in (await resp.json())['error']
+
+    # не помещается ни в один слот, раскладывается по нескольким ровно до лимита
+    transfers = [
+        {'source_account_id': other_account['id'], 'target_account_id': hot_account['id'], 'amount': 8.99},
+        {'source_account_id': other_account['id'], 'target_account_id': hot_account['id'], 'amount': 0.01},
+    ]
+    resp = await cli.post('/transactions/batch', json={'transfers': transfers})
+    assert [r['success'] for r in (await resp.json())['data']] == [True, False]
+
+    resp = await cli.get(f"/account/{hot_account['id']}")
+    assert (await resp.json())['data']['balance'] == '999999.99'
+
+
+@pytest.mark.postgres
+async def test_account_cache_invalidation(aiohttp_client, account_factory, storage_conf):
+    # кэш выключен по умолчанию
+    conf = dict(storage_conf, cache={'enabled': True})
+    db_handler = DBHandler(conf)
+    other_handler = DBHandler(conf)
+    await db_handler.start()
+    await other_handler.start()
+    cli = await aiohttp_client(Application(conf, storage=db_handler).webapp)
+    try:
+        account_data = await account_factory(initial_balance=1)
+
+        resp = await cli.get(f"/account/{account_data['id']}")
+        assert (await resp.json())['data']['balance'] == decimal_to_str(1)
+
+        # изменение из другого DBHandler (как из другого процесса) приходит в кэш приложения через NOTIFY
+        await other_handler.create_account_payment(account_data['id'], 200)
+
+        for _ in range(50):
+            resp = await cli.get(f"/account/{account_data['id']}")
+            balance = (await resp.json())['data']['balance']
+            if balance != decimal_to_str(1):
+                break
+            await asyncio.sleep(0.05)
+
+        assert balance == decimal_to_str(3)
+    finally:
+        # фоновые задачи приложения останавливаются до закрытия пула
+        await cli.close()
+        await other_handler.close()
+        await db_handler.close()
+
+
+@pytest.mark.postgres
+async def test_pool_warmup(cli, db_handler):
+    # все min_size соединений открыты при старте, до первого запроса к api
+    pool = db_handler.db_pool
+    assert pool.get_min_size() > 0
+    assert pool.get_size() == pool.get_min_size()
+
+    resp = await cli.get('/stats')
+    assert resp.status == 200
+
+    pool_stats = (await resp.json())['data']['pool']
+    # воркеры очереди переводов сразу после старта берут соединения, поэтому in_use не проверяется
+    assert pool_stats['size'] == pool_stats['min_size']
+
+
+@pytest.mark.postgres
+async def test_account_transactions_history(cli, account_factory):
+    account = await account_factory(initial_balance=100)
+    other_account = await account_factory(initial_balance=100)
+
+    await cli.post(f'/account/{account["id"]}/payment', json={'amount': 5})
+    transaction_ids = []
+    for amount, (source, target) in zip([1, 2, 3, 4, 5], [(account, other_account), (other_account, account)] * 3):
+        resp = await cli.post('/transaction', json={
+            'source_account_id': source['id'], 'target_account_id': target['id'], 'amount': amount
+        })
+        transaction_ids.append((await resp.json())['data']['id'])
+
+    # листаем по 2, от новых к старым
+    pages, cursor = [], None
+    while True:
+        params = {'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        resp = await cli.get(f'/account/{account["id"]}/transactions', params=params)
+        assert resp.status == 200
+        data = (await resp.json())['data']
+        pages.append(data['transactions'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    history = [transaction for page in pages for transaction in page]
+    assert [t['id'] for t in history[:5]] == transaction_ids[::-1]
+    # пополнение и начальный баланс
+    assert [t['source_account_id'] for t in history[5:]] == [None, None]
+
+    resp = await cli.get(f'/account/{account["id"]}/transactions', params={'direction': 'out', 'min_amount': '2'})
+    transactions = (await resp.json())['data']['transactions']
+    assert [t['amount'] for t in transactions] == ['5.00', '3.00']
+
+    resp = await cli.get(f'/account/{account["id"]}/transactions', params={'to': '2000-01-01T00:00:00'})
+    assert (await resp.json())['data'] == {'transactions': [], 'next_cursor': None, 'archived_periods': []}
+
+
+@pytest.mark.parametrize("params,http_status", [
+    ({}, 404), ({'cursor': 'test'}, 422), ({'direction': 'up'}, 422), ({'limit': 0}, 422), ({'from': 'x'}, 422)
+])
+@pytest.mark.postgres
+async def test_account_transactions_history_fail(cli, account_factory, params, http_status):
+    account_id = 9999999 if http_status == 404 else (await account_factory())['id']
+
+    resp = await cli.get(f'/account/{account_id}/transactions', params=params)
+    assert resp.status == http_status
+
+
+async def _import_accounts(cli, body, import_format):
+    resp = await cli.post(f'/accounts/import?format={import_format}', data=body)
+    assert resp.status == 200
+    lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+    return lines[:-1], lines[-1]['summary']
+
+
+@pytest.mark.postgres
+async def test_import_accounts(cli, account_factory, db_handler):
+    existing = await account_factory()
+    emails = [f'test_import_{uuid.uuid4()}@test.com' for _ in range(2)]
+    body = '\n'.join([
+        'email,initial_balance',
+        f'{emails[0]},10.50',
+        f"{existing['email']},5",
+        'not an email,1',
+        f'{emails[1]}',
+        f'{emails[0]},3',
+        f'test_import_{uuid.uuid4()}@test.com,1000000',
+    ])
+
+    results, summary = await _import_accounts(cli, body, 'csv')
+    created_ids = [result['id'] for result in results if result['status'] == 'created']
+    try:
+        assert [result['status'] for result in results] == [
+            'created', 'duplicate', 'invalid', 'created', 'duplicate', 'invalid'
+        ]
+        assert [result['line'] for result in results] == [2, 3, 4, 5, 6, 7]
+        assert summary == {'created': 2, 'duplicate': 2, 'invalid': 2}
+        assert 'email' in results[2]['error']
+        # лимит баланса из money.max_balance
+        assert results[5]['error'] == {'initial_balance': ['max value is 999999.99']}
+
+        resp = await cli.get(f"/account/{results[0]['id']}")
+        assert (await resp.json())['data']['balance'] == decimal_to_str(10.5)
+        resp = await cli.get(f"/account/{results[3]['id']}")
+        assert (await resp.json())['data']['balance'] == decimal_to_str(0)
+
+        # повторный импорт ничего не создает
+        body = '\n'.join(json.dumps({'email': email}) for email in emails) + '\n[]'
+        results, summary = await _import_accounts(cli, body, 'ndjson')
+        assert summary == {'created': 0, 'duplicate': 2, 'invalid': 1}
+    finally:
+        for account_id in created_ids:
+            await db_handler.drop_account(account_id)
@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from server.app import Application
+from server.admission import AdmissionGate, request_deadline
+from server.exceptions import RequestRejected
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+@pytest.fixture
+def admission_cli(loop, aiohttp_client):
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['admission'] = {'enabled': True, 'retry_after': 2, 'writes': {'max_concurrent': 1, 'max_queue': 1, 'deadline': 0.5}}
+    return loop.run_until_complete(aiohttp_client(Application(conf).webapp))
+
+
+async def test_gate_queue():
+    gate = AdmissionGate('writes', {'max_concurrent': 1, 'max_queue': 1})
+    deadline = time.monotonic() + 1
+
+    await gate.acquire(deadline)
+    waiter = asyncio.ensure_future(gate.acquire(deadline))
+    await asyncio.sleep(0)
+    # место в очереди одно, следующий получает отказ сразу
+    with pytest.raises(RequestRejected):
+        await gate.acquire(deadline)
+
+    # слот переходит к ожидающему
+    gate.release()
+    await waiter
+    assert gate.active == 1
+
+    # не дождался очереди до дедлайна
+    with pytest.raises(RequestRejected):
+        await gate.acquire(time.monotonic() + 0.05)
+    gate.release()
+    assert gate.active == 0
+    assert gate.get_stats() == {
+        'admitted': 2, 'queued': 2, 'queue_full': 1, 'queue_timeout': 1, 'active': 0, 'queued_now': 0
+    }
+
+
+async def test_statement_deadline(db_handler):
+    token = request_deadline.set(time.monotonic() + 0.2)
+    try:
+        async with db_handler._acquire() as conn:
+            started_at = time.monotonic()
+            with pytest.raises(RequestRejected):
+                await conn.fetchval('SELECT pg_sleep($1)', 5)
+            assert time.monotonic() - started_at < 1
+            # запрос отменен в базе, соединение можно использовать дальше
+            request_deadline.set(None)
+            assert await conn.fetchval('SELECT 1') == 1
+
+        # дедлайн уже прошел, соединение даже не берется из пула
+        request_deadline.set(time.monotonic() - 1)
+        with pytest.raises(RequestRejected):
+            async with db_handler._acquire():
+                pass
+    finally:
+        request_deadline.reset(token)
+
+
+async def test_overload_rejected(admission_cli, db_handler, account_factory):
+    account = await account_factory(initial_balance=10)
+
+    # счет залочен, пополнения ждут блокировку
+    async with db_handler._acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('SELECT 1 FROM accounts WHERE id = $1 FOR UPDATE', account['id'])
+
+            payments = [
+                asyncio.ensure_future(admission_cli.post(f'/account/{account["id"]}/payment', json={'amount': 1}))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0.1)
+            # один в работе, один в очереди, третий сразу получает 503
+            done = [payment for payment in payments if payment.done()]
+            assert len(done) == 1
+            resp = done[0].result()
+            assert resp.status == 503
+            assert resp.headers['Retry-After'] == '2'
+            assert await resp.json() == {'success': False, 'error': 'try again later'}
+
+            # чтения ограничиваются отдельно и не стоят в очереди за записями
+            resp = await admission_cli.get(f'/account/{account["id"]}')
+            assert resp.status == 200
+
+            # первое пополнение не дождалось блокировки до дедлайна, второе - очереди
+            for payment in payments:
+                assert (await payment).status == 503
+
+    assert (await db_handler.get_account(account['id']))['balance'] == 1000
+
+    resp = await admission_cli.get('/stats')
+    stats = (await resp.json())['data']['admission']['writes']
+    # ожидавший в очереди может получить слот впритык к дедлайну и отказать уже на запросе к базе
+    assert (stats['queue_full'], stats['queue_timeout'] + stats['deadline'], stats['active']) == (1, 2, 0)
@@ -0,0 +1,101 @@
+import os
+import gzip
+from datetime import datetime
+
+import pytest
+
+from server.partitions import Archiver, ArchiveWriter, read_archived_transaction
+from server.reconciliation import Reconciler
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+async def test_archive_blocks(tmp_path):
+    path = str(tmp_path / 'archive.csv.gz')
+    rows = [f'{i},1,2,{i * 100},2001-01-15 10:00:00' for i in range(1, 50, 2)]
+    data = ('id,source_account_id,target_account_id,amount,ctime\n' + '\n'.join(rows) + '\n').encode()
+
+    with open(path, 'wb') as file:
+        writer = ArchiveWriter(file, block_rows=10)
+        # куски COPY режут строки где угодно
+        for start in range(0, len(data), 7):
+            await writer.write(data[start:start + 7])
+        writer.close()
+    with open(path + '.idx', 'w') as file:
+        file.writelines(f'{first_id} {offset}\n' for first_id, offset in writer.index)
+
+    assert [first_id for first_id, _ in writer.index] == [1, 21, 41]
+    # файл целиком - обычный gzip
+    with gzip.open(path, 'rb') as file:
+        assert file.read() == data
+
+    for transaction_id in (1, 19, 21, 49):
+        assert read_archived_transaction(path, transaction_id)['amount'] == transaction_id * 100
+    for transaction_id in (0, 2, 20, 50):
+        assert read_archived_transaction(path, transaction_id) is None
+
+    # архив без индекса читается целиком
+    os.remove(path + '.idx')
+    assert read_archived_transaction(path, 21)['amount'] == 2100
+    assert read_archived_transaction(path, 20) is None
+
+
+async def test_archive_partition(cli, account_factory, db_handler, tmp_path):
+    async with db_handler._acquire() as conn:
+        if await conn.fetchval("SELECT to_regclass('transactions_legacy') IS NOT NULL"):
+            pytest.skip('transactions_legacy covers old months')
+
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['archive'] = {'directory': str(tmp_path)}
+
+    source_account = await account_factory(initial_balance=100)
+    target_account = await account_factory()
+
+    # перевод, проведенный давно, в своей месячной партиции
+    async with db_handler._acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                '''CREATE TABLE transactions_p2001_01 PARTITION OF transactions
+                FOR VALUES FROM ('2001-01-01') TO ('2001-02-01')'''
+            )
+            old_transaction_id = await conn.fetchval(
+                '''INSERT INTO transactions(source_account_id, target_account_id, amount, ctime)
+                VALUES ($1, $2, 1000, '2001-01-15 10:00:00.12') RETURNING id''',
+                source_account['id'], target_account['id']
+            )
+            await conn.execute('UPDATE accounts SET balance = balance - 1000 WHERE id = $1', source_account['id'])
+            await conn.execute('UPDATE accounts SET balance = balance + 1000 WHERE id = $1', target_account['id'])
+
+    await Reconciler(db_handler, conf).run()
+    try:
+        archived = await Archiver(db_handler, conf).archive(datetime(2001, 2, 1))
+        assert [(a['partition'], a['rows']) for a in archived] == [('transactions_p2001_01', 1)]
+        assert os.path.exists(tmp_path / 'transactions_p2001_01.csv.gz')
+        assert os.path.exists(tmp_path / 'transactions_p2001_01.csv.gz.idx')
+
+        resp = await cli.get(f'/transaction/{old_transaction_id}')
+        assert resp.status == 200
+        response = await resp.json()
+        assert response['data']['amount'] == '10.00'
+        assert response['data']['ctime'] == '2001-01-15T10:00:00.120000'
+        assert response['data']['status'] == 'completed'
+
+        resp = await cli.get(f'/account/{target_account["id"]}/transactions')
+        data = (await resp.json())['data']
+        assert data['transactions'] == []
+        assert data['archived_periods'][0]['credit_total'] == '10.00'
+        assert data['archived_periods'][0]['debit_total'] == '0.00'
+
+        # полный пересчет сверки начинается с сумм архивных периодов
+        report = await Reconciler(db_handler, conf).run(full=True)
+        drifted = {account['account_id'] for account in report['drifted']}
+        assert not drifted & {source_account['id'], target_account['id']}
+    finally:
+        async with db_handler._acquire() as conn:
+            await conn.execute(
+                '''DELETE FROM transactions_archive_summary WHERE partition_name = 'transactions_p2001_01';
+                DELETE FROM transactions_archives WHERE partition_name = 'transactions_p2001_01';
+                DROP TABLE IF EXISTS transactions_p2001_01'''
+            )
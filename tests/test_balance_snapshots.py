@@ -0,0 +1,135 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from server.exceptions import AccountNotFound, BalanceHistoryArchived, SnapshotError
+from server.snapshots import BalanceSnapshotter, floor_boundary
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+@pytest.fixture
+def snapshotter(loop, db_handler):
+    # снимки общие для всей базы, тест начинает с чистых таблиц
+    async def _truncate():
+        async with db_handler._acquire() as conn:
+            await conn.execute('TRUNCATE account_balance_snapshots, balance_snapshots')
+
+    loop.run_until_complete(_truncate())
+    return BalanceSnapshotter(db_handler, load_conf(os.path.join(os.getcwd(), 'config.yml')))
+
+
+async def ledger_times(db_handler, account_id):
+    async with db_handler._acquire() as conn:
+        return [row['ctime'] for row in await conn.fetch(
+            'SELECT ctime FROM transactions WHERE source_account_id = $1 OR target_account_id = $1 ORDER BY ctime',
+            account_id
+        )]
+
+
+def test_floor_boundary():
+    assert floor_boundary(datetime(2026, 10, 18, 13, 45), 86400) == datetime(2026, 10, 18)
+    assert floor_boundary(datetime(2026, 10, 18), 86400) == datetime(2026, 10, 18)
+    assert floor_boundary(datetime(2026, 10, 18, 13, 45), 3600) == datetime(2026, 10, 18, 13)
+
+
+async def test_balance_at(db_handler, snapshotter, account_factory):
+    source = await account_factory(initial_balance=100)
+    target = await account_factory()
+    await db_handler.create_account_payment(source['id'], 5000)
+    await db_handler.create_transaction(source['id'], target['id'], 3000)
+    created, paid, transferred = await ledger_times(db_handler, source['id'])
+
+    # первый снимок - по всему журналу, видит только начальный баланс
+    assert (await snapshotter.take(paid))['accounts'] >= 1
+    await db_handler.create_account_payment(source['id'], 1000)
+    # следующий - по строкам после первого, у target это первая строка снимка
+    second = transferred + timedelta(microseconds=1)
+    await snapshotter.take(second)
+    with pytest.raises(SnapshotError):
+        await snapshotter.take(paid)
+
+    async with db_handler._acquire() as conn:
+        rows = await conn.fetch(
+            'SELECT account_id, taken_at, balance FROM account_balance_snapshots WHERE account_id = ANY($1)',
+            [source['id'], target['id']]
+        )
+    assert sorted((r['account_id'], r['taken_at'], r['balance']) for r in rows) == [
+        (source['id'], paid, 10000), (source['id'], second, 12000), (target['id'], second, 3000),
+    ]
+
+    # баланс на момент at - проводки строго до него
+    for at, source_balance, target_balance in [
+        (created, 0, 0),
+        (paid, 100, 0),
+        (transferred, 150, 0),
+        (second, 120, 30),
+        (datetime.utcnow() + timedelta(days=1), 130, 30),
+    ]:
+        assert await db_handler.get_balance_at(source['id'], at) == source_balance * 100
+        assert await db_handler.get_balance_at(target['id'], at) == target_balance * 100
+
+    with pytest.raises(AccountNotFound):
+        await db_handler.get_balance_at(999999999, paid)
+
+
+async def test_balance_at_archived(db_handler, snapshotter, account_factory):
+    account = await account_factory(initial_balance=100)
+    created, = await ledger_times(db_handler, account['id'])
+    await snapshotter.take(created + timedelta(microseconds=1))
+
+    async with db_handler._acquire() as conn:
+        await conn.execute(
+            '''INSERT INTO transactions_archives(partition_name, period_start, period_end, min_id, max_id, rows, path)
+            VALUES ('transactions_p2001_01', '2001-01-01', '2001-02-01', 0, 0, 0, '/dev/null')'''
+        )
+    try:
+        # строки внутри архивного месяца не посчитать, а весь месяц - сумма архива
+        with pytest.raises(BalanceHistoryArchived):
+            await db_handler.get_balance_at(account['id'], datetime(2001, 1, 15))
+        assert await db_handler.get_balance_at(account['id'], datetime(2001, 2, 1)) == 0
+        # от снимка после архивного месяца считается как обычно
+        assert await db_handler.get_balance_at(account['id'], datetime.utcnow() + timedelta(days=1)) == 10000
+    finally:
+        async with db_handler._acquire() as conn:
+            await conn.execute("DELETE FROM transactions_archives WHERE partition_name = 'transactions_p2001_01'")
+
+
+async def test_snapshots_run(db_handler, snapshotter, account_factory):
+    account = await account_factory(initial_balance=100)
+
+    # первый запуск снимает только последнюю границу, следующий до новой границы - ничего
+    taken = await snapshotter.run()
+    assert len(taken) == 1 and taken[0] == floor_boundary(taken[0], snapshotter.interval)
+    assert await snapshotter.run() == []
+
+    # пропущенные границы снимаются по очереди от последнего снимка
+    async with db_handler._acquire() as conn:
+        await conn.execute('UPDATE balance_snapshots SET taken_at = taken_at - interval \'3 days\'')
+        await conn.execute('UPDATE account_balance_snapshots SET taken_at = taken_at - interval \'3 days\'')
+    assert await snapshotter.run() == [taken[0] - timedelta(days=2), taken[0] - timedelta(days=1), taken[0]]
+    assert await db_handler.get_balance_at(account['id'], datetime.utcnow() + timedelta(days=1)) == 10000
+
+
+async def test_balance_api(cli, account_factory):
+    account = await account_factory(initial_balance=100)
+    at = (datetime.utcnow() + timedelta(days=1)).isoformat()
+
+    resp = await cli.get(f'/account/{account["id"]}/balance', params={'at': at + '+00:00'})
+    assert resp.status == 200
+    assert (await resp.json())['data'] == {'account_id': account['id'], 'at': at, 'balance': '100.00'}
+
+    resp = await cli.get(f'/account/{account["id"]}/balance')
+    assert resp.status == 422
+    resp = await cli.get('/account/999999999/balance', params={'at': at})
+    assert resp.status == 404
+
+    resp = await cli.post('/accounts/balances', json={'account_ids': [account['id'], 999999999], 'at': at})
+    assert resp.status == 200
+    assert (await resp.json())['data'] == [
+        {'success': True, 'data': {'account_id': account['id'], 'at': at, 'balance': '100.00'}},
+        {'success': False, 'error': {'id': 'not found'}},
+    ]
@@ -0,0 +1,78 @@
+import os
+import asyncio
+
+import pytest
+
+from server.app import Application
+from server.handlers import DBHandler
+from server.exceptions import AccountNotEnoughtMoney, AccountNotFound
+from server.utils import load_conf
+from conftest import decimal_to_str
+
+
+pytestmark = pytest.mark.postgres
+
+
+def _group_commit_conf():
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['database']['group_commit'] = {'enabled': True, 'window': 0.05, 'max_batch': 8}
+    return conf
+
+
+@pytest.fixture
+def group_db_handler(loop):
+    db_handler = DBHandler(_group_commit_conf())
+    loop.run_until_complete(db_handler.start())
+    yield db_handler
+    loop.run_until_complete(db_handler.close())
+
+
+async def test_group_commit(group_db_handler, account_factory):
+    accounts = [await account_factory(initial_balance=10) for _ in range(4)]
+    ids = [account['id'] for account in accounts]
+
+    results = await asyncio.gather(
+        group_db_handler.create_transaction(ids[0], ids[1], 300),
+        group_db_handler.create_transaction(ids[1], ids[2], 10000),
+        group_db_handler.create_account_payment(ids[3], 500),
+        group_db_handler.create_transaction(ids[2], 999999999, 100),
+        group_db_handler.create_transaction(ids[3], ids[0], 1500),
+        return_exceptions=True
+    )
+
+    # ошибка одной записи не откатывает остальные записи группы
+    assert results[0]['amount'] == 300
+    assert isinstance(results[1], AccountNotEnoughtMoney)
+    assert results[2]['balance'] == 1500
+    assert isinstance(results[3], AccountNotFound)
+    assert results[4]['amount'] == 1500
+    assert group_db_handler.group_committer.stats['groups'] == 1
+    assert group_db_handler.group_committer.stats['writes'] == 5
+
+    balances = [(await group_db_handler.get_account(account_id))['balance'] for account_id in ids]
+    assert balances == [2200, 1300, 1000, 0]
+
+
+async def test_group_commit_max_batch(group_db_handler, account_factory):
+    source = await account_factory(initial_balance=100)
+    target = await account_factory()
+
+    await asyncio.gather(*[
+        group_db_handler.create_transaction(source['id'], target['id'], 100) for _ in range(20)
+    ])
+    # группы по max_batch отправляются не дожидаясь окна
+    assert group_db_handler.group_committer.stats['groups'] == 3
+    assert (await group_db_handler.get_account(target['id']))['balance'] == 2000
+
+
+async def test_group_commit_api(aiohttp_client, account_factory):
+    cli = await aiohttp_client(Application(_group_commit_conf()).webapp)
+    account = await account_factory()
+
+    resps = await asyncio.gather(*[
+        cli.post(f"/account/{account['id']}/payment", json={'amount': 1}) for _ in range(5)
+    ])
+    assert [resp.status for resp in resps] == [200] * 5
+
+    resp = await cli.get(f"/account/{account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(5)
@@ -0,0 +1,96 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from conftest import decimal_to_str
+
+
+async def test_payment_replay(cli, account_factory):
+    account = await account_factory(initial_balance=10)
+    headers = {'Idempotency-Key': str(uuid4())}
+
+    responses = []
+    for _ in range(3):
+        resp = await cli.post(f"/account/{account['id']}/payment", json={'amount': 5}, headers=headers)
+        assert resp.status == 200
+        responses.append(await resp.json())
+
+    assert responses[0] == responses[1] == responses[2]
+    assert responses[0]['data']['balance'] == decimal_to_str(15)
+
+    resp = await cli.get(f"/account/{account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(15)
+
+
+async def test_concurrent_transaction_duplicates(cli, account_factory):
+    source_account = await account_factory(initial_balance=10)
+    target_account = await account_factory()
+
+    payload = {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 3}
+    headers = {'Idempotency-Key': str(uuid4())}
+    resps = await asyncio.gather(*(cli.post('/transaction', json=payload, headers=headers) for _ in range(5)))
+    assert all(resp.status == 200 for resp in resps)
+
+    responses = [await resp.json() for resp in resps]
+    assert len({response['data']['id'] for response in responses}) == 1
+
+    resp = await cli.get(f"/account/{source_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(7)
+
+
+async def test_error_response_replay(cli, account_factory):
+    source_account = await account_factory(initial_balance=1)
+    target_account = await account_factory()
+
+    payload = {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 3}
+    headers = {'Idempotency-Key': str(uuid4())}
+    resp = await cli.post('/transaction', json=payload, headers=headers)
+    assert resp.status == 422
+    assert 'source_account_id' in (await resp.json())['error']
+
+    # ответ сохранен вместе с ключом: пополнение счета не меняет результат повтора
+    await cli.post(f"/account/{source_account['id']}/payment", json={'amount': 10})
+    resp = await cli.post('/transaction', json=payload, headers=headers)
+    assert resp.status == 422
+
+    resp = await cli.get(f"/account/{source_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(11)
+
+
+async def test_key_reused_with_another_request(cli, account_factory):
+    account = await account_factory()
+    headers = {'Idempotency-Key': str(uuid4())}
+
+    resp = await cli.post(f"/account/{account['id']}/payment", json={'amount': 5}, headers=headers)
+    assert resp.status == 200
+
+    resp = await cli.post(f"/account/{account['id']}/payment", json={'amount': 6}, headers=headers)
+    assert resp.status == 422
+    assert 'Idempotency-Key' in (await resp.json())['error']
+
+    resp = await cli.get(f"/account/{account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(5)
+
+
+@pytest.mark.postgres
+async def test_async_transaction_replay(cli, account_factory):
+    source_account = await account_factory(initial_balance=10)
+    target_account = await account_factory()
+
+    payload = {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 3}
+    headers = {'Idempotency-Key': str(uuid4())}
+    resps = [await cli.post('/transaction?mode=async', json=payload, headers=headers) for _ in range(2)]
+    assert [resp.status for resp in resps] == [202, 202]
+    transaction_id = (await resps[0].json())['data']['id']
+    assert (await resps[1].json())['data']['id'] == transaction_id
+
+    # тот же ключ в другом режиме - другой запрос
+    resp = await cli.post('/transaction', json=payload, headers=headers)
+    assert resp.status == 422
+
+    for _ in range(50):
+        resp = await cli.get(f'/transaction/{transaction_id}')
+        if (await resp.json())['data']['status'] != 'pending':
+            break
+        await asyncio.sleep(0.1)
@@ -0,0 +1,91 @@
+import os
+import asyncio
+
+import pytest
+
+from server.handlers import Idempotency
+from server.memory import MemoryStorage
+from server.exceptions import (
+    DuplicateAccountEmail, AccountNotFound, AccountNotEnoughtMoney, AccountBalanceExceededMaximum, StorageLogError
+)
+
+
+def memory_conf(path, fsync=True):
+    return {'storage': {'backend': 'memory', 'memory': {'log_path': str(path), 'fsync': fsync}}}
+
+
+async def test_log_replay(tmp_path):
+    path = tmp_path / 'ledger.log'
+    storage = MemoryStorage(memory_conf(path))
+    await storage.start()
+
+    source = await storage.create_account('a@test.com', 1001)
+    target = await storage.create_account('b@test.com')
+    dropped = await storage.create_account('c@test.com', 100)
+    await storage.create_account_payment(target['id'], 100)
+    transaction = await storage.create_transaction(source['id'], target['id'], 250)
+    idempotency = Idempotency('payment', 'key-1', 'hash-1', lambda result: (200, str(result['balance'])))
+    response = await storage.create_account_payment(source['id'], 100, idempotency=idempotency)
+    await storage.drop_account(dropped['id'])
+
+    with pytest.raises(DuplicateAccountEmail):
+        await storage.create_account('a@test.com')
+    with pytest.raises(AccountNotFound) as exc_info:
+        await storage.create_transaction(source['id'], dropped['id'], 100)
+    assert exc_info.value.extra_info == ['target_account_id']
+    with pytest.raises(AccountNotEnoughtMoney):
+        await storage.create_transaction(target['id'], source['id'], 10000)
+    with pytest.raises(AccountBalanceExceededMaximum):
+        await storage.create_account_payment(target['id'], 99999900)
+    await storage.close()
+
+    restored = MemoryStorage(memory_conf(path))
+    await restored.start()
+    assert restored.accounts == storage.accounts
+    assert restored.transactions == storage.transactions
+    assert (await restored.get_account(source['id']))['balance'] == 851
+    assert (await restored.get_transaction(transaction['id']))['status'] == 'completed'
+    assert await restored.get_idempotent_response('payment', 'key-1') == response
+
+    # id не переиспользуются, email удаленного счета свободен
+    account = await restored.create_account('c@test.com')
+    assert account['id'] == dropped['id'] + 1
+    await restored.close()
+
+
+async def test_log_unfinished_line(tmp_path):
+    path = tmp_path / 'ledger.log'
+    storage = MemoryStorage(memory_conf(path, fsync=False))
+    await storage.start()
+    account = await storage.create_account('a@test.com', 500)
+    await storage.close()
+
+    size = os.path.getsize(path)
+    with open(path, 'ab') as file:
+        file.write(b'[{"op":"payment","id":2,')
+
+    # процесс упал посреди записи: недописанная строка отрезается
+    storage = MemoryStorage(memory_conf(path, fsync=False))
+    await storage.start()
+    assert (await storage.get_account(account['id']))['balance'] == 500
+    assert os.path.getsize(path) == size
+    await storage.close()
+
+    with open(path, 'ab') as file:
+        file.write(b'garbage\n[]\n')
+    with pytest.raises(StorageLogError):
+        await MemoryStorage(memory_conf(path)).start()
+
+
+async def test_group_fsync(tmp_path):
+    storage = MemoryStorage(memory_conf(tmp_path / 'ledger.log'))
+    await storage.start()
+    account = await storage.create_account('a@test.com')
+
+    await asyncio.gather(*(storage.create_account_payment(account['id'], 1) for _ in range(50)))
+    assert (await storage.get_account(account['id']))['balance'] == 50
+    # пока идет один fsync, следующие изменения копятся и уходят одним
+    stats = storage.get_stats()['memory']['log']
+    assert stats['changes'] == 51
+    assert stats['fsyncs'] < stats['changes']
+    await storage.close()
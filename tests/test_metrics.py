@@ -0,0 +1,75 @@
+import pytest
+
+from server.handlers import SQL_GET_ACCOUNT
+from server.metrics import HistogramFamily
+from server.tracing import Trace, current_trace
+
+
+def _samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_histogram_buckets():
+    family = HistogramFamily('latency_seconds', 'test', ('route',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        family.observe(value, '/a')
+
+    lines = []
+    family.render(lines)
+    samples = _samples('\n'.join(lines))
+    assert samples['latency_seconds_bucket{route="/a",le="0.1"}'] == 2
+    assert samples['latency_seconds_bucket{route="/a",le="1"}'] == 3
+    assert samples['latency_seconds_bucket{route="/a",le="+Inf"}'] == 4
+    assert samples['latency_seconds_count{route="/a"}'] == 4
+    assert samples['latency_seconds_sum{route="/a"}'] == 3.65
+
+
+@pytest.mark.postgres
+async def test_metrics(cli, account_factory):
+    account = await account_factory(initial_balance=10)
+    await cli.get(f"/account/{account['id']}")
+    await cli.get('/account/999999999')
+    await cli.post(f"/account/{account['id']}/payment", json={'amount': 1})
+
+    resp = await cli.get('/metrics')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+
+    samples = _samples(await resp.text())
+    assert samples['http_request_duration_seconds_count{route="/account/{id}",method="GET",status="200"}'] == 1
+    assert samples['http_request_duration_seconds_count{route="/account/{id}",method="GET",status="404"}'] == 1
+    assert samples['http_request_duration_seconds_count{route="/account/{id}/payment",method="POST",status="200"}'] == 1
+    # сам запрос /metrics еще обрабатывается
+    assert samples['http_requests_in_flight'] == 1
+    assert samples['db_pool_wait_seconds_count'] >= 3
+    assert samples['db_statement_duration_seconds_count{statement="get_account"}'] >= 1
+    assert samples['db_lock_wait_seconds_count'] >= 1
+    assert samples['db_transaction_errors_total{error="deadlocks"}'] == 0
+
+
+@pytest.mark.postgres
+async def test_metered_connection(db_handler, account_factory):
+    # время запросов пишется через публичные fetch*/execute, а не через внутренние методы asyncpg
+    account = await account_factory(initial_balance=10)
+    trace = Trace('test', max_spans=100)
+    token = current_trace.set(trace)
+    try:
+        async with db_handler._acquire() as conn:
+            await conn.fetch(SQL_GET_ACCOUNT, account['id'])
+            await conn.fetchrow(SQL_GET_ACCOUNT, account['id'])
+            assert await conn.fetchval('SELECT $1::int', 7) == 7
+            assert await conn.execute('SELECT $1::int', 7) == 'SELECT 1'
+            async with conn.transaction():
+                pass
+    finally:
+        current_trace.reset(token)
+
+    assert sum(db_handler.metrics.statements.labels('get_account').counts) >= 2
+    assert trace.totals['sql:get_account'][0] == 2
+    assert trace.totals['sql:other'][0] == 2
+    assert trace.totals['sql:begin'][0] == trace.totals['sql:commit'][0] == 1
@@ -0,0 +1,60 @@
+from decimal import Decimal
+
+import pytest
+
+from server.memory import MemoryStorage
+from server.constants import MAX_AMOUNT
+from server.exceptions import AccountBalanceExceededMaximum
+from server.money import to_minor_units, format_minor_units, format_money, max_balance
+from server.utils import custom_json_dumps
+
+
+@pytest.mark.parametrize('value, expected', [
+    (10, 1000),
+    (0.1, 10),
+    (2.005, 200),
+    (0.125, 13),
+    (-0.125, -13),
+    ('2.005', 201),
+    (' 7 ', 700),
+    ('1e3', 100000),
+    (Decimal('10.50'), 1050),
+    (Decimal('0.004'), 0),
+    ('1e999999999', MAX_AMOUNT + 1),
+])
+def test_to_minor_units(value, expected):
+    # float переводится точно: 2.005 во float чуть меньше 2.005, поэтому 200, как и у Decimal(2.005)
+    assert to_minor_units(value) == expected
+
+
+@pytest.mark.parametrize('value', ['x', '', 'NaN', float('inf'), Decimal('-Infinity')])
+def test_to_minor_units_invalid(value):
+    with pytest.raises(Exception):
+        to_minor_units(value)
+
+
+def test_format_money():
+    assert [format_minor_units(value) for value in (0, 5, 1050, -5, -1050)] == [
+        '0.00', '0.05', '10.50', '-0.05', '-10.50'
+    ]
+    # форматируются только названные поля, id и остальные числа остаются числами
+    row = {'id': 7, 'amount': 150, 'balance': None, 'count': 3}
+    assert format_money(row, 'amount', 'balance') == {'id': 7, 'amount': '1.50', 'balance': None, 'count': 3}
+    assert row['amount'] == 150
+    # сериализация сама суммы не угадывает: счетчик с именем поля суммы остается числом
+    assert custom_json_dumps({'amount': 150}) == '{"amount": 150}'
+
+
+async def test_max_balance():
+    assert max_balance({}) == 99999999
+    assert max_balance({'money': {'max_balance': 10.5}}) == 1050
+    with pytest.raises(ValueError):
+        max_balance({'money': {'max_balance': '0'}})
+
+    storage = MemoryStorage({'money': {'max_balance': '10'}})
+    await storage.start()
+    account = await storage.create_account('a@test.com', 900)
+    await storage.create_account_payment(account['id'], 100)
+    with pytest.raises(AccountBalanceExceededMaximum):
+        await storage.create_account_payment(account['id'], 1)
+    await storage.close()
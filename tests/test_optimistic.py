@@ -0,0 +1,102 @@
+import os
+import asyncio
+
+import pytest
+
+from server.handlers import DBHandler
+from server.exceptions import AccountNotFound, AccountNotEnoughtMoney, AccountBalanceExceededMaximum
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+@pytest.fixture
+def optimistic_db_handler(loop):
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['database']['concurrency_control'] = 'optimistic'
+    db_handler = DBHandler(conf)
+    loop.run_until_complete(db_handler.start())
+    yield db_handler
+    loop.run_until_complete(db_handler.close())
+
+
+async def test_optimistic_transfer(optimistic_db_handler, account_factory):
+    source = await account_factory(initial_balance=10)
+    target = await account_factory(initial_balance=5)
+
+    await optimistic_db_handler.get_account(source['id'])
+
+    transaction = await optimistic_db_handler.create_transaction(source['id'], target['id'], 201)
+    assert transaction['amount'] == 201
+    assert set(transaction) == {'id', 'source_account_id', 'target_account_id', 'amount', 'ctime'}
+    assert (await optimistic_db_handler.get_account(source['id']))['balance'] == 799
+    assert (await optimistic_db_handler.get_account(target['id']))['balance'] == 701
+
+
+@pytest.mark.parametrize('source_exists, target_exists, amount, error, extra_info', [
+    (False, True, 1, AccountNotFound, ['source_account_id']),
+    (True, False, 1, AccountNotFound, ['target_account_id']),
+    (True, True, 11, AccountNotEnoughtMoney, None),
+    (True, True, 5, AccountBalanceExceededMaximum, None),
+])
+async def test_optimistic_transfer_fail(
+    optimistic_db_handler, account_factory, source_exists, target_exists, amount, error, extra_info
+):
+    source_id = (await account_factory(initial_balance=10))['id'] if source_exists else 999999998
+    target_id = (await account_factory(initial_balance=999999))['id'] if target_exists else 999999999
+
+    with pytest.raises(error) as exc_info:
+        await optimistic_db_handler.create_transaction(source_id, target_id, amount * 100)
+    if extra_info is not None:
+        assert exc_info.value.extra_info == extra_info
+
+    if source_exists:
+        assert (await optimistic_db_handler.get_account(source_id))['balance'] == 1000
+
+
+async def test_optimistic_transfer_conflict(optimistic_db_handler, db_handler, account_factory):
+    source = await account_factory(initial_balance=10)
+    target = await account_factory(initial_balance=0)
+
+    # другая транзакция меняет счет-источник, пока перевод его читает: условный UPDATE ждет ее коммита,
+    # не находит прочитанную версию, и перевод повторяется с новым балансом
+    async with db_handler._acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('UPDATE accounts SET balance = balance - 400 WHERE id = $1', source['id'])
+            transfer = asyncio.ensure_future(
+                optimistic_db_handler.create_transaction(source['id'], target['id'], 500)
+            )
+            await asyncio.sleep(0.2)
+            assert not transfer.done()
+
+    await transfer
+    assert optimistic_db_handler.contention_stats['version_conflicts'] == 1
+    assert (await optimistic_db_handler.get_account(source['id']))['balance'] == 100
+    assert (await optimistic_db_handler.get_account(target['id']))['balance'] == 500
+
+    # после повтора денег на второй такой же перевод уже нет
+    with pytest.raises(AccountNotEnoughtMoney):
+        await optimistic_db_handler.create_transaction(source['id'], target['id'], 500)
+
+
+async def test_optimistic_transfer_concurrent(optimistic_db_handler, account_factory):
+    accounts = [(await account_factory(initial_balance=100))['id'] for _ in range(3)]
+
+    # встречные переводы между тремя счетами: деньги не теряются и не появляются
+    await asyncio.gather(*[
+        optimistic_db_handler.create_transaction(accounts[i % 3], accounts[(i + 1) % 3], 100)
+        for i in range(12)
+    ])
+    balances = [(await optimistic_db_handler.get_account(account_id))['balance'] for account_id in accounts]
+    assert balances == [10000] * 3
+
+
+async def test_optimistic_transfer_sharded(optimistic_db_handler, account_factory):
+    hot_account = await account_factory(initial_balance=10)
+    other_account = await account_factory(initial_balance=100)
+    await optimistic_db_handler.enable_balance_sharding(hot_account['id'], 4)
+
+    await optimistic_db_handler.create_transaction(other_account['id'], hot_account['id'], 2000)
+    await optimistic_db_handler.create_transaction(hot_account['id'], other_account['id'], 2500)
+    assert (await optimistic_db_handler.get_account(hot_account['id']))['balance'] == 500
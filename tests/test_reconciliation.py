@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from server.reconciliation import Reconciler
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+async def test_reconciliation(cli, account_factory, db_handler):
+    reconciler = Reconciler(db_handler, load_conf(os.path.join(os.getcwd(), 'config.yml')))
+
+    source_account = await account_factory(initial_balance=100)
+    target_account = await account_factory()
+    await cli.post('/transaction', json={
+        'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 30
+    })
+    await cli.post(f'/account/{target_account["id"]}/payment', json={'amount': 5})
+
+    report = await reconciler.run()
+    drifted = {account['account_id'] for account in report['drifted']}
+    assert not drifted & {source_account['id'], target_account['id']}
+
+    # баланс разошелся с журналом
+    async with db_handler._acquire() as conn:
+        await conn.execute('UPDATE accounts SET balance = balance + 100 WHERE id = $1', target_account['id'])
+    await cli.post('/transaction', json={
+        'source_account_id': target_account['id'], 'target_account_id': source_account['id'], 'amount': 10
+    })
+
+    next_report = await reconciler.run()
+    assert next_report['from_transaction_id'] == report['to_transaction_id']
+    drifted = {account['account_id']: account for account in next_report['drifted']}
+    assert source_account['id'] not in drifted
+    assert drifted[target_account['id']]['expected'] == 2500
+    assert drifted[target_account['id']]['drift'] == 100
+
+    full_report = await reconciler.run(full=True)
+    assert full_report['from_transaction_id'] == 0
+    assert target_account['id'] in {account['account_id'] for account in full_report['drifted']}
@@ -0,0 +1,137 @@
+import os
+
+import pytest
+
+from server.app import Application
+from server.cache import MISSING
+from server.handlers import DBHandler, CONSISTENCY_TOKEN_HEADER
+from server.replicas import parse_lsn, MAX_LSN, SQL_PRIMARY_LSN, SQL_REPLICA_STATE
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+# реплика в тестах - та же основная база: она не в recovery, поэтому проверка состояния ее не включает,
+# а тест может включить ее сам и проверить, куда уходят чтения
+def replica_conf():
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['database']['replicas'] = {'dsns': [conf['database']['dsn']], 'check_interval': 3600}
+    # чтения с реплик не должны попадать в кэш, он выключен по умолчанию
+    conf['cache'] = {'enabled': True}
+    return conf
+
+
+@pytest.fixture
+def replica_db_handler(loop):
+    db_handler = DBHandler(replica_conf())
+    loop.run_until_complete(db_handler.start())
+    yield db_handler
+    loop.run_until_complete(db_handler.close())
+
+
+@pytest.fixture
+def replica_cli(loop, aiohttp_client):
+    return loop.run_until_complete(aiohttp_client(Application(replica_conf()).webapp))
+
+
+def test_lsn():
+    assert parse_lsn('16/B374D848') == (0x16 << 32) + 0xB374D848
+    assert parse_lsn('FFFFFFFF/FFFFFFFF') == MAX_LSN
+    assert parse_lsn('0/0') < parse_lsn('0/1') < parse_lsn('1/0')
+    for token in ('', '16', '16/', 'x/1', '1/2/3', '100000000/0'):
+        with pytest.raises(ValueError):
+            parse_lsn(token)
+
+
+async def test_replica_not_in_recovery(replica_db_handler, account_factory):
+    account = await account_factory(initial_balance=10)
+
+    # основная база под видом реплики: она не проигрывает WAL, и чтения на нее не идут
+    assert not replica_db_handler.replicas.replicas[0].available
+    assert (await replica_db_handler.get_account(account['id']))['balance'] == 1000
+    assert replica_db_handler.replicas.stats['primary_reads'] == 1
+    assert replica_db_handler.replicas.stats['reads'] == 0
+
+
+async def test_replica_state(replica_db_handler):
+    # у основной базы нет WAL receiver и проигранного WAL: отставание не определено, реплика не включается
+    replica = replica_db_handler.replicas.replicas[0]
+    primary_lsn = await replica_db_handler.db_pool.fetchval(SQL_PRIMARY_LSN)
+    async with replica.pool.acquire() as conn:
+        state = await conn.fetchrow(SQL_REPLICA_STATE, primary_lsn)
+    assert (state['in_recovery'], state['streaming'], state['lag']) == (False, False, None)
+
+    await replica_db_handler.replicas.check(replica)
+    assert not replica.available and replica.lag is None
+
+
+async def test_replica_reads(replica_db_handler, account_factory):
+    account = await account_factory(initial_balance=10)
+    replica = replica_db_handler.replicas.replicas[0]
+    replica.available = True
+
+    assert (await replica_db_handler.get_account(account['id']))['balance'] == 1000
+    assert replica_db_handler.replicas.stats['reads'] == 1
+    # прочитанное с реплики в кэш не кладется
+    assert replica_db_handler.accounts_cache.get(account['id']) is MISSING
+
+    await replica_db_handler.create_account_payment(account['id'], 500)
+
+    # известная позиция реплики позади токена, а сама она позицию не знает (не в recovery) - читаем с основной
+    min_lsn = parse_lsn(await replica_db_handler.get_write_lsn())
+    replica.replay_lsn = min_lsn - 1
+    assert (await replica_db_handler.get_account(account['id'], min_lsn=min_lsn))['balance'] == 1500
+    assert replica_db_handler.replicas.stats['behind'] == 1
+    assert replica_db_handler.replicas.stats['primary_reads'] == 1
+
+    # позиция реплики догнала токен. прочитанное с основной базы легло в кэш, убираем его
+    replica.replay_lsn = min_lsn
+    replica_db_handler.accounts_cache.invalidate(account['id'])
+    assert (await replica_db_handler.get_account(account['id'], min_lsn=min_lsn))['balance'] == 1500
+    assert replica_db_handler.replicas.stats['reads'] == 2
+
+
+async def test_consistency_token(replica_cli, account_factory):
+    account = await account_factory(initial_balance=10)
+
+    resp = await replica_cli.post(f'/account/{account["id"]}/payment', json={'amount': 5})
+    assert resp.status == 200
+    token = resp.headers[CONSISTENCY_TOKEN_HEADER]
+    parse_lsn(token)
+
+    for token in (token, 'garbage'):
+        resp = await replica_cli.get(f'/account/{account["id"]}', headers={CONSISTENCY_TOKEN_HEADER: token})
+        assert resp.status == 200
+        assert (await resp.json())['data']['balance'] == '15.00'
+
+    # чтения и неуспешные записи токен не получают
+    assert CONSISTENCY_TOKEN_HEADER not in resp.headers
+    resp = await replica_cli.post('/account/999999999/payment', json={'amount': 5})
+    assert resp.status == 404
+    assert CONSISTENCY_TOKEN_HEADER not in resp.headers
+
+    resp = await replica_cli.get('/stats')
+    # чтения с токеном идут мимо кэша, оба - с основной базы: реплика не в recovery
+    assert (await resp.json())['data']['replicas']['primary_reads'] == 2
+
+
+async def test_cached_account_with_token(account_factory):
+    # изменение, инвалидация которого еще не дошла до процесса: без токена кэш отдает старый баланс,
+    # с токеном чтение идет мимо кэша
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['cache'] = {'enabled': True}
+    db_handler = DBHandler(conf)
+    await db_handler.start()
+    try:
+        account = await account_factory(initial_balance=10)
+        assert (await db_handler.get_account(account['id']))['balance'] == 1000
+
+        async with db_handler._acquire() as conn:
+            await conn.execute('UPDATE accounts SET balance = 5000 WHERE id = $1', account['id'])
+        min_lsn = parse_lsn(await db_handler.get_write_lsn())
+
+        assert (await db_handler.get_account(account['id']))['balance'] == 1000
+        assert (await db_handler.get_account(account['id'], min_lsn=min_lsn))['balance'] == 5000
+    finally:
+        await db_handler.close()
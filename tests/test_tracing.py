@@ -0,0 +1,86 @@
+import os
+import json
+import asyncio
+
+import pytest
+from loguru import logger
+
+from server.app import Application
+from server.tracing import TRACE_ID_HEADER
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+def tracing_conf(**overrides):
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['tracing'] = {'enabled': True, 'slow_request_threshold': 0}
+    # спан очереди admission есть, только если она включена
+    conf['admission'] = dict(conf['admission'], enabled=True)
+    conf.update(overrides)
+    return conf
+
+
+@pytest.fixture
+def slow_log():
+    records = []
+    sink_id = logger.add(lambda message: records.append(message.record['message']), level='WARNING')
+    yield records
+    logger.remove(sink_id)
+
+
+async def test_slow_request_spans(loop, aiohttp_client, account_factory, slow_log):
+    cli = await aiohttp_client(Application(tracing_conf()).webapp)
+    source = await account_factory(initial_balance=10)
+    target = await account_factory()
+
+    resp = await cli.post(
+        '/transaction', json={'source_account_id': source['id'], 'target_account_id': target['id'], 'amount': 1}
+    )
+    assert resp.status == 200
+    trace_id = resp.headers[TRACE_ID_HEADER]
+
+    records = [json.loads(message.split(': ', 1)[1]) for message in slow_log if message.startswith('Slow request')]
+    record, = [record for record in records if record['trace_id'] == trace_id]
+    assert (record['route'], record['status']) == ('/transaction', 200)
+    assert {
+        'parse_request', 'validate', 'admission', 'pool_acquire', 'lock_wait', 'sql:lock_transfer_accounts',
+        'sql:begin', 'sql:commit', 'json_dumps',
+    } <= set(record['spans'])
+    assert [span[0] for span in record['timeline']][:3] == ['admission', 'parse_request', 'validate']
+
+    # id трассировки от клиента сохраняется
+    resp = await cli.get(f'/account/{source["id"]}', headers={TRACE_ID_HEADER: 'lb-1234'})
+    assert resp.headers[TRACE_ID_HEADER] == 'lb-1234'
+
+
+async def test_profiling(loop, aiohttp_client, tmp_path):
+    cli = await aiohttp_client(Application(tracing_conf()).webapp)
+    resp = await cli.post('/admin/profiling', json={'action': 'start'})
+    assert resp.status == 403
+
+    conf = tracing_conf(profiling={'enabled': True, 'directory': str(tmp_path)})
+    cli = await aiohttp_client(Application(conf).webapp)
+
+    resp = await cli.post('/admin/profiling', json={'action': 'start', 'interval_ms': 1})
+    assert resp.status == 200
+    assert (await resp.json())['data']['running']
+    resp = await cli.post('/admin/profiling', json={'action': 'start'})
+    assert resp.status == 409
+
+    for _ in range(20):
+        await cli.get('/stats')
+        await asyncio.sleep(0.005)
+
+    resp = await cli.post('/admin/profiling', json={'action': 'stop'})
+    assert resp.status == 200
+    status = (await resp.json())['data']
+    assert not status['running'] and status['samples'] > 0
+    with open(status['path']) as file:
+        stacks = [line.rsplit(' ', 1) for line in file]
+    assert sum(int(count) for _, count in stacks) == status['samples']
+    assert any('server.handlers.AppHandlers.get_stats' in stack or 'asyncio' in stack for stack, _ in stacks)
+
+    resp = await cli.post('/admin/profiling', json={'action': 'stop'})
+    assert resp.status == 409
@@ -1,4 +1,8 @@
+import io
+import csv
+import json
 import random
+import asyncio
 from decimal import Decimal
 
 import pytest
@@ -125,3 +129,181 @@ async def test_get_transaction_fail(cli, account_factory, transaction_id, http_s
     response = await resp.json()
     assert response['success'] is False
     assert 'id' in response['error']
+
+
+async def test_cross_transactions(cli, account_factory):
+    # встречные переводы не должны дедлочиться
+    account_a = await account_factory(initial_balance=100)
+    account_b = await account_factory(initial_balance=100)
+
+    def _transfer(source, target):
+        payload = {'source_account_id': source['id'], 'target_account_id': target['id'], 'amount': 1}
+        return cli.post('/transaction', json=payload)
+
+    responses = await asyncio.gather(*[
+        _transfer(account_a, account_b) if i % 2 else _transfer(account_b, account_a) for i in range(40)
+    ])
+    assert [resp.status for resp in responses] == [200] * 40
+
+    resp = await cli.get(f"/account/{account_a['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(100)
+
+
+@pytest.mark.postgres
+async def test_transactions_batch(cli, account_factory):
+    source_account = await account_factory(initial_balance=10)
+    target_account = await account_factory(initial_balance=999999)
+    other_account = await account_factory()
+
+    transfers = [
+        {'source_account_id': source_account['id'], 'target_account_id': other_account['id'], 'amount': 4},
+        {'source_account_id': source_account['id'], 'target_account_id': other_account['id'], 'amount': 7},
+        {'source_account_id': other_account['id'], 'target_account_id': source_account['id'], 'amount': 1},
+        {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 1},
+        {'source_account_id': source_account['id'], 'target_account_id': 9999999, 'amount': 1},
+        {'source_account_id': source_account['id'], 'target_account_id': source_account['id'], 'amount': 1},
+    ]
+
+    resp = await cli.post('/transactions/batch', json={'transfers': transfers})
+    assert resp.status == 200
+
+    results = (await resp.json())['data']
+    assert [r['success'] for r in results] == [True, False, True, False, False, False]
+    assert results[0]['data']['amount'] == decimal_to_str(4)
+    assert results[0]['data']['id'] < results[2]['data']['id']
+    assert 'source_account_id' in results[1]['error']
+    assert 'amount' in results[3]['error']
+    assert 'target_account_id' in results[4]['error']
+    assert 'target_account' in results[5]['error']
+
+    resp = await cli.get(f"/account/{source_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(7)
+
+    resp = await cli.get(f"/account/{other_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(3)
+
+    resp = await cli.get(f"/transaction/{results[2]['data']['id']}")
+    assert (await resp.json())['data']['source_account_id'] == other_account['id']
+
+
+@pytest.mark.parametrize("payload", [{}, {'transfers': []}, {'transfers': [{'amount': 1}]}])
+@pytest.mark.postgres
+async def test_transactions_batch_invalid(cli, payload):
+    resp = await cli.post('/transactions/batch', json=payload)
+    assert resp.status == 422
+
+    response = await resp.json()
+    assert response['success'] is False
+    assert 'transfers' in response['error']
+
+
+async def _wait_transaction_status(cli, transaction_id):
+    for _ in range(50):
+        resp = await cli.get(f'/transaction/{transaction_id}')
+        response = await resp.json()
+        if response['data']['status'] != 'pending':
+            return response['data']
+        await asyncio.sleep(0.1)
+    raise AssertionError('transaction is still pending')
+
+
+@pytest.mark.postgres
+async def test_async_transaction(cli, account_factory, db_handler):
+    source_account = await account_factory(initial_balance=10)
+    target_account = await account_factory()
+
+    payload = {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 3}
+    resp = await cli.post('/transaction?mode=async', json=payload)
+    assert resp.status == 202
+
+    response = await resp.json()
+    assert response['data']['status'] == 'pending'
+
+    transaction_data = await _wait_transaction_status(cli, response['data']['id'])
+    assert transaction_data['status'] == 'completed'
+    assert transaction_data['amount'] == decimal_to_str(3)
+    # проведенный запрос не остается в очереди
+    async with db_handler._acquire() as conn:
+        assert not await conn.fetchval('SELECT count(*) FROM transfer_requests WHERE id = $1', transaction_data['id'])
+
+    resp = await cli.get(f"/account/{target_account['id']}")
+    assert (await resp.json())['data']['balance'] == decimal_to_str(3)
+
+
+@pytest.mark.postgres
+async def test_async_transaction_connection_lost(db_handler, account_factory, monkeypatch):
+    source_account = await account_factory(initial_balance=10)
+    target_account = await account_factory()
+    request = await db_handler.enqueue_transaction(source_account['id'], target_account['id'], 300)
+
+    async def _lost(*args, **kwargs):
+        raise ConnectionResetError
+
+    # обрыв соединения посреди перевода не делает запрос failed, он остается в очереди
+    monkeypatch.setattr(db_handler, '_execute_transfer', _lost)
+    with pytest.raises(ConnectionResetError):
+        await db_handler.process_transfer_request(lambda exc: None)
+    monkeypatch.undo()
+    assert (await db_handler.get_transaction(request['id']))['status'] == 'pending'
+
+    while await db_handler.process_transfer_request(lambda exc: None):
+        pass
+    assert (await db_handler.get_transaction(request['id']))['status'] == 'completed'
+
+
+@pytest.mark.postgres
+async def test_async_transaction_fail(cli, account_factory):
+    source_account = await account_factory(initial_balance=1)
+    target_account = await account_factory()
+
+    payload = {'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': 3}
+    resp = await cli.post('/transaction?mode=async', json=payload)
+    assert resp.status == 202
+
+    transaction_data = await _wait_transaction_status(cli, (await resp.json())['data']['id'])
+    assert transaction_data['status'] == 'failed'
+    assert 'source_account_id' in transaction_data['error']
+
+    resp = await cli.post('/transaction?mode=later', json=payload)
+    assert resp.status == 422
+    assert 'mode' in (await resp.json())['error']
+
+
+@pytest.mark.postgres
+async def test_export_transactions(cli, account_factory):
+    source_account = await account_factory(initial_balance=100)
+    target_account = await account_factory()
+
+    transaction_ids = []
+    for amount in [1, 2, 3]:
+        resp = await cli.post('/transaction', json={
+            'source_account_id': source_account['id'], 'target_account_id': target_account['id'], 'amount': amount
+        })
+        transaction_ids.append((await resp.json())['data']['id'])
+
+    resp = await cli.get('/transactions/export', params={'account_id': target_account['id'], 'with_accounts': 'true'})
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'application/x-ndjson'
+
+    lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert [line['id'] for line in lines] == transaction_ids
+    assert lines[0]['amount'] == '1.00'
+    assert lines[0]['source_email'] == source_account['email']
+
+    # продолжение выгрузки после обрыва
+    resp = await cli.get('/transactions/export', params={
+        'account_id': target_account['id'], 'after_id': transaction_ids[0], 'format': 'csv'
+    })
+    assert resp.status == 200
+
+    rows = list(csv.reader(io.StringIO(await resp.text())))
+    assert rows[0] == ['id', 'source_account_id', 'target_account_id', 'amount', 'ctime']
+    assert [int(row[0]) for row in rows[1:]] == transaction_ids[1:]
+    assert rows[1][3] == '2.00'
+
+
+@pytest.mark.parametrize("params", [{'format': 'xml'}, {'after_id': -1}, {'with_accounts': 'yes'}])
+@pytest.mark.postgres
+async def test_export_transactions_invalid(cli, params):
+    resp = await cli.get('/transactions/export', params=params)
+    assert resp.status == 422
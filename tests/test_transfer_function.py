@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from server.handlers import DBHandler
+from server.exceptions import AccountNotFound, AccountNotEnoughtMoney, AccountBalanceExceededMaximum
+from server.utils import load_conf
+
+
+pytestmark = pytest.mark.postgres
+
+
+@pytest.fixture
+def transfer_db_handler(loop):
+    conf = load_conf(os.path.join(os.getcwd(), 'config.yml'))
+    conf['database']['transfer_function'] = True
+    db_handler = DBHandler(conf)
+    loop.run_until_complete(db_handler.start())
+    yield db_handler
+    loop.run_until_complete(db_handler.close())
+
+
+async def test_transfer_function(transfer_db_handler, account_factory):
+    source = await account_factory(initial_balance=10)
+    target = await account_factory(initial_balance=999990)
+
+    # прогрев кэша счетов: после перевода в нем не должно остаться старого баланса
+    await transfer_db_handler.get_account(source['id'])
+
+    transaction = await transfer_db_handler.create_transaction(source['id'], target['id'], 201)
+    assert transaction['amount'] == 201
+    assert set(transaction) == {'id', 'source_account_id', 'target_account_id', 'amount', 'ctime'}
+    assert (await transfer_db_handler.get_account(source['id']))['balance'] == 799
+    assert (await transfer_db_handler.get_transaction(transaction['id']))['amount'] == 201
+
+
+@pytest.mark.parametrize('source_exists, target_exists, amount, error, extra_info', [
+    (False, True, 1, AccountNotFound, ['source_account_id']),
+    (True, False, 1, AccountNotFound, ['target_account_id']),
+    (False, False, 1, AccountNotFound, ['source_account_id', 'target_account_id']),
+    (True, True, 11, AccountNotEnoughtMoney, None),
+    (True, True, 5, AccountBalanceExceededMaximum, None),
+])
+async def test_transfer_function_fail(
+    transfer_db_handler, account_factory, source_exists, target_exists, amount, error, extra_info
+):
+    source_id = (await account_factory(initial_balance=10))['id'] if source_exists else 999999998
+    target_id = (await account_factory(initial_balance=999999))['id'] if target_exists else 999999999
+
+    with pytest.raises(error) as exc_info:
+        await transfer_db_handler.create_transaction(source_id, target_id, amount * 100)
+    if extra_info is not None:
+        assert exc_info.value.extra_info == extra_info
+
+    if source_exists:
+        assert (await transfer_db_handler.get_account(source_id))['balance'] == 1000
+
+
+async def test_transfer_function_sharded(transfer_db_handler, account_factory):
+    hot_account = await account_factory(initial_balance=10)
+    other_account = await account_factory(initial_balance=100)
+    await transfer_db_handler.enable_balance_sharding(hot_account['id'], 4)
+
+    # шардированные счета проводятся обычным путем
+    await transfer_db_handler.create_transaction(other_account['id'], hot_account['id'], 2000)
+    await transfer_db_handler.create_transaction(hot_account['id'], other_account['id'], 2500)
+    assert (await transfer_db_handler.get_account(hot_account['id']))['balance'] == 500
+
+    with pytest.raises(AccountNotEnoughtMoney):
+        await transfer_db_handler.create_transaction(hot_account['id'], other_account['id'], 600)
@@ -0,0 +1,55 @@
+from decimal import Decimal
+
+import pytest
+
+from server.schemas import (
+    CREATE_ACCOUNT, ACCOUNT_PAYMENT, CREATE_TRANSACTION, CREATE_TRANSACTIONS_BATCH, GET_OBJECT_BY_ID,
+    ACCOUNT_TRANSACTIONS, EXPORT_TRANSACTIONS, IMPORT_ACCOUNT
+)
+from server.utils import cerberus_validate
+from server.validation import compile_schema, UnsupportedSchema
+
+
+VALUES = [
+    None, True, 0, 1, -1, 5.5, 0.001, 999999999999999999999999, Decimal('0.01'),
+    '1', '0', '-1', ' 7 ', '1e3', 'x', '', 'NaN', 'test@test.com', 'test@', [], [1], {}, {'a': 1},
+    'in', 'csv', 'true', 'false', '2026-10-18T12:00:00', '2026-10-18T12:00:00+03:00', 'MjAyNi0xMC0xOFQxMjowMDowMCwx'
+]
+
+SCHEMAS = [
+    CREATE_ACCOUNT, ACCOUNT_PAYMENT, CREATE_TRANSACTION, CREATE_TRANSACTIONS_BATCH, GET_OBJECT_BY_ID,
+    ACCOUNT_TRANSACTIONS, EXPORT_TRANSACTIONS, IMPORT_ACCOUNT
+]
+
+
+def _documents(schema):
+    yield {}
+    for field in list(schema) + ['unknown']:
+        for value in VALUES:
+            yield {field: value}
+
+    transfer = {'source_account_id': 1, 'target_account_id': 2, 'amount': 1}
+    for value in VALUES:
+        yield dict(transfer, amount=value)
+        yield {'transfers': [transfer, dict(transfer, source_account_id=value), value]}
+
+
+def _run(validate, document):
+    try:
+        is_valid, normalized, errors = validate(document)
+    except Exception as exc:
+        return type(exc)
+    return is_valid, normalized if is_valid else None, errors
+
+
+@pytest.mark.parametrize('schema', SCHEMAS)
+def test_compiled_schema_same_as_cerberus(schema):
+    compiled = compile_schema(schema)
+    for document in _documents(schema):
+        expected = _run(lambda d: cerberus_validate(schema, d), document)
+        assert repr(_run(compiled, document)) == repr(expected), document
+
+
+def test_unsupported_schema():
+    with pytest.raises(UnsupportedSchema):
+        compile_schema({'email': dict(type='string', empty=False)})